@@ -65,6 +65,7 @@ async def api_process_documents(doc_request: DocumentProcessRequest):
         category=category,
         skipblobs=False,
         disablebatchvectors=False,
+        incremental=False,
         searchkey=None,
         storagekey=None,
         datalakekey=None,
@@ -1,3 +1,4 @@
+import asyncio
 import dataclasses
 import io
 import json
@@ -5,8 +6,9 @@ import logging
 import mimetypes
 import os
 import time
+from json.encoder import encode_basestring
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, Union, cast
+from typing import Any, AsyncGenerator, Dict, Optional, Union, cast
 
 from azure.cognitiveservices.speech import (
     ResultReason,
@@ -49,14 +51,17 @@ from quart import (
 )
 from quart_cors import cors
 
-from approaches.approach import Approach
+from approaches.approach import Approach, Document
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
+from approaches.contextpacker import ContextPacker
+from approaches.keywordclassifier import KeywordClassifier
 from approaches.promptmanager import PromptyManager
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
 from chat_history.cosmosdb import chat_history_cosmosdb_bp
 from config import (
+    CONFIG_ANSWER_CACHE,
     CONFIG_ASK_APPROACH,
     CONFIG_ASK_VISION_APPROACH,
     CONFIG_AUTH_CLIENT,
@@ -66,10 +71,16 @@ from config import (
     CONFIG_CHAT_HISTORY_COSMOS_ENABLED,
     CONFIG_CHAT_VISION_APPROACH,
     CONFIG_CREDENTIAL,
+    CONFIG_EMBEDDING_CACHE,
     CONFIG_GPT4V_DEPLOYED,
+    CONFIG_HTTP_CLIENTS,
     CONFIG_INGESTER,
     CONFIG_LANGUAGE_PICKER_ENABLED,
     CONFIG_OPENAI_CLIENT,
+    CONFIG_PROMPT_MANAGER,
+    CONFIG_PROMPT_RELOAD_TASK,
+    CONFIG_CACHE_STATS_ENABLED,
+    CONFIG_SEARCH_CACHE,
     CONFIG_SEARCH_CLIENT,
     CONFIG_SEMANTIC_RANKER_DEPLOYED,
     CONFIG_SPEECH_INPUT_ENABLED,
@@ -79,13 +90,18 @@ from config import (
     CONFIG_SPEECH_SERVICE_LOCATION,
     CONFIG_SPEECH_SERVICE_TOKEN,
     CONFIG_SPEECH_SERVICE_VOICE,
+    CONFIG_STREAM_FLUSH_INTERVAL,
     CONFIG_USER_BLOB_CONTAINER_CLIENT,
     CONFIG_USER_UPLOAD_ENABLED,
     CONFIG_VECTOR_SEARCH_ENABLED,
     CONFIG_COSMOS_LOGGING_CLIENT,
     CONFIG_COSMOS_LOGGING_CONTAINER
 )
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
+from core.httpclient import HTTPClientRegistry
+from core.searchcache import SearchCache
 from core.sessionhelper import create_session_id
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
@@ -96,6 +112,7 @@ from prepdocs import (
     setup_search_info,
 )
 from prepdocslib.filestrategy import UploadUserFileStrategy
+from prepdocslib.indexversion import IndexVersion
 from prepdocslib.listfilestrategy import File
 
 bp = Blueprint("routes", __name__, static_folder="static")
@@ -176,6 +193,31 @@ async def content_file(path: str, auth_claims: Dict[str, Any]):
     return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
 
 
+@bp.route("/api/document/<document_id>/vectors", methods=["GET"])
+@authenticated
+async def document_vectors(auth_claims: Dict[str, Any], document_id: str):
+    """
+    Returns the embeddings of a document of the search index, which are left out of the search results
+    unless the include_vectors override is set, for debugging the retrieval.
+    """
+    auth_helper: AuthenticationHelper = current_app.config[CONFIG_AUTH_CLIENT]
+    search_client: SearchClient = current_app.config[CONFIG_SEARCH_CLIENT]
+    try:
+        document = await search_client.get_document(key=document_id)
+    except ResourceNotFoundError:
+        abort(404)
+    # The user needs to have access to the source of the document, as for /content
+    if not await auth_helper.check_path_auth(document.get("sourcepage") or "", auth_claims, search_client):
+        abort(403)
+    return jsonify(
+        {
+            "id": document_id,
+            "embedding": document.get("embedding"),
+            "imageEmbedding": document.get("imageEmbedding"),
+        }
+    )
+
+
 @bp.route("/api/ask", methods=["POST"])
 @authenticated
 async def ask(auth_claims: Dict[str, Any]):
@@ -206,13 +248,88 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
-async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+# The format of the events with a token of the answer, which are most of the events of a stream
+DELTA_TEMPLATE = '{"delta": {"content": %s, "role": %s}}\n'
+
+
+def encode_delta_value(value: Optional[str]) -> str:
+    return "null" if value is None else encode_basestring(value)
+
+
+def format_ndjson_line(event: dict) -> str:
+    # Answer tokens are formatted without going through the encoder, into the same line that json.dumps writes.
+    # Only the first delta of an answer has a role, the ones of the following tokens have a null role.
+    delta = event.get("delta")
+    if len(event) == 1 and isinstance(delta, dict) and tuple(delta) == ("content", "role"):
+        content, role = delta["content"], delta["role"]
+        if isinstance(content, (str, type(None))) and isinstance(role, (str, type(None))):
+            return DELTA_TEMPLATE % (encode_delta_value(content), encode_delta_value(role))
+    return json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
+
+
+async def format_as_ndjson(r: AsyncGenerator[dict, None], flush_interval: float = 0) -> AsyncGenerator[str, None]:
+    """
+    Formats the events of the stream as lines of JSON.
+    With a flush_interval, the lines of the events that arrive within that many seconds of the first one
+    are sent together, which saves a write to the connection per token of the answer.
+    """
+    if flush_interval <= 0:
+        try:
+            async for event in r:
+                yield format_ndjson_line(event)
+        except Exception as error:
+            logging.exception("Exception while generating response stream: %s", error)
+            yield json.dumps(error_dict(error))
+        finally:
+            await r.aclose()
+        return
+
+    # A single task reads the whole stream, as the generator of the approach must always run in the same task
+    events: asyncio.Queue = asyncio.Queue()
+    stream_end = object()
+
+    async def read_events():
+        try:
+            async for event in r:
+                events.put_nowait(event)
+        except Exception as error:
+            events.put_nowait(error)
+        events.put_nowait(stream_end)
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.create_task(read_events())
+    lines: list[str] = []
+    flush_at = 0.0
+    next_event: asyncio.Future = asyncio.ensure_future(events.get())
     try:
-        async for event in r:
-            yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
+        while True:
+            if lines:
+                # The lines are sent when the window ends, even if the next event is still being generated
+                done, _ = await asyncio.wait({next_event}, timeout=max(flush_at - loop.time(), 0))
+                if not done:
+                    yield "".join(lines)
+                    lines = []
+                    continue
+            event = await next_event
+            if event is stream_end:
+                break
+            if isinstance(event, Exception):
+                raise event
+            if not lines:
+                flush_at = loop.time() + flush_interval
+            lines.append(format_ndjson_line(event))
+            next_event = asyncio.ensure_future(events.get())
+        if lines:
+            yield "".join(lines)
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
-        yield json.dumps(error_dict(error))
+        yield "".join(lines) + json.dumps(error_dict(error))
+    finally:
+        next_event.cancel()
+        # The client can disconnect before the end of the stream, which stops the reader where it is
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+        await r.aclose()
 
 
 @bp.route("/api/chat", methods=["POST"])
@@ -278,7 +395,7 @@ async def chat_stream(auth_claims: Dict[str, Any]):
             context=context,
             session_state=session_state,
         )
-        response = await make_response(format_as_ndjson(result))
+        response = await make_response(format_as_ndjson(result, current_app.config[CONFIG_STREAM_FLUSH_INTERVAL]))
         response.timeout = None  # type: ignore
         response.mimetype = "application/json-lines"
         return response
@@ -311,6 +428,27 @@ def config():
     )
 
 
+@bp.route("/api/cache_stats", methods=["GET"])
+@authenticated
+async def cache_stats(auth_claims: Dict[str, Any]):
+    # The statistics cover the requests of every user, so they are only served when enabled for the operators
+    if not current_app.config[CONFIG_CACHE_STATS_ENABLED]:
+        return jsonify({"error": "Cache statistics not enabled"}), 400
+    embedding_cache: Optional[EmbeddingCache] = current_app.config.get(CONFIG_EMBEDDING_CACHE)
+    answer_cache: Optional[AnswerCache] = current_app.config.get(CONFIG_ANSWER_CACHE)
+    search_cache: Optional[SearchCache] = current_app.config.get(CONFIG_SEARCH_CACHE)
+    prompt_manager: PromptyManager = current_app.config[CONFIG_PROMPT_MANAGER]
+    return jsonify(
+        {
+            "queryEmbeddings": embedding_cache.stats() if embedding_cache else None,
+            "answers": answer_cache.stats() if answer_cache else None,
+            "searchResults": search_cache.stats() if search_cache else None,
+            **current_app.config[CONFIG_AUTH_CLIENT].get_cache_stats(),
+            "prompts": {"version": prompt_manager.version, "reloads": prompt_manager.reloads},
+        }
+    )
+
+
 @bp.route("/api/speech", methods=["POST"])
 async def speech():
     if not request.is_json:
@@ -495,12 +633,51 @@ async def setup_clients():
     USE_SPEECH_OUTPUT_AZURE = os.getenv("USE_SPEECH_OUTPUT_AZURE", "").lower() == "true"
     USE_CHAT_HISTORY_BROWSER = os.getenv("USE_CHAT_HISTORY_BROWSER", "").lower() == "true"
     USE_CHAT_HISTORY_COSMOS = os.getenv("USE_CHAT_HISTORY_COSMOS", "").lower() == "true"
+    USE_SPECULATIVE_QUERY_EMBEDDING = os.getenv("USE_SPECULATIVE_QUERY_EMBEDDING", "").lower() == "true"
+    USE_LOCAL_KEYWORD_CLASSIFIER = os.getenv("USE_LOCAL_KEYWORD_CLASSIFIER", "").lower() == "true"
+    KEYWORD_CLASSIFIER_RULES_FILE = os.getenv("KEYWORD_CLASSIFIER_RULES_FILE") or KeywordClassifier.DEFAULT_RULES_FILE
+    USE_KEYWORD_CLASSIFIER_LLM_FALLBACK = os.getenv("USE_KEYWORD_CLASSIFIER_LLM_FALLBACK", "").lower() == "true"
+    USE_MULTI_QUERY_SEARCH = os.getenv("USE_MULTI_QUERY_SEARCH", "").lower() == "true"
+    MULTI_QUERY_CONCURRENCY = int(os.getenv("MULTI_QUERY_CONCURRENCY") or 2)
 
     # WEBSITE_HOSTNAME is always set by App Service, RUNNING_IN_PRODUCTION is set in main.bicep
     RUNNING_ON_AZURE = os.getenv("WEBSITE_HOSTNAME") is not None or os.getenv("RUNNING_IN_PRODUCTION") is not None
     
     # EXPOSE LOG REQUESTS API AND STORE IN COSMOS DB
     USE_REQLOG = os.getenv("USE_REQLOG", "").lower() == "true"
+
+    # Connection pooling for the outbound HTTP calls made with aiohttp, a limit of 0 means unlimited
+    HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS") or 100)
+    HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST") or 0)
+    HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT") or 30)
+    HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL") or 300)
+
+    # Repeated questions reuse the embedding of the query instead of calling the embeddings API
+    USE_QUERY_EMBEDDING_CACHE = os.getenv("USE_QUERY_EMBEDDING_CACHE", "").lower() == "true"
+    QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE") or 1000)
+    # Optional SQLite file that persists the query embeddings and shares them between the workers
+    QUERY_EMBEDDING_CACHE_FILE = os.getenv("QUERY_EMBEDDING_CACHE_FILE")
+
+    # Answers of frequently asked questions are reused until the search index changes or they expire
+    USE_ANSWER_CACHE = os.getenv("USE_ANSWER_CACHE", "").lower() == "true"
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE") or 1000)
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL") or 3600)
+    # Questions whose embeddings are at least this similar share their answer, unset to only reuse identical questions
+    ANSWER_CACHE_SIMILARITY_THRESHOLD = os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD")
+    # Identical searches made within the ttl (in seconds) reuse the documents that were found
+    USE_SEARCH_CACHE = os.getenv("USE_SEARCH_CACHE", "").lower() == "true"
+    SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE") or 1000)
+    SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL") or 60)
+    # Optional file touched whenever documents are ingested, shared with prepdocs to invalidate the caches
+    SEARCH_INDEX_VERSION_FILE = os.getenv("SEARCH_INDEX_VERSION_FILE")
+    # Tokens available for the text of the sources in the answer prompts, 0 sends the top documents whole
+    SOURCE_TOKEN_BUDGET = int(os.getenv("SOURCE_TOKEN_BUDGET") or 0)
+    # Seconds between checks of the prompts directory for edited prompts, 0 only loads them at startup
+    PROMPTS_RELOAD_INTERVAL = float(os.getenv("PROMPTS_RELOAD_INTERVAL") or 0)
+    # Seconds during which the tokens of a streamed answer are gathered into one write, 0 writes each token
+    STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL") or 0)
+    # Serves the hit ratios of the caches at /api/cache_stats
+    ENABLE_CACHE_STATS = os.getenv("ENABLE_CACHE_STATS", "").lower() == "true"
     
         
 
@@ -532,6 +709,15 @@ async def setup_clients():
     # Set the Azure credential in the app config for use in other parts of the app
     current_app.config[CONFIG_CREDENTIAL] = azure_credential
 
+    # Shared by all the helpers that make outbound HTTP calls, so warm connections are reused across requests
+    http_clients = HTTPClientRegistry(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_connections_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        dns_cache_ttl=HTTP_DNS_CACHE_TTL,
+    )
+    current_app.config[CONFIG_HTTP_CLIENTS] = http_clients
+
     # Set up clients for AI Search and Storage
     search_client = SearchClient(
         endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
@@ -558,8 +744,9 @@ async def setup_clients():
         
     # Set up authentication helper
     search_index = None
-    if AZURE_USE_AUTHENTICATION:
-        current_app.logger.info("AZURE_USE_AUTHENTICATION is true, setting up search index client")
+    # The fields of the index are also needed to know whether prepdocs stored the token counts for the context packer
+    if AZURE_USE_AUTHENTICATION or SOURCE_TOKEN_BUDGET > 0:
+        current_app.logger.info("AZURE_USE_AUTHENTICATION is true or SOURCE_TOKEN_BUDGET is set, reading search index")
         search_index_client = SearchIndexClient(
             endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
             credential=azure_credential,
@@ -576,8 +763,11 @@ async def setup_clients():
         require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
         enable_global_documents=AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS,
         enable_unauthenticated_access=AZURE_ENABLE_UNAUTHENTICATED_ACCESS,
+        http_session=http_clients.get_session(),
     )
 
+    index_version = IndexVersion(SEARCH_INDEX_VERSION_FILE)
+
     if USE_USER_UPLOAD:
         current_app.logger.info("USE_USER_UPLOAD is true, setting up user upload feature")
         if not AZURE_USERSTORAGE_ACCOUNT or not AZURE_USERSTORAGE_CONTAINER:
@@ -616,7 +806,10 @@ async def setup_clients():
             disable_vectors=os.getenv("USE_VECTORS", "").lower() == "false",
         )
         ingester = UploadUserFileStrategy(
-            search_info=search_info, embeddings=text_embeddings_service, file_processors=file_processors
+            search_info=search_info,
+            embeddings=text_embeddings_service,
+            file_processors=file_processors,
+            index_version=index_version,
         )
         current_app.config[CONFIG_INGESTER] = ingester
 
@@ -689,8 +882,56 @@ async def setup_clients():
     current_app.config[CONFIG_SPEECH_OUTPUT_AZURE_ENABLED] = USE_SPEECH_OUTPUT_AZURE
     current_app.config[CONFIG_CHAT_HISTORY_BROWSER_ENABLED] = USE_CHAT_HISTORY_BROWSER
     current_app.config[CONFIG_CHAT_HISTORY_COSMOS_ENABLED] = USE_CHAT_HISTORY_COSMOS
+    current_app.config[CONFIG_STREAM_FLUSH_INTERVAL] = STREAM_FLUSH_INTERVAL
+    current_app.config[CONFIG_CACHE_STATS_ENABLED] = ENABLE_CACHE_STATS
 
     prompt_manager = PromptyManager()
+    current_app.config[CONFIG_PROMPT_MANAGER] = prompt_manager
+    if PROMPTS_RELOAD_INTERVAL > 0:
+        current_app.logger.info("PROMPTS_RELOAD_INTERVAL is set, watching the prompts directory for changes")
+        current_app.config[CONFIG_PROMPT_RELOAD_TASK] = asyncio.create_task(
+            prompt_manager.watch(PROMPTS_RELOAD_INTERVAL)
+        )
+
+    embedding_cache: Optional[EmbeddingCache] = None
+    if USE_QUERY_EMBEDDING_CACHE:
+        current_app.logger.info("USE_QUERY_EMBEDDING_CACHE is true, setting up query embedding cache")
+        embedding_cache = EmbeddingCache(max_size=QUERY_EMBEDDING_CACHE_SIZE, path=QUERY_EMBEDDING_CACHE_FILE)
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+
+    answer_cache: Optional[AnswerCache] = None
+    if USE_ANSWER_CACHE:
+        current_app.logger.info("USE_ANSWER_CACHE is true, setting up answer cache")
+        answer_cache = AnswerCache(
+            max_size=ANSWER_CACHE_SIZE,
+            ttl=ANSWER_CACHE_TTL,
+            similarity_threshold=(
+                float(ANSWER_CACHE_SIMILARITY_THRESHOLD) if ANSWER_CACHE_SIMILARITY_THRESHOLD else None
+            ),
+            index_version=index_version,
+        )
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+
+    search_cache: Optional[SearchCache[Document]] = None
+    if USE_SEARCH_CACHE:
+        current_app.logger.info("USE_SEARCH_CACHE is true, setting up search cache")
+        search_cache = SearchCache(max_size=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL, index_version=index_version)
+    current_app.config[CONFIG_SEARCH_CACHE] = search_cache
+
+    keyword_classifier: Optional[KeywordClassifier] = None
+    if USE_LOCAL_KEYWORD_CLASSIFIER:
+        current_app.logger.info(
+            "USE_LOCAL_KEYWORD_CLASSIFIER is true, loading rules from %s", KEYWORD_CLASSIFIER_RULES_FILE
+        )
+        keyword_classifier = KeywordClassifier.from_file(KEYWORD_CLASSIFIER_RULES_FILE)
+
+    context_packer: Optional[ContextPacker] = None
+    has_token_count_field = False
+    if SOURCE_TOKEN_BUDGET > 0:
+        has_token_count_field = search_index is not None and any(
+            field.name == "token_count" for field in search_index.fields
+        )
+        context_packer = ContextPacker(SOURCE_TOKEN_BUDGET)
 
     # Set up the two default RAG approaches for /ask and /chat
     # RetrieveThenReadApproach is used by /ask for single-turn Q&A
@@ -708,6 +949,11 @@ async def setup_clients():
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
         prompt_manager=prompt_manager,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        answer_cache=answer_cache,
+        context_packer=context_packer,
+        has_token_count_field=has_token_count_field,
     )
 
     # ChatReadRetrieveReadApproach is used by /chat for multi-turn conversation
@@ -725,6 +971,16 @@ async def setup_clients():
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
         prompt_manager=prompt_manager,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        answer_cache=answer_cache,
+        context_packer=context_packer,
+        has_token_count_field=has_token_count_field,
+        speculative_query_embedding=USE_SPECULATIVE_QUERY_EMBEDDING,
+        keyword_classifier=keyword_classifier,
+        keyword_classifier_llm_fallback=USE_KEYWORD_CLASSIFIER_LLM_FALLBACK,
+        multi_query=USE_MULTI_QUERY_SEARCH,
+        sub_query_concurrency=MULTI_QUERY_CONCURRENCY,
     )
 
     if USE_GPT4V:
@@ -740,6 +996,7 @@ async def setup_clients():
             auth_helper=auth_helper,
             vision_endpoint=AZURE_VISION_ENDPOINT,
             vision_token_provider=token_provider,
+            http_session=http_clients.get_session(),
             gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
             gpt4v_model=AZURE_OPENAI_GPT4V_MODEL,
             embedding_model=OPENAI_EMB_MODEL,
@@ -750,6 +1007,8 @@ async def setup_clients():
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
             prompt_manager=prompt_manager,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
         )
 
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
@@ -759,6 +1018,7 @@ async def setup_clients():
             auth_helper=auth_helper,
             vision_endpoint=AZURE_VISION_ENDPOINT,
             vision_token_provider=token_provider,
+            http_session=http_clients.get_session(),
             chatgpt_model=OPENAI_CHATGPT_MODEL,
             chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
             gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
@@ -771,13 +1031,25 @@ async def setup_clients():
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
             prompt_manager=prompt_manager,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
+            keyword_classifier=keyword_classifier,
+            keyword_classifier_llm_fallback=USE_KEYWORD_CLASSIFIER_LLM_FALLBACK,
         )
 
 
 @bp.after_app_serving
 async def close_clients():
+    if current_app.config.get(CONFIG_PROMPT_RELOAD_TASK):
+        current_app.config[CONFIG_PROMPT_RELOAD_TASK].cancel()
     await current_app.config[CONFIG_SEARCH_CLIENT].close()
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
+    await current_app.config[CONFIG_HTTP_CLIENTS].close()
+    current_app.config[CONFIG_AUTH_CLIENT].close()
+    if current_app.config.get(CONFIG_EMBEDDING_CACHE):
+        current_app.config[CONFIG_EMBEDDING_CACHE].close()
+    if current_app.config.get(CONFIG_INGESTER) and current_app.config[CONFIG_INGESTER].embeddings:
+        await current_app.config[CONFIG_INGESTER].embeddings.close()
     if current_app.config.get(CONFIG_USER_BLOB_CONTAINER_CLIENT):
         await current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT].close()
         
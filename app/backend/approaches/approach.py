@@ -4,11 +4,13 @@ from dataclasses import dataclass
 from typing import (
     Any,
     AsyncGenerator,
+    AsyncIterator,
     Awaitable,
     Callable,
     List,
     Optional,
     TypedDict,
+    Union,
     cast,
 )
 from urllib.parse import urljoin
@@ -21,11 +23,25 @@ from azure.search.documents.models import (
     VectorizedQuery,
     VectorQuery,
 )
-from openai import AsyncOpenAI
-from openai.types.chat import ChatCompletionMessageParam
+from openai import AsyncOpenAI, AsyncStream
+from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionChunk,
+    ChatCompletionMessageParam,
+)
 
 from approaches.promptmanager import PromptManager
+from core.answercache import (
+    AnswerCache,
+    AnswerCacheHit,
+    CachedAnswer,
+    cached_chat_completion,
+    cached_chat_completion_chunk,
+)
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
+from core.httpclient import borrow_session
+from core.searchcache import SearchCache
 
 
 @dataclass
@@ -42,6 +58,8 @@ class Document:
     captions: List[QueryCaptionResult]
     score: Optional[float] = None
     reranker_score: Optional[float] = None
+    # Number of tokens in the content, stored in the index by prepdocs or counted when first packed into a prompt
+    token_count: Optional[int] = None
 
     def serialize_for_results(self) -> dict[str, Any]:
         return {
@@ -96,6 +114,9 @@ class Approach(ABC):
     # Useful for using local small language models, for example
     ALLOW_NON_GPT_MODELS = True
 
+    # Whether the index stores the token count of each section, computed by prepdocs when it was uploaded
+    has_token_count_field = False
+
     def __init__(
         self,
         search_client: SearchClient,
@@ -110,6 +131,10 @@ class Approach(ABC):
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
         prompt_manager: PromptManager,
+        http_session: Optional[aiohttp.ClientSession] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        search_cache: Optional[SearchCache["Document"]] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -123,6 +148,10 @@ class Approach(ABC):
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
         self.prompt_manager = prompt_manager
+        self.embedding_cache = embedding_cache
+        self.answer_cache = answer_cache
+        self.search_cache = search_cache
+        self.http_session = http_session
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
         include_category = overrides.get("include_category")
@@ -140,6 +169,15 @@ class Approach(ABC):
             filters.append(security_filter)
         return None if len(filters) == 0 else " and ".join(filters)
 
+    def get_search_select_fields(self) -> List[str]:
+        fields = ["id", "content", "category", "sourcepage", "sourcefile"]
+        # The access control fields only exist in the indexes that were created with them
+        if self.auth_helper is not None and self.auth_helper.has_auth_fields:
+            fields += ["oids", "groups"]
+        if self.has_token_count_field:
+            fields.append("token_count")
+        return fields
+
     async def search(
         self,
         top: int,
@@ -152,14 +190,73 @@ class Approach(ABC):
         use_semantic_captions: bool,
         minimum_search_score: Optional[float],
         minimum_reranker_score: Optional[float],
+        include_vectors: bool = False,
     ) -> List[Document]:
+        return [
+            document
+            async for document in self.search_stream(
+                top,
+                query_text,
+                filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                include_vectors,
+            )
+        ]
+
+    async def search_stream(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: List[VectorQuery],
+        use_text_search: bool,
+        use_vector_search: bool,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        minimum_search_score: Optional[float],
+        minimum_reranker_score: Optional[float],
+        include_vectors: bool = False,
+    ) -> AsyncGenerator[Document, None]:
+        """
+        Yields the documents that pass the score thresholds as soon as they are read from the search results,
+        so that callers can process them while the next pages are still being fetched.
+        The embeddings of the documents are only retrieved with include_vectors, as they are the bulk of the results.
+        """
         search_text = query_text if use_text_search else ""
         search_vectors = vectors if use_vector_search else []
+        search_cache_key: Optional[str] = None
+        if self.search_cache is not None:
+            search_cache_key = SearchCache.create_key(
+                search_text,
+                search_vectors,
+                filter,
+                top,
+                # The semantic query is the query text, even when the text search is disabled
+                semantic_query=query_text if use_semantic_ranker else None,
+                use_semantic_captions=use_semantic_captions,
+                minimum_search_score=minimum_search_score,
+                minimum_reranker_score=minimum_reranker_score,
+                include_vectors=include_vectors,
+            )
+            cached_documents = self.search_cache.get(search_cache_key, type(self).__name__)
+            if cached_documents is not None:
+                for cached_document in cached_documents:
+                    yield cached_document
+                return
+
+        select = None if include_vectors else self.get_search_select_fields()
         if use_semantic_ranker:
             results = await self.search_client.search(
                 search_text=search_text,
                 filter=filter,
                 top=top,
+                select=select,
                 query_caption="extractive|highlight-false" if use_semantic_captions else None,
                 vector_queries=search_vectors,
                 query_type=QueryType.SEMANTIC,
@@ -173,39 +270,53 @@ class Approach(ABC):
                 search_text=search_text,
                 filter=filter,
                 top=top,
+                select=select,
                 vector_queries=search_vectors,
             )
 
-        documents = []
+        qualified_documents: List[Document] = []
+        finished = False
         async for page in results.by_page():
             async for document in page:
-                documents.append(
-                    Document(
-                        id=document.get("id"),
-                        content=document.get("content"),
-                        embedding=document.get("embedding"),
-                        image_embedding=document.get("imageEmbedding"),
-                        category=document.get("category"),
-                        sourcepage=document.get("sourcepage"),
-                        sourcefile=document.get("sourcefile"),
-                        oids=document.get("oids"),
-                        groups=document.get("groups"),
-                        captions=cast(List[QueryCaptionResult], document.get("@search.captions")),
-                        score=document.get("@search.score"),
-                        reranker_score=document.get("@search.reranker_score"),
-                    )
+                score = document.get("@search.score")
+                reranker_score = document.get("@search.reranker_score")
+                # Results are sorted by the reranker score with the semantic ranker, and by the search score without,
+                # so once a result is below the threshold of that score, none of the remaining ones can pass it
+                sorting_score, minimum_sorting_score = (
+                    (reranker_score, minimum_reranker_score) if use_semantic_ranker else (score, minimum_search_score)
                 )
-
-            qualified_documents = [
-                doc
-                for doc in documents
-                if (
-                    (doc.score or 0) >= (minimum_search_score or 0)
-                    and (doc.reranker_score or 0) >= (minimum_reranker_score or 0)
+                if (sorting_score or 0) < (minimum_sorting_score or 0):
+                    finished = True
+                    break
+                if (score or 0) < (minimum_search_score or 0) or (reranker_score or 0) < (minimum_reranker_score or 0):
+                    continue
+                qualified_document = Document(
+                    id=document.get("id"),
+                    content=document.get("content"),
+                    embedding=document.get("embedding"),
+                    image_embedding=document.get("imageEmbedding"),
+                    category=document.get("category"),
+                    sourcepage=document.get("sourcepage"),
+                    sourcefile=document.get("sourcefile"),
+                    oids=document.get("oids"),
+                    groups=document.get("groups"),
+                    captions=cast(List[QueryCaptionResult], document.get("@search.captions")),
+                    score=score,
+                    reranker_score=reranker_score,
+                    token_count=document.get("token_count"),
                 )
-            ]
-
-        return qualified_documents
+                qualified_documents.append(qualified_document)
+                yield qualified_document
+                if len(qualified_documents) >= top:
+                    finished = True
+                    break
+            # The remaining pages are not fetched once enough documents were found or the scores fell too low
+            if finished:
+                break
+
+        # Only complete result lists are cached, not the ones of callers that stopped reading early
+        if self.search_cache is not None and search_cache_key is not None:
+            self.search_cache.set(search_cache_key, qualified_documents)
 
     def get_sources_content(
         self, results: List[Document], use_semantic_captions: bool, use_image_citation: bool
@@ -252,13 +363,21 @@ class Approach(ABC):
         dimensions_args: ExtraArgs = (
             {"dimensions": self.embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[self.embedding_model] else {}
         )
-        embedding = await self.openai_client.embeddings.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
-            **dimensions_args,
+        # Azure OpenAI takes the deployment name as the model name
+        model = self.embedding_deployment if self.embedding_deployment else self.embedding_model
+        dimensions = dimensions_args.get("dimensions")
+        query_vector = (
+            await self.embedding_cache.get(q, model, dimensions) if self.embedding_cache is not None else None
         )
-        query_vector = embedding.data[0].embedding
+        if query_vector is None:
+            embedding = await self.openai_client.embeddings.create(
+                model=model,
+                input=q,
+                **dimensions_args,
+            )
+            query_vector = embedding.data[0].embedding
+            if self.embedding_cache is not None:
+                await self.embedding_cache.set(q, model, dimensions, query_vector)
         return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields="embedding")
 
     async def compute_image_embedding(self, q: str):
@@ -269,7 +388,7 @@ class Approach(ABC):
 
         headers["Authorization"] = "Bearer " + await self.vision_token_provider()
 
-        async with aiohttp.ClientSession() as session:
+        async with borrow_session(self.http_session) as session:
             async with session.post(
                 url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
             ) as response:
@@ -286,6 +405,87 @@ class Approach(ABC):
         else:
             return {"override_prompt": override_prompt}
 
+    def get_answer_cache_scope(
+        self,
+        prompt: Any,
+        model: str,
+        overrides: dict[str, Any],
+        filter: Optional[str],
+        past_messages: Optional[list[ChatCompletionMessageParam]] = None,
+    ) -> str:
+        # Answers are only shared between requests that only differ by their query, and only for the same version
+        # of the prompts, so that editing the prompts does not keep serving the answers of the previous ones.
+        # Chat answers also depend on the conversation, so a follow-up question is only answered from the cache
+        # within the same conversation.
+        return AnswerCache.create_scope(
+            approach=type(self).__name__,
+            model=model,
+            prompt=prompt.content,
+            prompt_version=self.prompt_manager.version,
+            overrides=overrides,
+            filter=filter,
+            past_messages=past_messages or [],
+        )
+
+    @staticmethod
+    def get_query_vector(vectors: list[VectorQuery]) -> Optional[list[float]]:
+        for vector in vectors:
+            if isinstance(vector, VectorizedQuery) and vector.fields == "embedding":
+                return vector.vector
+        return None
+
+    def get_cached_answer_thought(self, cache_hit: AnswerCacheHit, query: str) -> ThoughtStep:
+        return ThoughtStep(
+            "Answer served from cache",
+            query,
+            {"match": cache_hit.match, "similarity": round(cache_hit.similarity, 4)},
+        )
+
+    async def replay_cached_answer(
+        self, content: str, model: str, should_stream: bool
+    ) -> Union[ChatCompletion, AsyncIterator[ChatCompletionChunk]]:
+        if should_stream:
+            return self.stream_cached_answer(content, model)
+        return cached_chat_completion(content, model)
+
+    async def stream_cached_answer(self, content: str, model: str) -> AsyncGenerator[ChatCompletionChunk, None]:
+        yield cached_chat_completion_chunk(content, model)
+
+    async def complete_with_answer_cache(
+        self,
+        scope: str,
+        query: str,
+        query_vector: Optional[list[float]],
+        data_points: dict[str, Any],
+        create_completion: Callable[[], Awaitable[Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]],
+    ) -> Union[ChatCompletion, AsyncIterator[ChatCompletionChunk]]:
+        # The completion is only created once this coroutine is awaited, so that dropping the coroutine
+        # without awaiting it does not leave an unawaited OpenAI call behind
+        completion = await create_completion()
+        if isinstance(completion, ChatCompletion):
+            content = completion.choices[0].message.content
+            if content and self.answer_cache is not None:
+                self.answer_cache.set(scope, query, query_vector, CachedAnswer(content, data_points))
+            return completion
+        return self.stream_with_answer_cache(scope, query, query_vector, data_points, completion)
+
+    async def stream_with_answer_cache(
+        self,
+        scope: str,
+        query: str,
+        query_vector: Optional[list[float]],
+        data_points: dict[str, Any],
+        stream: AsyncStream[ChatCompletionChunk],
+    ) -> AsyncGenerator[ChatCompletionChunk, None]:
+        content = ""
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                content += chunk.choices[0].delta.content
+            yield chunk
+        # Only complete answers are cached, not the ones of clients that disconnected in the middle
+        if content and self.answer_cache is not None:
+            self.answer_cache.set(scope, query, query_vector, CachedAnswer(content, data_points))
+
     async def run(
         self,
         messages: list[ChatCompletionMessageParam],
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import re
 from abc import ABC, abstractmethod
@@ -6,6 +7,7 @@ from typing import Any, AsyncGenerator, Optional
 from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
 
 from approaches.approach import Approach, ThoughtStep
+from approaches.keywordclassifier import KeywordClassifier, Verdict
 
 
 class ChatApproach(Approach, ABC):
@@ -16,11 +18,55 @@ class ChatApproach(Approach, ABC):
 
     PRE_GENERATED_RESPONSE = "I’m sorry, but I can’t provide an answer to that question."
 
+    # Classifies questions locally instead of asking the chat model whether they mention one of the KEYWORDS,
+    # which saves a model call per streamed answer
+    keyword_classifier: Optional[KeywordClassifier] = None
+    # Whether the questions that the local classifier finds ambiguous are then classified by the chat model
+    keyword_classifier_llm_fallback = False
+
+    # Set by the approaches, the chat model also classifies the questions
+    chatgpt_model: str
+    chatgpt_deployment: Optional[str]
+
+    @property
+    def query_rewrite_prompt(self):
+        # Looked up for each request, so that the prompts reloaded by the prompt manager are used right away
+        return self.prompt_manager.load_prompt("chat_query_rewrite.prompty")
+
+    @property
+    def query_rewrite_tools(self):
+        return self.prompt_manager.load_tools("chat_query_rewrite_tools.json")
 
     @abstractmethod
     async def run_until_final_call(self, messages, overrides, auth_claims, should_stream) -> tuple:
         pass
 
+    async def classify_user_input_from_keywords(self, user_question: str, keywords: list[str]) -> bool:
+        """
+        Asks the chat model whether the question mentions one of the keywords, or a synonym of them
+        """
+        prompt = (
+            "Determine if the following user question contains any of these keywords - case insensitive or synonym "
+            f"terms should also be matched: {', '.join(keywords)}.\n"
+            "Respond only with 'True' or 'False'.\n"
+            f"User question: {user_question}"
+        )
+        # The question is classified with the chat model, even by the approaches that send images to GPT-4V
+        response = await self.openai_client.chat.completions.create(
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You are a classification assistant that answers only with True or False.",
+                },
+                {"role": "user", "content": prompt},
+            ],
+            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+            temperature=0.0,
+            max_tokens=5,
+            n=1,
+        )
+        return (response.choices[0].message.content or "").strip() == "True"
+
     def get_search_query(self, chat_completion: ChatCompletion, user_query: str):
         response_message = chat_completion.choices[0].message
 
@@ -39,6 +85,36 @@ class ChatApproach(Approach, ABC):
                 return query_text
         return user_query
 
+    def get_sub_queries(self, chat_completion: ChatCompletion, search_query: str, max_sub_queries: int) -> list[str]:
+        # Sub-queries are only requested with the multi-query tools, for questions about several distinct topics
+        sub_queries: list[str] = []
+        for tool in chat_completion.choices[0].message.tool_calls or []:
+            if tool.type == "function" and tool.function.name == "search_sources":
+                arg = json.loads(tool.function.arguments)
+                sub_queries += [
+                    sub_query
+                    for sub_query in arg.get("sub_queries") or []
+                    if isinstance(sub_query, str) and sub_query.strip() and sub_query != self.NO_RESPONSE
+                ]
+        return [sub_query for sub_query in dict.fromkeys(sub_queries) if sub_query != search_query][:max_sub_queries]
+
+    async def classify_user_input(self, user_question: str) -> bool:
+        if self.keyword_classifier is None:
+            return await self.classify_user_input_from_keywords(user_question, self.KEYWORDS)
+        classification = self.keyword_classifier.classify(user_question)
+        if classification.verdict == Verdict.AMBIGUOUS and self.keyword_classifier_llm_fallback:
+            return await self.classify_user_input_from_keywords(user_question, self.keyword_classifier.keywords)
+        return classification.is_match
+
+    @staticmethod
+    def discard_final_call(final_call: asyncio.Task):
+        if not final_call.done():
+            final_call.cancel()
+        elif not final_call.cancelled() and final_call.exception() is None:
+            # Retrieval already finished, so only the answer generation that was never started needs to be dropped
+            _, chat_coroutine = final_call.result()
+            chat_coroutine.close()
+
     def extract_followup_questions(self, content: Optional[str]):
         if content is None:
             return content, []
@@ -74,9 +150,21 @@ class ChatApproach(Approach, ABC):
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> AsyncGenerator[dict, None]:
-        # Call the classify function before running the rest of the implementation.
+        # Classify the question while the search query is rewritten and the documents are retrieved,
+        # so the answer generation only waits for whichever of the two finishes last
         user_question = messages[-1]["content"]
-        if await self.classify_user_input_from_keywords(user_question, self.KEYWORDS):
+        if not isinstance(user_question, str):
+            raise ValueError("The most recent message content must be a string.")
+        final_call = asyncio.create_task(self.run_until_final_call(messages, overrides, auth_claims, should_stream=True))
+        try:
+            is_non_answerable = await self.classify_user_input(user_question)
+            if not is_non_answerable:
+                extra_info, chat_coroutine = await final_call
+        except BaseException:
+            self.discard_final_call(final_call)
+            raise
+        if is_non_answerable:
+            self.discard_final_call(final_call)
             extra_info = {
                 "data_points": {"text": ["Classified as a non-answerable question"]},
                 "thoughts": [
@@ -97,26 +185,18 @@ class ChatApproach(Approach, ABC):
             }
             return
 
-        extra_info, chat_coroutine = await self.run_until_final_call(
-            messages, overrides, auth_claims, should_stream=True
-        )
         yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
 
         followup_questions_started = False
         followup_content = ""
         async for event_chunk in await chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
-            if event["choices"]:
-                completion = {
-                    "delta": {
-                        "content": event["choices"][0]["delta"].get("content"),
-                        "role": event["choices"][0]["delta"]["role"],
-                    }
-                }
+            # The delta is read from the chunk directly, as converting every chunk to a dict costs more than the rest
+            if event_chunk.choices:
+                delta = event_chunk.choices[0].delta
+                completion = {"delta": {"content": delta.content, "role": delta.role}}
                 # if event contains << and not >>, it is start of follow-up question, truncate
-                content = completion["delta"].get("content")
-                content = content or ""  # content may either not exist in delta, or explicitly be None
+                content = delta.content or ""  # content may be None, such as in the chunk with the role
                 if overrides.get("suggest_followup_questions") and "<<" in content:
                     followup_questions_started = True
                     earlier_content = content[: content.index("<<")]
@@ -1,8 +1,22 @@
-from typing import Any, Coroutine, List, Literal, Optional, Union, overload
+import asyncio
+import functools
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Coroutine,
+    List,
+    Literal,
+    Optional,
+    Union,
+    overload,
+)
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorQuery
-from openai import AsyncOpenAI, AsyncStream
+from openai import AsyncOpenAI
 from openai.types.chat import (
     ChatCompletion,
     ChatCompletionChunk,
@@ -11,10 +25,16 @@ from openai.types.chat import (
 )
 from openai_messages_token_helper import build_messages, get_token_limit
 
-from approaches.approach import ThoughtStep
+from approaches.approach import Document, ThoughtStep
 from approaches.chatapproach import ChatApproach
+from approaches.contextpacker import ContextPacker
+from approaches.keywordclassifier import KeywordClassifier
 from approaches.promptmanager import PromptManager
+from approaches.reranker import get_reranker, reciprocal_rank_fusion
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
+from core.searchcache import SearchCache
 
 
 class ChatReadRetrieveReadApproach(ChatApproach):
@@ -24,6 +44,9 @@ class ChatReadRetrieveReadApproach(ChatApproach):
     original user question, and search results to OpenAI to generate a response.
     """
 
+    # Searches made for a compound question in multi-query mode, in addition to the search query
+    MAX_SUB_QUERIES = 3
+
     def __init__(
         self,
         *,
@@ -39,7 +62,17 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         content_field: str,
         query_language: str,
         query_speller: str,
-        prompt_manager: PromptManager
+        prompt_manager: PromptManager,
+        speculative_query_embedding: bool = False,
+        keyword_classifier: Optional[KeywordClassifier] = None,
+        keyword_classifier_llm_fallback: bool = False,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache[Document]] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        multi_query: bool = False,
+        sub_query_concurrency: int = 2,
+        context_packer: Optional[ContextPacker] = None,
+        has_token_count_field: bool = False,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -55,38 +88,64 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.query_speller = query_speller
         self.chatgpt_token_limit = get_token_limit(chatgpt_model, default_to_minimum=self.ALLOW_NON_GPT_MODELS)
         self.prompt_manager = prompt_manager
-        self.query_rewrite_prompt = self.prompt_manager.load_prompt("chat_query_rewrite.prompty")
-        self.query_rewrite_tools = self.prompt_manager.load_tools("chat_query_rewrite_tools.json")
-        self.answer_prompt = self.prompt_manager.load_prompt("chat_answer_question.prompty")
-    
-    async def classify_user_input_from_keywords(self, user_question: str, keywords: List[str]) -> bool:
-        # Build the prompt
-        keywords_str = ", ".join(keywords)
-        prompt = (
-            f"Determine if the following user question contains any of these keywords - case insenstive or synonym terms should also be matched: {keywords_str}.\n"
-            f"Respond only with 'True' or 'False'.\n"
-            f"User question: {user_question}"
-        )
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.answer_cache = answer_cache
+        self.context_packer = context_packer
+        self.has_token_count_field = has_token_count_field
+        # Embed the user's question while the search query is being rewritten, instead of after
+        self.speculative_query_embedding = speculative_query_embedding
+        self.keyword_classifier = keyword_classifier
+        self.keyword_classifier_llm_fallback = keyword_classifier_llm_fallback
+        # Lets the rewrite split compound questions into sub-queries that are searched concurrently
+        self.multi_query = multi_query
+        self.sub_query_concurrency = sub_query_concurrency
 
-        # Prepare the messages for the chat completion
-        messages = [
-            {"role": "system", "content": "You are a classification assistant that answers only with True or False."},
-            {"role": "user", "content": prompt},
-        ]
+    @property
+    def answer_prompt(self):
+        return self.prompt_manager.load_prompt("chat_answer_question.prompty")
 
-        # Call the OpenAI chat API with minimal output tokens
-        response = await self.openai_client.chat.completions.create(
-            messages=messages,
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,
-            max_tokens=5,
-            n=1,
-        )
+    @property
+    def query_rewrite_multi_tools(self):
+        return self.prompt_manager.load_tools("chat_query_rewrite_multi_tools.json")
+
+    async def search_sub_queries(
+        self,
+        search: Callable[..., Awaitable[list[Document]]],
+        top: int,
+        queries: list[str],
+        vectors: list[VectorQuery],
+        use_vector_search: bool,
+    ) -> tuple[list[Document], list[dict[str, Any]]]:
+        """
+        Searches the search query and its sub-queries concurrently, with at most sub_query_concurrency searches
+        in flight, and fuses their results with reciprocal rank fusion, which also removes the duplicates.
+        The vectors are the ones of the first query, the embeddings of the sub-queries are computed here.
+        Returns the fused results with the number of results and the duration of each search.
+        """
+        semaphore = asyncio.Semaphore(self.sub_query_concurrency)
 
-        # Extract and return the classification result
-        result = response.choices[0].message.content.strip()
-        return result == "True"
+        async def search_query(query: str, query_vectors: Optional[list[VectorQuery]]):
+            async with semaphore:
+                start = time.perf_counter()
+                if query_vectors is None:
+                    query_vectors = [await self.compute_text_embedding(query)] if use_vector_search else []
+                documents = await search(top=top, query_text=query, vectors=query_vectors)
+                duration = time.perf_counter() - start
+            return documents, {"query": query, "results": len(documents), "duration_ms": round(duration * 1000)}
 
+        searches = [
+            asyncio.create_task(search_query(query, vectors if index == 0 else None))
+            for index, query in enumerate(queries)
+        ]
+        try:
+            searched = await asyncio.gather(*searches)
+        except BaseException:
+            for search_task in searches:
+                search_task.cancel()
+            raise
+        results = reciprocal_rank_fusion([documents for documents, _ in searched])
+        return results[:top], [timing for _, timing in searched]
 
     @overload
     async def run_until_final_call(
@@ -104,7 +163,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[True],
-    ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]: ...
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncIterator[ChatCompletionChunk]]]: ...
 
     async def run_until_final_call(
         self,
@@ -112,7 +171,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
-    ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncIterator[ChatCompletionChunk]]]]:
         seed = overrides.get("seed", None)
         use_text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -121,6 +180,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
+        use_speculative_embedding = overrides.get("speculative_embedding", self.speculative_query_embedding)
+        use_multi_query = overrides.get("multi_query", self.multi_query)
         filter = self.build_filter(overrides, auth_claims)
 
         original_user_query = messages[-1]["content"]
@@ -130,10 +191,13 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         rendered_query_prompt = self.prompt_manager.render_prompt(
             self.query_rewrite_prompt, {"user_query": original_user_query, "past_messages": messages[:-1]}
         )
-        tools: List[ChatCompletionToolParam] = self.query_rewrite_tools
+        tools: List[ChatCompletionToolParam] = (
+            self.query_rewrite_multi_tools if use_multi_query else self.query_rewrite_tools
+        )
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        query_response_token_limit = 100
+        # The sub-queries need room in the tool call arguments too
+        query_response_token_limit = 200 if use_multi_query else 100
         query_messages = build_messages(
             model=self.chatgpt_model,
             system_prompt=rendered_query_prompt.system_content,
@@ -145,43 +209,119 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             fallback_to_default=self.ALLOW_NON_GPT_MODELS,
         )
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=query_messages,  # type: ignore
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=query_response_token_limit,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            tools=tools,
-            seed=seed,
-        )
+        # The rewrite often keeps the user's question as is (or gives up with NO_RESPONSE), so its embedding
+        # can be computed in parallel with the rewrite and is only thrown away if the query was actually changed
+        speculative_embedding: Optional[asyncio.Task[VectorQuery]] = None
+        if use_vector_search and use_speculative_embedding:
+            speculative_embedding = asyncio.create_task(self.compute_text_embedding(original_user_query))
+
+        try:
+            chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
+                messages=query_messages,  # type: ignore
+                # Azure OpenAI takes the deployment name as the model name
+                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                temperature=0.0,  # Minimize creativity for search query generation
+                max_tokens=query_response_token_limit,  # Setting too low risks malformed JSON, setting too high may affect performance
+                n=1,
+                tools=tools,
+                seed=seed,
+            )
+
+            query_text = self.get_search_query(chat_completion, original_user_query)
+            sub_queries = (
+                self.get_sub_queries(chat_completion, query_text, self.MAX_SUB_QUERIES) if use_multi_query else []
+            )
+
+            # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
-        query_text = self.get_search_query(chat_completion, original_user_query)
-
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if use_vector_search:
-            vectors.append(await self.compute_text_embedding(query_text))
-
-        results = await self.search(
-            top,
-            query_text,
-            filter,
-            vectors,
-            use_text_search,
-            use_vector_search,
-            use_semantic_ranker,
-            use_semantic_captions,
-            minimum_search_score,
-            minimum_reranker_score,
+            # If retrieval mode includes vectors, compute an embedding for the query
+            vectors: list[VectorQuery] = []
+            query_embedding_path = "sequential"
+            if use_vector_search:
+                if speculative_embedding is not None and query_text == original_user_query:
+                    vectors.append(await speculative_embedding)
+                    query_embedding_path = "speculative"
+                else:
+                    if speculative_embedding is not None:
+                        speculative_embedding.cancel()
+                        query_embedding_path = "recomputed"
+                    vectors.append(await self.compute_text_embedding(query_text))
+        finally:
+            if speculative_embedding is not None and not speculative_embedding.done():
+                speculative_embedding.cancel()
+
+        # The same version of the prompt is used for the whole request, even if the prompts are reloaded meanwhile
+        answer_prompt = self.answer_prompt
+
+        # Frequently asked questions are answered from the cache, without searching or generating the answer again
+        answer_cache_scope: Optional[str] = None
+        query_vector: Optional[list[float]] = None
+        if self.answer_cache is not None:
+            answer_cache_scope = self.get_answer_cache_scope(
+                answer_prompt, self.chatgpt_model, overrides, filter, past_messages=messages[:-1]
+            )
+            query_vector = self.get_query_vector(vectors)
+            cache_hit = await self.answer_cache.get(answer_cache_scope, query_text, query_vector)
+            if cache_hit is not None:
+                # Only the answer and its sources come from the cache, the thoughts describe this request
+                extra_info = {
+                    "data_points": cache_hit.answer.data_points,
+                    "thoughts": [
+                        ThoughtStep(
+                            "Prompt to generate search query",
+                            query_messages,
+                            (
+                                {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
+                                if self.chatgpt_deployment
+                                else {"model": self.chatgpt_model}
+                            ),
+                        ),
+                        self.get_cached_answer_thought(cache_hit, query_text),
+                    ],
+                }
+                return (
+                    extra_info,
+                    self.replay_cached_answer(cache_hit.answer.content, self.chatgpt_model, should_stream),
+                )
+
+        reranker = get_reranker(overrides)
+        search = functools.partial(
+            self.search,
+            filter=filter,
+            use_text_search=use_text_search,
+            use_vector_search=use_vector_search,
+            use_semantic_ranker=use_semantic_ranker,
+            use_semantic_captions=use_semantic_captions,
+            minimum_search_score=minimum_search_score,
+            minimum_reranker_score=minimum_reranker_score,
+            include_vectors=bool(overrides.get("include_vectors")) or (reranker is not None and reranker.uses_vectors),
         )
+        search_top = reranker.get_candidate_count(top) if reranker else top
+        sub_query_searches: list[dict[str, Any]] = []
+        if sub_queries:
+            results, sub_query_searches = await self.search_sub_queries(
+                search, search_top, [query_text, *sub_queries], vectors, use_vector_search
+            )
+        else:
+            results = await search(top=search_top, query_text=query_text, vectors=vectors)
+        if reranker is not None:
+            # The rerankers compare the documents in Python, which would delay the other requests on the event loop
+            results = await asyncio.to_thread(
+                reranker.rerank,
+                [query_text, *sub_queries, original_user_query],
+                results,
+                top,
+                self.get_query_vector(vectors),
+            )
+        sources_token_count: Optional[int] = None
+        if self.context_packer is not None:
+            results = self.context_packer.pack(results, use_semantic_captions)
+            sources_token_count = self.context_packer.get_sources_token_count(results, use_semantic_captions)
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
         text_sources = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
         rendered_answer_prompt = self.prompt_manager.render_prompt(
-            self.answer_prompt,
+            answer_prompt,
             self.get_system_prompt_variables(overrides.get("prompt_template"))
             | {
                 "include_follow_up_questions": bool(overrides.get("suggest_followup_questions")),
@@ -192,17 +332,31 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         )
 
         response_token_limit = 1024
-        messages = build_messages(
-            model=self.chatgpt_model,
-            system_prompt=rendered_answer_prompt.system_content,
-            past_messages=rendered_answer_prompt.past_messages,
-            new_user_content=rendered_answer_prompt.new_user_content,
-            max_tokens=self.chatgpt_token_limit - response_token_limit,
-            fallback_to_default=self.ALLOW_NON_GPT_MODELS,
-        )
+        if sources_token_count is None:
+            messages = build_messages(
+                model=self.chatgpt_model,
+                system_prompt=rendered_answer_prompt.system_content,
+                past_messages=rendered_answer_prompt.past_messages,
+                new_user_content=rendered_answer_prompt.new_user_content,
+                max_tokens=self.chatgpt_token_limit - response_token_limit,
+                fallback_to_default=self.ALLOW_NON_GPT_MODELS,
+            )
+        else:
+            # The sources were counted when they were packed, so only the question is counted with the history,
+            # and the sources are added to the question afterwards instead of being encoded again
+            messages = build_messages(
+                model=self.chatgpt_model,
+                system_prompt=rendered_answer_prompt.system_content,
+                past_messages=rendered_answer_prompt.past_messages,
+                new_user_content=original_user_query,
+                max_tokens=self.chatgpt_token_limit - response_token_limit - sources_token_count,
+                fallback_to_default=self.ALLOW_NON_GPT_MODELS,
+            )
+            messages[-1] = {"role": "user", "content": rendered_answer_prompt.new_user_content}
 
+        data_points: dict[str, Any] = {"text": text_sources}
         extra_info = {
-            "data_points": {"text": text_sources},
+            "data_points": data_points,
             "thoughts": [
                 ThoughtStep(
                     "Prompt to generate search query",
@@ -223,7 +377,11 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                         "filter": filter,
                         "use_vector_search": use_vector_search,
                         "use_text_search": use_text_search,
-                    },
+                    }
+                    | ({"reranker": overrides["reranker"]} if reranker is not None else {})
+                    | ({"sub_queries": sub_query_searches} if sub_query_searches else {})
+                    # Reports whether the embedding computed during the rewrite was used, to measure the saving
+                    | ({"query_embedding": query_embedding_path} if speculative_embedding is not None else {}),
                 ),
                 ThoughtStep(
                     "Search results",
@@ -241,7 +399,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             ],
         }
 
-        chat_coroutine = self.openai_client.chat.completions.create(
+        create_chat_completion = functools.partial(
+            self.openai_client.chat.completions.create,
             # Azure OpenAI takes the deployment name as the model name
             model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
             messages=messages,
@@ -251,4 +410,11 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             stream=should_stream,
             seed=seed,
         )
+        chat_coroutine: Coroutine[Any, Any, Union[ChatCompletion, AsyncIterator[ChatCompletionChunk]]]
+        if answer_cache_scope is None:
+            chat_coroutine = create_chat_completion()
+        else:
+            chat_coroutine = self.complete_with_answer_cache(
+                answer_cache_scope, query_text, query_vector, data_points, create_chat_completion
+            )
         return (extra_info, chat_coroutine)
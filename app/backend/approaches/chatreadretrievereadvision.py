@@ -1,5 +1,7 @@
+import asyncio
 from typing import Any, Awaitable, Callable, Coroutine, List, Optional, Union
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI, AsyncStream
@@ -11,11 +13,14 @@ from openai.types.chat import (
 )
 from openai_messages_token_helper import build_messages, get_token_limit
 
-from approaches.approach import ThoughtStep
+from approaches.approach import Document, ThoughtStep
 from approaches.chatapproach import ChatApproach
+from approaches.keywordclassifier import KeywordClassifier
 from approaches.promptmanager import PromptManager
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
 from core.imageshelper import fetch_image
+from core.searchcache import SearchCache
 
 
 class ChatReadRetrieveReadVisionApproach(ChatApproach):
@@ -46,6 +51,11 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
         prompt_manager: PromptManager,
+        http_session: Optional[aiohttp.ClientSession] = None,
+        keyword_classifier: Optional[KeywordClassifier] = None,
+        keyword_classifier_llm_fallback: bool = False,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache[Document]] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -66,9 +76,15 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.vision_token_provider = vision_token_provider
         self.chatgpt_token_limit = get_token_limit(gpt4v_model, default_to_minimum=self.ALLOW_NON_GPT_MODELS)
         self.prompt_manager = prompt_manager
-        self.query_rewrite_prompt = self.prompt_manager.load_prompt("chat_query_rewrite.prompty")
-        self.query_rewrite_tools = self.prompt_manager.load_tools("chat_query_rewrite_tools.json")
-        self.answer_prompt = self.prompt_manager.load_prompt("chat_answer_question_vision.prompty")
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.http_session = http_session
+        self.keyword_classifier = keyword_classifier
+        self.keyword_classifier_llm_fallback = keyword_classifier_llm_fallback
+
+    @property
+    def answer_prompt(self):
+        return self.prompt_manager.load_prompt("chat_answer_question_vision.prompty")
 
     async def run_until_final_call(
         self,
@@ -140,29 +156,37 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                 )
                 vectors.append(vector)
 
-        results = await self.search(
-            top,
-            query_text,
-            filter,
-            vectors,
-            use_text_search,
-            use_vector_search,
-            use_semantic_ranker,
-            use_semantic_captions,
-            minimum_search_score,
-            minimum_reranker_score,
-        )
+        # The images are downloaded while the next search results are read, instead of one after the other
+        results: list[Document] = []
+        image_downloads: list[asyncio.Task[Optional[str]]] = []
+        try:
+            async for result in self.search_stream(
+                top,
+                query_text,
+                filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                include_vectors=bool(overrides.get("include_vectors")),
+            ):
+                results.append(result)
+                if send_images_to_gptvision:
+                    image_downloads.append(asyncio.create_task(fetch_image(self.blob_container_client, result)))
+            image_urls = await asyncio.gather(*image_downloads)
+        except BaseException:
+            for image_download in image_downloads:
+                image_download.cancel()
+            raise
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
         text_sources = []
-        image_sources = []
         if send_text_to_gptvision:
             text_sources = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
-        if send_images_to_gptvision:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_sources.append(url)
+        image_sources = [url for url in image_urls if url]
 
         rendered_answer_prompt = self.prompt_manager.render_prompt(
             self.answer_prompt,
@@ -0,0 +1,126 @@
+import re
+from dataclasses import replace
+
+from approaches.approach import Document
+from prepdocslib.textsplitter import bpe
+
+# The sentence endings that the text splitter of prepdocs also breaks chunks on
+SENTENCE_ENDING = re.compile(r"[.!?](?=\s|$)|[。！？‼⁇⁈⁉]")
+
+
+class ContextPacker:
+    """
+    Chooses the text of the sources sent to the model, so that it fits in a budget of tokens.
+    The documents are taken in the order of the search, or of the reranker, and are kept whole while they fit.
+    A document that does not fit is trimmed at a sentence boundary, and the next ones are still tried
+    with the remaining budget.
+    Ingestion splits pages into chunks that overlap, so text that was already sent for the same page is dropped.
+    Tokens are counted with the encoding of the text splitter, which also wrote the counts stored in the index.
+    """
+
+    # Trimmed chunks with fewer tokens are left out, as a few words without their context do not help the answer
+    MIN_TRIMMED_TOKENS = 32
+    # Shortest text shared by two chunks of a page that is treated as an overlap rather than a coincidence
+    MIN_OVERLAP_LENGTH = 40
+
+    # Tokens of the citation and separators that precede the text of each source in the prompt
+    SOURCE_SEPARATOR_TOKENS = 2
+
+    def __init__(self, token_budget: int):
+        self.token_budget = token_budget
+        self.encoding = bpe
+
+    def count_tokens(self, text: str) -> int:
+        # Documents can contain the text of special tokens, which is only counted as text here
+        return len(self.encoding.encode_ordinary(text))
+
+    def get_token_count(self, document: Document) -> int:
+        # The count stored in the index is used when there is one.
+        # Otherwise documents are shared through the search cache, so the content of each chunk is only encoded once.
+        if document.token_count is None:
+            document.token_count = self.count_tokens(document.content or "")
+        return document.token_count
+
+    @classmethod
+    def remove_overlap(cls, text: str, packed_text: str) -> str:
+        """
+        Removes the start of text that is the end of packed_text, or the end of text that is the start of packed_text
+        """
+        if text in packed_text:
+            return ""
+        # The earliest match is the longest overlap
+        start = packed_text.find(text[: cls.MIN_OVERLAP_LENGTH])
+        while start != -1:
+            if text.startswith(packed_text[start:]):
+                return text[len(packed_text) - start :]
+            start = packed_text.find(text[: cls.MIN_OVERLAP_LENGTH], start + 1)
+        end = text.find(packed_text[: cls.MIN_OVERLAP_LENGTH])
+        while end != -1:
+            if packed_text.startswith(text[end:]):
+                return text[:end]
+            end = text.find(packed_text[: cls.MIN_OVERLAP_LENGTH], end + 1)
+        return text
+
+    def trim(self, text: str, token_budget: int) -> tuple[str, int]:
+        """
+        Returns the longest start of text that ends with a sentence and fits in token_budget, with its token count
+        """
+        end = 0
+        token_count = 0
+        for sentence_ending in SENTENCE_ENDING.finditer(text):
+            sentence_token_count = self.count_tokens(text[end : sentence_ending.end()])
+            if token_count + sentence_token_count > token_budget:
+                break
+            end = sentence_ending.end()
+            token_count += sentence_token_count
+        return text[:end], token_count
+
+    def pack(self, documents: list[Document], use_semantic_captions: bool) -> list[Document]:
+        packed: list[Document] = []
+        packed_texts: dict[str, list[str]] = {}
+        remaining = self.token_budget
+        for document in documents:
+            if remaining < self.MIN_TRIMMED_TOKENS:
+                break
+            if use_semantic_captions:
+                # Captions are short extracts, so they are either sent whole or not at all
+                captions = " . ".join(caption.text or "" for caption in document.captions or [])
+                token_count = self.count_tokens(captions)
+                if token_count <= remaining:
+                    packed.append(document)
+                    remaining -= token_count
+                continue
+
+            content = document.content or ""
+            token_count = self.get_token_count(document)
+            text = content
+            page_texts = packed_texts.setdefault(document.sourcepage or "", [])
+            for page_text in page_texts:
+                text = self.remove_overlap(text, page_text)
+            if not text.strip():
+                continue
+            if text != content:
+                token_count = self.count_tokens(text)
+            if token_count > remaining:
+                text, token_count = self.trim(text, remaining)
+                if token_count < self.MIN_TRIMMED_TOKENS:
+                    continue
+
+            page_texts.append(text)
+            packed.append(document if text == content else replace(document, content=text, token_count=token_count))
+            remaining -= token_count
+        return packed
+
+    def get_sources_token_count(self, documents: list[Document], use_semantic_captions: bool) -> int:
+        """
+        Returns the token count of the sources made from packed documents, from the counts kept by pack,
+        so that the prompt can be budgeted without encoding the sources again
+        """
+        token_count = 0
+        for document in documents:
+            if use_semantic_captions:
+                token_count += self.count_tokens(" . ".join(caption.text or "" for caption in document.captions or []))
+            else:
+                token_count += self.get_token_count(document)
+            token_count += self.count_tokens(document.sourcepage or "") + self.SOURCE_SEPARATOR_TOKENS
+        return token_count
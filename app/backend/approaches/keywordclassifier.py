@@ -0,0 +1,126 @@
+import json
+import re
+import unicodedata
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import Optional, Union
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def normalize_tokens(text: str) -> list[str]:
+    """
+    Splits the text into lowercase words, with accents removed so that "Fútbol" and "futbol" are the same word
+    """
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return TOKEN_PATTERN.findall(stripped)
+
+
+class Verdict(str, Enum):
+    MATCH = "match"
+    NO_MATCH = "no_match"
+    # Only terms that are not conclusive on their own were found, such as "match" or "league"
+    AMBIGUOUS = "ambiguous"
+
+
+@dataclass
+class KeywordClassification:
+    verdict: Verdict
+    # The canonical keywords that were found, or the ambiguous terms if the verdict is AMBIGUOUS
+    matches: list[str] = field(default_factory=list)
+
+    @property
+    def is_match(self) -> bool:
+        return self.verdict == Verdict.MATCH
+
+
+@dataclass
+class Pattern:
+    label: str
+    ambiguous: bool
+
+
+class KeywordClassifier:
+    """
+    Local replacement for asking the chat model whether a question mentions one of a list of keywords.
+    Each keyword can have synonyms, which may be several words long ("tee time"), and there can be ambiguous terms
+    that only suggest a keyword. All of them are compiled into a single Aho-Corasick automaton over normalized words,
+    so a question is classified in one pass over its words, whatever the number of patterns.
+    """
+
+    DEFAULT_RULES_FILE = Path(__file__).parent / "keyword_rules.json"
+
+    def __init__(self, keywords: dict[str, list[str]], ambiguous_terms: Optional[list[str]] = None):
+        self.keywords = list(keywords)
+        # Each node of the trie is the index of its transitions, failure link and the patterns that end there
+        self.transitions: list[dict[str, int]] = [{}]
+        self.failure: list[int] = [0]
+        self.outputs: list[list[Pattern]] = [[]]
+        for keyword, synonyms in keywords.items():
+            for term in [keyword, *synonyms]:
+                self.add_pattern(term, Pattern(label=keyword, ambiguous=False))
+        for term in ambiguous_terms or []:
+            self.add_pattern(term, Pattern(label=term, ambiguous=True))
+        self.build_failure_links()
+
+    @classmethod
+    def from_file(cls, path: Union[str, Path]) -> "KeywordClassifier":
+        """
+        Loads the rules from a JSON file of the form
+        {"keywords": {"golf": ["golfer", "tee time"]}, "ambiguous": ["tournament"]}
+        """
+        with open(path, encoding="utf-8") as f:
+            rules = json.load(f)
+        return cls(keywords=rules["keywords"], ambiguous_terms=rules.get("ambiguous", []))
+
+    def add_pattern(self, term: str, pattern: Pattern):
+        tokens = normalize_tokens(term)
+        if not tokens:
+            raise ValueError(f"The keyword classifier term '{term}' does not contain any word")
+        node = 0
+        for token in tokens:
+            next_node = self.transitions[node].get(token)
+            if next_node is None:
+                next_node = len(self.transitions)
+                self.transitions.append({})
+                self.failure.append(0)
+                self.outputs.append([])
+                self.transitions[node][token] = next_node
+            node = next_node
+        self.outputs[node].append(pattern)
+
+    def build_failure_links(self):
+        queue = deque(self.transitions[0].values())
+        while queue:
+            node = queue.popleft()
+            for token, child in self.transitions[node].items():
+                queue.append(child)
+                fallback = self.failure[node]
+                while fallback and token not in self.transitions[fallback]:
+                    fallback = self.failure[fallback]
+                self.failure[child] = self.transitions[fallback].get(token, 0)
+                # A pattern that ends at the longest suffix also ends here
+                self.outputs[child] = self.outputs[child] + self.outputs[self.failure[child]]
+
+    def find_patterns(self, text: str) -> list[Pattern]:
+        found: list[Pattern] = []
+        node = 0
+        for token in normalize_tokens(text):
+            while node and token not in self.transitions[node]:
+                node = self.failure[node]
+            node = self.transitions[node].get(token, 0)
+            found.extend(self.outputs[node])
+        return found
+
+    def classify(self, text: str) -> KeywordClassification:
+        found = self.find_patterns(text)
+        keywords = list(dict.fromkeys(pattern.label for pattern in found if not pattern.ambiguous))
+        if keywords:
+            return KeywordClassification(Verdict.MATCH, keywords)
+        ambiguous_terms = list(dict.fromkeys(pattern.label for pattern in found))
+        if ambiguous_terms:
+            return KeywordClassification(Verdict.AMBIGUOUS, ambiguous_terms)
+        return KeywordClassification(Verdict.NO_MATCH)
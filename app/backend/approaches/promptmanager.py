@@ -1,9 +1,21 @@
+import asyncio
+import hashlib
 import json
+import logging
 import pathlib
+import re
 from dataclasses import dataclass
+from typing import Any, Optional
 
+import jinja2
 import prompty
 from openai.types.chat import ChatCompletionMessageParam
+from prompty.core import param_hoisting
+from prompty.invoker import InvokerFactory
+
+from core.cache import LRUCache
+
+logger = logging.getLogger("scripts")
 
 
 @dataclass
@@ -15,8 +27,29 @@ class RenderedPrompt:
     new_user_content: str
 
 
+@dataclass
+class StaticPrompt:
+    # The rendered text of the system message and the examples, which only depends on the prompt variant
+    text: str
+    system_content: str
+    few_shot_messages: list[ChatCompletionMessageParam]
+
+
+@dataclass(frozen=True)
+class PromptSet:
+    # The prompts and tools of the prompts directory as they were read together, replaced as a whole on reload
+    version: str
+    prompts: dict[str, Any]
+    tools: dict[str, Any]
+    modified_times: dict[str, int]
+
+
 class PromptManager:
 
+    @property
+    def version(self) -> str:
+        raise NotImplementedError
+
     def load_prompt(self, path: str):
         raise NotImplementedError
 
@@ -31,46 +64,200 @@ class PromptyManager(PromptManager):
 
     PROMPTS_DIRECTORY = pathlib.Path(__file__).parent / "prompts"
 
+    # The variables that change with every request, while the others select a variant of the system prompt
+    REQUEST_VARIABLES = ("past_messages", "user_query", "text_sources", "image_sources")
+    # The separator between messages of the prompty chat parser
+    ROLE_SEPARATOR = re.compile(r"(?i)^\s*#?\s*(assistant|function|system|user)\s*:\s*\n", re.MULTILINE)
+
+    PROMPT_SUFFIX = ".prompty"
+    TOOLS_SUFFIX = ".json"
+
+    def __init__(self, static_prompt_cache_size: int = 100):
+        self.templates: dict[tuple[str, str], jinja2.Template] = {}
+        # Bounded, as the prompt_template override lets every request choose its own system prompt
+        self.static_prompts: LRUCache[tuple[str, str, str], StaticPrompt] = LRUCache(max_size=static_prompt_cache_size)
+        self.prompt_set = self.read_prompt_set()
+        self.reloads = 0
+
+    @property
+    def version(self) -> str:
+        # Identifies the content of the prompt files, so it is the same in every worker that loaded the same files
+        return self.prompt_set.version
+
+    def get_modified_times(self) -> dict[str, int]:
+        return {
+            path.name: path.stat().st_mtime_ns
+            for path in sorted(self.PROMPTS_DIRECTORY.iterdir())
+            if path.suffix in (self.PROMPT_SUFFIX, self.TOOLS_SUFFIX)
+        }
+
+    def read_prompt_set(self) -> PromptSet:
+        modified_times = self.get_modified_times()
+        prompts = {}
+        tools = {}
+        version = hashlib.sha256()
+        for name in modified_times:
+            path = self.PROMPTS_DIRECTORY / name
+            with open(path, "rb") as file:
+                content = file.read()
+            version.update(name.encode() + b"\0" + content + b"\0")
+            if path.suffix == self.PROMPT_SUFFIX:
+                prompts[name] = prompty.load(path)
+            else:
+                tools[name] = json.loads(content)
+        return PromptSet(version=version.hexdigest()[:12], prompts=prompts, tools=tools, modified_times=modified_times)
+
     def load_prompt(self, path: str):
-        return prompty.load(self.PROMPTS_DIRECTORY / path)
+        prompt = self.prompt_set.prompts.get(path)
+        if prompt is None:
+            raise ValueError(f"Prompt {path} not found in {self.PROMPTS_DIRECTORY}")
+        return prompt
 
     def load_tools(self, path: str):
-        return json.loads(open(self.PROMPTS_DIRECTORY / path).read())
+        tools = self.prompt_set.tools.get(path)
+        if tools is None:
+            raise ValueError(f"Tools {path} not found in {self.PROMPTS_DIRECTORY}")
+        return tools
+
+    def reload(self) -> bool:
+        """
+        Reads the prompt files again and makes them the active version, returning whether their content changed.
+        Requests keep the prompts that they already looked up, and the previous version stays active
+        if one of the files cannot be loaded, such as while it is being edited.
+        """
+        try:
+            prompt_set = self.read_prompt_set()
+        except Exception:
+            logger.exception("Could not reload the prompts, keeping version %s", self.version)
+            return False
+        previous_version = self.version
+        self.prompt_set = prompt_set
+        if prompt_set.version == previous_version:
+            return False
+        # The templates of the previous version are not rendered anymore
+        self.templates = {}
+        self.reloads += 1
+        logger.info("Reloaded the prompts, version %s replaces %s", prompt_set.version, previous_version)
+        return True
+
+    async def watch(self, interval: float):
+        """
+        Reloads the prompts when a file of the prompts directory is added, removed or modified
+        """
+        checked_modified_times = self.prompt_set.modified_times
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                modified_times = self.get_modified_times()
+            except OSError:
+                # A file was removed while the directory was listed
+                continue
+            if modified_times != checked_modified_times:
+                checked_modified_times = modified_times
+                self.reload()
+
+    def get_template(self, prompt) -> jinja2.Template:
+        """
+        Returns the compiled Jinja template of the prompt.
+        prompty.prepare creates a new Jinja environment and compiles the template again for every request.
+        """
+        key = (str(prompt.file), prompt.content)
+        template = self.templates.get(key)
+        if template is None:
+            templates = {}
+            current_prompt = prompt
+            while current_prompt:
+                if isinstance(current_prompt.content, str):
+                    templates[pathlib.Path(current_prompt.file).name] = current_prompt.content
+                current_prompt = current_prompt.basePrompty
+            environment = jinja2.Environment(loader=jinja2.DictLoader(templates))
+            template = environment.get_template(pathlib.Path(prompt.file).name)
+            self.templates[key] = template
+        return template
+
+    def parse_messages(self, prompt, text: str) -> list:
+        return InvokerFactory.run_parser(prompt, text)
+
+    def get_static_prompt(self, prompt, rendered: str, all_messages: list) -> Optional[StaticPrompt]:
+        """
+        Finds the rendered text of the system message and of the examples that follow it, if it parses on its own
+        into the same messages, so that it can be reused by the requests that render the same variant of the prompt
+        """
+        static_message_count = 1
+        while static_message_count + 2 < len(all_messages):
+            content = all_messages[static_message_count]["content"]
+            if not (isinstance(content, str) and content.startswith("(EXAMPLE)")):
+                break
+            static_message_count += 2
+        separators = list(self.ROLE_SEPARATOR.finditer(rendered))
+        if len(separators) <= static_message_count:
+            return None
+        text = rendered[: separators[static_message_count].start()]
+        if self.parse_messages(prompt, text) != all_messages[:static_message_count]:
+            return None
+        few_shot_messages, _ = self.split_examples([message.copy() for message in all_messages[1:static_message_count]])
+        return StaticPrompt(text=text, system_content=all_messages[0]["content"], few_shot_messages=few_shot_messages)
+
+    @staticmethod
+    def split_examples(messages: list) -> tuple[list, list]:
+        few_shot_messages = []
+        past_messages = []
+        for user_message, assistant_message in zip(messages[0::2], messages[1::2]):
+            if user_message["content"].startswith("(EXAMPLE)"):
+                user_message["content"] = user_message["content"][9:].lstrip()
+                few_shot_messages.extend([user_message, assistant_message])
+            else:
+                past_messages.extend([user_message, assistant_message])
+        return few_shot_messages, past_messages
 
     def render_prompt(self, prompt, data) -> RenderedPrompt:
         # Assumes that the first message is the system message, the last message is the user message,
         # and the messages in-between are either examples or past messages.
 
-        all_messages: list = prompty.prepare(prompt, data)
-        remaining_messages = all_messages.copy()
+        inputs: dict[str, Any] = param_hoisting(data, prompt.sample)
+        rendered = self.get_template(prompt).render(**inputs)
+        static_variables = {name: value for name, value in inputs.items() if name not in self.REQUEST_VARIABLES}
+        static_key = (str(prompt.file), prompt.content, json.dumps(static_variables, sort_keys=True, default=str))
+
+        # Only the messages that come after the system message and the examples are parsed again
+        static_prompt = self.static_prompts.get(static_key)
+        few_shot_messages: list = []
+        if static_prompt is not None and rendered.startswith(static_prompt.text):
+            request_messages: list = self.parse_messages(prompt, rendered[len(static_prompt.text) :])
+            few_shot_messages = [message.copy() for message in static_prompt.few_shot_messages]
+            all_messages: list = [
+                {"role": "system", "content": static_prompt.system_content},
+                *few_shot_messages,
+                *request_messages,
+            ]
+        else:
+            all_messages = self.parse_messages(prompt, rendered)
+            request_messages = all_messages[1:]
+            static_prompt = None
 
         system_content = None
         if all_messages[0]["role"] == "system":
             system_content = all_messages[0]["content"]
-            remaining_messages.pop(0)
         else:
             raise ValueError("The first message in the prompt must be a system message.")
 
         new_user_content = None
         if all_messages[-1]["role"] == "user":
             new_user_content = all_messages[-1]["content"]
-            remaining_messages.pop(-1)
         else:
             raise ValueError("The last message in the prompt must be a user message.")
 
-        few_shot_messages = []
-        past_messages = []
-        for user_message, assistant_message in zip(remaining_messages[0::2], remaining_messages[1::2]):
-            if user_message["content"].startswith("(EXAMPLE)"):
-                user_message["content"] = user_message["content"][9:].lstrip()
-                few_shot_messages.extend([user_message, assistant_message])
-            else:
-                past_messages.extend([user_message, assistant_message])
+        if static_prompt is None:
+            static_prompt = self.get_static_prompt(prompt, rendered, all_messages)
+            if static_prompt is not None:
+                self.static_prompts.set(static_key, static_prompt)
+
+        request_few_shot_messages, past_messages = self.split_examples(request_messages[:-1])
 
         return RenderedPrompt(
             all_messages=all_messages,
             system_content=system_content,
-            few_shot_messages=few_shot_messages,
+            few_shot_messages=few_shot_messages + request_few_shot_messages,
             past_messages=past_messages,
             new_user_content=new_user_content,
         )
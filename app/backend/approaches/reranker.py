@@ -0,0 +1,181 @@
+import logging
+import math
+from abc import ABC, abstractmethod
+from array import array
+from collections import Counter
+from operator import mul
+from typing import Any, Optional
+
+from approaches.approach import Document
+from approaches.keywordclassifier import normalize_tokens
+
+
+def get_document_text(document: Document) -> str:
+    # The captions are the most relevant parts of the document when the semantic ranker extracted them
+    if document.captions:
+        return " ".join(caption.text or "" for caption in document.captions)
+    return document.content or ""
+
+
+def reciprocal_rank_fusion(rankings: list[list[Document]], k: int = 60) -> list[Document]:
+    """
+    Merges several rankings of documents into one, where documents found near the top of many rankings come first.
+    Documents are identified by their id, so the same document found by different searches is counted once.
+    """
+    scores: dict[str, float] = {}
+    documents: dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking):
+            key = document.id or str(id(document))
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank + 1)
+            documents.setdefault(key, document)
+    return [documents[key] for key in sorted(scores, key=lambda key: scores[key], reverse=True)]
+
+
+class Reranker(ABC):
+    """
+    Reorders the documents found by the search before the top ones are sent to the model,
+    as a local and cheaper alternative to the semantic ranker of Azure AI Search.
+    """
+
+    # How many more documents than top are retrieved, to give the reranker some candidates to choose from
+    CANDIDATES_FACTOR = 3
+    # Whether the embeddings of the documents need to be retrieved
+    uses_vectors = False
+
+    def get_candidate_count(self, top: int) -> int:
+        # Azure AI Search only reranks 50 results with the semantic ranker, which is a good bound here too
+        return max(top, min(top * self.CANDIDATES_FACTOR, 50))
+
+    @abstractmethod
+    def rerank(
+        self, queries: list[str], documents: list[Document], top: int, query_vector: Optional[list[float]] = None
+    ) -> list[Document]:
+        pass
+
+
+class BM25Reranker(Reranker):
+    """
+    Scores the text of each document against the queries with BM25, using the candidates as the corpus
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+
+    def get_scores(self, query: str, documents: list[Document]) -> list[float]:
+        documents_tokens = [Counter(normalize_tokens(get_document_text(document))) for document in documents]
+        if not documents_tokens:
+            return []
+        average_length = sum(sum(tokens.values()) for tokens in documents_tokens) / len(documents_tokens) or 1
+        scores = [0.0] * len(documents)
+        for term in set(normalize_tokens(query)):
+            frequency = sum(1 for tokens in documents_tokens if term in tokens)
+            if not frequency:
+                continue
+            idf = math.log((len(documents) - frequency + 0.5) / (frequency + 0.5) + 1)
+            for index, tokens in enumerate(documents_tokens):
+                term_count = tokens[term]
+                if term_count:
+                    length_norm = 1 - self.b + self.b * sum(tokens.values()) / average_length
+                    scores[index] += idf * term_count * (self.k1 + 1) / (term_count + self.k1 * length_norm)
+        return scores
+
+    def rerank(
+        self, queries: list[str], documents: list[Document], top: int, query_vector: Optional[list[float]] = None
+    ) -> list[Document]:
+        scores = [0.0] * len(documents)
+        for query in queries:
+            for index, score in enumerate(self.get_scores(query, documents)):
+                scores[index] += score
+        # The sort is stable, so documents with the same score keep the order of the search
+        ranked = sorted(range(len(documents)), key=lambda index: scores[index], reverse=True)
+        return [documents[index] for index in ranked[:top]]
+
+
+class MMRReranker(Reranker):
+    """
+    Maximal marginal relevance: picks documents that are relevant to the query but not similar to the ones
+    already picked, so that the sources are not several chunks that say the same thing.
+    """
+
+    uses_vectors = True
+
+    def __init__(self, diversity: float = 0.3):
+        # 0 only considers relevance, 1 only diversity
+        self.diversity = diversity
+
+    @staticmethod
+    def normalize(vector: Optional[list[float]]) -> Optional[array]:
+        if not vector:
+            return None
+        norm = math.sqrt(sum(value * value for value in vector))
+        return array("f", (value / norm for value in vector)) if norm else None
+
+    @staticmethod
+    def similarity(first: Optional[array], second: Optional[array]) -> float:
+        if first is None or second is None:
+            return 0.0
+        return sum(map(mul, first, second))
+
+    def rerank(
+        self, queries: list[str], documents: list[Document], top: int, query_vector: Optional[list[float]] = None
+    ) -> list[Document]:
+        vectors = [self.normalize(document.embedding) for document in documents]
+        normalized_query_vector = self.normalize(query_vector)
+        if normalized_query_vector is not None:
+            relevance = [self.similarity(normalized_query_vector, vector) for vector in vectors]
+        else:
+            # Without the query embedding, the order of the search is the relevance
+            relevance = [1 - index / len(documents) for index in range(len(documents))]
+
+        selected: list[int] = []
+        # Highest similarity of each candidate to the documents selected so far, which is only compared
+        # to the document selected last, so that each pair of documents is compared at most once
+        redundancy = [-math.inf] * len(documents)
+        remaining = list(range(len(documents)))
+        while remaining and len(selected) < top:
+            best = max(
+                remaining,
+                key=lambda index: (1 - self.diversity) * relevance[index]
+                - self.diversity * (redundancy[index] if selected else 0.0),
+            )
+            selected.append(best)
+            remaining.remove(best)
+            if len(selected) < top:
+                for index in remaining:
+                    redundancy[index] = max(redundancy[index], self.similarity(vectors[index], vectors[best]))
+        return [documents[index] for index in selected]
+
+
+class RRFReranker(Reranker):
+    """
+    Fuses the order of the search with the BM25 rankings of each query variant, such as the question of the user
+    and the search query that was generated from it
+    """
+
+    def __init__(self, k: int = 60):
+        self.k = k
+        self.bm25 = BM25Reranker()
+
+    def rerank(
+        self, queries: list[str], documents: list[Document], top: int, query_vector: Optional[list[float]] = None
+    ) -> list[Document]:
+        rankings = [documents]
+        for query in dict.fromkeys(queries):
+            rankings.append(self.bm25.rerank([query], documents, len(documents)))
+        return reciprocal_rank_fusion(rankings, self.k)[:top]
+
+
+RERANKERS: dict[str, Reranker] = {"bm25": BM25Reranker(), "mmr": MMRReranker(), "rrf": RRFReranker()}
+
+
+def get_reranker(overrides: dict[str, Any]) -> Optional[Reranker]:
+    name = overrides.get("reranker")
+    if not name:
+        return None
+    if name not in RERANKERS:
+        # Like the other overrides, an unknown value is left out instead of failing the request
+        logging.warning("Unknown reranker '%s', expected one of %s, not reranking", name, ", ".join(RERANKERS))
+        return None
+    return RERANKERS[name]
@@ -1,3 +1,4 @@
+import asyncio
 from typing import Any, Optional
 
 from azure.search.documents.aio import SearchClient
@@ -6,9 +7,14 @@ from openai import AsyncOpenAI
 from openai.types.chat import ChatCompletionMessageParam
 from openai_messages_token_helper import get_token_limit
 
-from approaches.approach import Approach, ThoughtStep
+from approaches.approach import Approach, Document, ThoughtStep
+from approaches.contextpacker import ContextPacker
 from approaches.promptmanager import PromptManager
+from approaches.reranker import get_reranker
+from core.answercache import AnswerCache, CachedAnswer
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
+from core.searchcache import SearchCache
 
 
 class RetrieveThenReadApproach(Approach):
@@ -34,6 +40,11 @@ class RetrieveThenReadApproach(Approach):
         query_language: str,
         query_speller: str,
         prompt_manager: PromptManager,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache[Document]] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        context_packer: Optional[ContextPacker] = None,
+        has_token_count_field: bool = False,
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
@@ -50,7 +61,16 @@ class RetrieveThenReadApproach(Approach):
         self.query_speller = query_speller
         self.chatgpt_token_limit = get_token_limit(chatgpt_model, self.ALLOW_NON_GPT_MODELS)
         self.prompt_manager = prompt_manager
-        self.answer_prompt = self.prompt_manager.load_prompt("ask_answer_question.prompty")
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.answer_cache = answer_cache
+        self.context_packer = context_packer
+        self.has_token_count_field = has_token_count_field
+
+    @property
+    def answer_prompt(self):
+        # Looked up for each request, so that the prompts reloaded by the prompt manager are used right away
+        return self.prompt_manager.load_prompt("ask_answer_question.prompty")
 
     async def run(
         self,
@@ -78,8 +98,31 @@ class RetrieveThenReadApproach(Approach):
         if use_vector_search:
             vectors.append(await self.compute_text_embedding(q))
 
+        # The same version of the prompt is used for the whole request, even if the prompts are reloaded meanwhile
+        answer_prompt = self.answer_prompt
+
+        # Frequently asked questions are answered from the cache, without searching or generating the answer again
+        answer_cache_scope: Optional[str] = None
+        query_vector: Optional[list[float]] = None
+        if self.answer_cache is not None:
+            answer_cache_scope = self.get_answer_cache_scope(answer_prompt, self.chatgpt_model, overrides, filter)
+            query_vector = self.get_query_vector(vectors)
+            cache_hit = await self.answer_cache.get(answer_cache_scope, q, query_vector)
+            if cache_hit is not None:
+                # Only the answer and its sources come from the cache, the thoughts describe this request
+                extra_info = {
+                    "data_points": cache_hit.answer.data_points,
+                    "thoughts": [self.get_cached_answer_thought(cache_hit, q)],
+                }
+                return {
+                    "message": {"content": cache_hit.answer.content, "role": "assistant"},
+                    "context": extra_info,
+                    "session_state": session_state,
+                }
+
+        reranker = get_reranker(overrides)
         results = await self.search(
-            top,
+            reranker.get_candidate_count(top) if reranker else top,
             q,
             filter,
             vectors,
@@ -89,12 +132,18 @@ class RetrieveThenReadApproach(Approach):
             use_semantic_captions,
             minimum_search_score,
             minimum_reranker_score,
+            include_vectors=bool(overrides.get("include_vectors")) or (reranker is not None and reranker.uses_vectors),
         )
+        if reranker is not None:
+            # The rerankers compare the documents in Python, which would delay the other requests on the event loop
+            results = await asyncio.to_thread(reranker.rerank, [q], results, top, self.get_query_vector(vectors))
+        if self.context_packer is not None:
+            results = self.context_packer.pack(results, use_semantic_captions)
 
         # Process results
         text_sources = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
         rendered_answer_prompt = self.prompt_manager.render_prompt(
-            self.answer_prompt,
+            answer_prompt,
             self.get_system_prompt_variables(overrides.get("prompt_template"))
             | {"user_query": q, "text_sources": text_sources},
         )
@@ -109,8 +158,9 @@ class RetrieveThenReadApproach(Approach):
             seed=seed,
         )
 
+        data_points: dict[str, Any] = {"text": text_sources}
         extra_info = {
-            "data_points": {"text": text_sources},
+            "data_points": data_points,
             "thoughts": [
                 ThoughtStep(
                     "Search using user query",
@@ -122,7 +172,8 @@ class RetrieveThenReadApproach(Approach):
                         "filter": filter,
                         "use_vector_search": use_vector_search,
                         "use_text_search": use_text_search,
-                    },
+                    }
+                    | ({"reranker": overrides["reranker"]} if reranker is not None else {}),
                 ),
                 ThoughtStep(
                     "Search results",
@@ -140,6 +191,10 @@ class RetrieveThenReadApproach(Approach):
             ],
         }
 
+        content = chat_completion.choices[0].message.content
+        if self.answer_cache is not None and answer_cache_scope is not None and content:
+            self.answer_cache.set(answer_cache_scope, q, query_vector, CachedAnswer(content, data_points))
+
         return {
             "message": {
                 "content": chat_completion.choices[0].message.content,
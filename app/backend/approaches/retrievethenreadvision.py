@@ -1,5 +1,7 @@
+import asyncio
 from typing import Any, Awaitable, Callable, Optional
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI
@@ -8,10 +10,12 @@ from openai.types.chat import (
 )
 from openai_messages_token_helper import get_token_limit
 
-from approaches.approach import Approach, ThoughtStep
+from approaches.approach import Approach, Document, ThoughtStep
 from approaches.promptmanager import PromptManager
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
 from core.imageshelper import fetch_image
+from core.searchcache import SearchCache
 
 
 class RetrieveThenReadVisionApproach(Approach):
@@ -40,6 +44,9 @@ class RetrieveThenReadVisionApproach(Approach):
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
         prompt_manager: PromptManager,
+        http_session: Optional[aiohttp.ClientSession] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache[Document]] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -58,7 +65,13 @@ class RetrieveThenReadVisionApproach(Approach):
         self.vision_token_provider = vision_token_provider
         self.gpt4v_token_limit = get_token_limit(gpt4v_model, self.ALLOW_NON_GPT_MODELS)
         self.prompt_manager = prompt_manager
-        self.answer_prompt = self.prompt_manager.load_prompt("ask_answer_question_vision.prompty")
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.http_session = http_session
+
+    @property
+    def answer_prompt(self):
+        return self.prompt_manager.load_prompt("ask_answer_question_vision.prompty")
 
     async def run(
         self,
@@ -97,29 +110,37 @@ class RetrieveThenReadVisionApproach(Approach):
                 )
                 vectors.append(vector)
 
-        results = await self.search(
-            top,
-            q,
-            filter,
-            vectors,
-            use_text_search,
-            use_vector_search,
-            use_semantic_ranker,
-            use_semantic_captions,
-            minimum_search_score,
-            minimum_reranker_score,
-        )
+        # The images are downloaded while the next search results are read, instead of one after the other
+        results: list[Document] = []
+        image_downloads: list[asyncio.Task[Optional[str]]] = []
+        try:
+            async for result in self.search_stream(
+                top,
+                q,
+                filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                include_vectors=bool(overrides.get("include_vectors")),
+            ):
+                results.append(result)
+                if send_images_to_gptvision:
+                    image_downloads.append(asyncio.create_task(fetch_image(self.blob_container_client, result)))
+            image_urls = await asyncio.gather(*image_downloads)
+        except BaseException:
+            for image_download in image_downloads:
+                image_download.cancel()
+            raise
 
         # Process results
         text_sources = []
-        image_sources = []
         if send_text_to_gptvision:
             text_sources = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
-        if send_images_to_gptvision:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_sources.append(url)
+        image_sources = [url for url in image_urls if url]
 
         rendered_answer_prompt = self.prompt_manager.render_prompt(
             self.answer_prompt,
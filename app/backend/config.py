@@ -28,4 +28,12 @@ CONFIG_COSMOS_HISTORY_CLIENT = "cosmos_history_client"
 CONFIG_COSMOS_HISTORY_CONTAINER = "cosmos_history_container"
 CONFIG_COSMOS_HISTORY_VERSION = "cosmos_history_version"
 CONFIG_COSMOS_LOGGING_CLIENT = "cosmos_logging_client"
-CONFIG_COSMOS_LOGGING_CONTAINER = "cosmos_logging_container"
\ No newline at end of file
+CONFIG_COSMOS_LOGGING_CONTAINER = "cosmos_logging_container"
+CONFIG_HTTP_CLIENTS = "http_clients"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_SEARCH_CACHE = "search_cache"
+CONFIG_CACHE_STATS_ENABLED = "cache_stats_enabled"
+CONFIG_PROMPT_MANAGER = "prompt_manager"
+CONFIG_PROMPT_RELOAD_TASK = "prompt_reload_task"
+CONFIG_STREAM_FLUSH_INTERVAL = "stream_flush_interval"
@@ -0,0 +1,177 @@
+import asyncio
+import copy
+import hashlib
+import json
+import math
+import time
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from operator import mul
+from typing import Any, Optional
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice
+from openai.types.chat.chat_completion_chunk import ChoiceDelta
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+
+from core.cache import LRUCache
+from prepdocslib.indexversion import IndexVersion
+
+
+@dataclass
+class CachedAnswer:
+    content: str
+    # The sources that the answer cites. The thoughts are not cached, as they contain the conversation of the user
+    # who asked first, and are rebuilt from the request that the answer is served to.
+    data_points: dict[str, Any]
+
+
+@dataclass
+class AnswerCacheHit:
+    answer: CachedAnswer
+    similarity: float
+
+    @property
+    def match(self) -> str:
+        return "exact" if self.similarity >= 1 else "semantic"
+
+
+def get_similarity(vector: array, candidate: array) -> float:
+    return sum(map(mul, vector, candidate))
+
+
+class AnswerCache:
+    """
+    Opt-in cache of generated answers, for frequently asked questions.
+    Answers are indexed by the search query (after the rewrite for chat) within a scope that combines everything
+    else that decides the answer: the approach, the security filter of the user, the conversation history,
+    the overrides and the prompt version.
+    Besides exact matches of the normalized query, a query whose embedding is at least similarity_threshold close
+    to one of the latest cached ones of its scope gets its answer. The whole cache is dropped when the search index
+    changes.
+    """
+
+    # Most recent queries of a scope compared by similarity, as the vectors are compared one by one
+    MAX_SEMANTIC_CANDIDATES = 128
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        ttl: Optional[float] = None,
+        similarity_threshold: Optional[float] = None,
+        index_version: Optional[IndexVersion] = None,
+    ):
+        self.entries: LRUCache[tuple[str, str], CachedAnswer] = LRUCache(max_size=max_size, ttl=ttl)
+        # Normalized query vectors of each scope, from the least to the most recently cached
+        self.vectors: dict[str, OrderedDict[str, array]] = {}
+        self.vector_count = 0
+        self.similarity_threshold = similarity_threshold
+        self.index_version = index_version
+        self.cached_index_version = index_version.current if index_version else None
+
+    @staticmethod
+    def create_scope(**parts: Any) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(query.split()).casefold()
+
+    @staticmethod
+    def normalize_vector(vector: list[float]) -> Optional[array]:
+        norm = math.sqrt(sum(value * value for value in vector))
+        return array("f", (value / norm for value in vector)) if norm else None
+
+    def check_index_version(self):
+        if self.index_version is not None and self.index_version.current != self.cached_index_version:
+            self.entries.clear()
+            self.vectors.clear()
+            self.vector_count = 0
+            self.cached_index_version = self.index_version.current
+
+    def remove_evicted_vectors(self):
+        # The vectors of the answers evicted or expired from the entries are dropped once they outnumber them
+        self.vectors = {
+            scope: OrderedDict(
+                (query, vector) for query, vector in vectors.items() if (scope, query) in self.entries.entries
+            )
+            for scope, vectors in self.vectors.items()
+        }
+        self.vectors = {scope: vectors for scope, vectors in self.vectors.items() if vectors}
+        self.vector_count = sum(len(vectors) for vectors in self.vectors.values())
+
+    async def get(self, scope: str, query: str, query_vector: Optional[list[float]] = None) -> Optional[AnswerCacheHit]:
+        self.check_index_version()
+        answer = self.entries.get((scope, self.normalize_query(query)), record=False)
+        if answer is not None:
+            self.entries.record(hit=True)
+            return AnswerCacheHit(copy.deepcopy(answer), similarity=1.0)
+        hit = await self.get_similar(scope, query_vector)
+        self.entries.record(hit=hit is not None)
+        return hit
+
+    async def get_similar(self, scope: str, query_vector: Optional[list[float]]) -> Optional[AnswerCacheHit]:
+        if self.similarity_threshold is None or query_vector is None or scope not in self.vectors:
+            return None
+        normalized_vector = self.normalize_vector(query_vector)
+        if normalized_vector is None:
+            return None
+        candidates = list(self.vectors[scope].items())[-self.MAX_SEMANTIC_CANDIDATES :]
+        # Comparing the vectors takes milliseconds, which would delay the other requests on the event loop
+        similarities = await asyncio.to_thread(
+            lambda: [get_similarity(normalized_vector, vector) for _, vector in candidates]
+        )
+        for similarity, (candidate_query, _) in sorted(
+            zip(similarities, candidates), key=lambda candidate: candidate[0], reverse=True
+        ):
+            if similarity < self.similarity_threshold:
+                break
+            answer = self.entries.get((scope, candidate_query), record=False)
+            if answer is not None:
+                return AnswerCacheHit(copy.deepcopy(answer), similarity=similarity)
+        return None
+
+    def set(self, scope: str, query: str, query_vector: Optional[list[float]], answer: CachedAnswer):
+        self.check_index_version()
+        normalized_query = self.normalize_query(query)
+        self.entries.set((scope, normalized_query), copy.deepcopy(answer))
+        vector = self.normalize_vector(query_vector) if query_vector is not None else None
+        if vector is not None:
+            vectors = self.vectors.setdefault(scope, OrderedDict())
+            if normalized_query not in vectors:
+                self.vector_count += 1
+            vectors[normalized_query] = vector
+            vectors.move_to_end(normalized_query)
+            if self.vector_count > 2 * self.entries.max_size:
+                self.remove_evicted_vectors()
+
+    def stats(self) -> dict[str, float]:
+        return self.entries.stats()
+
+
+def cached_chat_completion(content: str, model: str) -> ChatCompletion:
+    return ChatCompletion(
+        id="cached",
+        object="chat.completion",
+        created=int(time.time()),
+        model=model,
+        choices=[
+            Choice(
+                index=0,
+                finish_reason="stop",
+                message=ChatCompletionMessage(role="assistant", content=content),
+            )
+        ],
+    )
+
+
+def cached_chat_completion_chunk(content: str, model: str) -> ChatCompletionChunk:
+    return ChatCompletionChunk(
+        id="cached",
+        object="chat.completion.chunk",
+        created=int(time.time()),
+        model=model,
+        choices=[ChunkChoice(index=0, delta=ChoiceDelta(role="assistant", content=content), finish_reason="stop")],
+    )
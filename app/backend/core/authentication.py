@@ -1,8 +1,14 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
 import base64
+import copy
+import functools
+import hashlib
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional
 
 import aiohttp
@@ -20,6 +26,9 @@ from tenacity import (
     wait_random_exponential,
 )
 
+from core.cache import LRUCache
+from core.httpclient import borrow_session
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -31,8 +40,109 @@ class AuthError(Exception):
         return self.error or ""
 
 
+def create_pem_from_jwk(key: dict[str, Any]) -> bytes:
+    # Construct the RSA public key
+    public_numbers = rsa.RSAPublicNumbers(
+        e=int.from_bytes(base64.urlsafe_b64decode(key["e"] + "=="), byteorder="big"),
+        n=int.from_bytes(base64.urlsafe_b64decode(key["n"] + "=="), byteorder="big"),
+    )
+    public_key = public_numbers.public_key()
+
+    # Convert to PEM format
+    return public_key.public_bytes(
+        encoding=serialization.Encoding.PEM, format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+
+
+class SigningKeyCache:
+    """
+    In-process cache of the Entra token signing keys (JWKS), indexed by key id ("kid").
+    Keys are refreshed in the background once the TTL has elapsed, and refetched right away when a token
+    is signed by a key that is not cached yet, which is what happens after a signing key rollover.
+    Concurrent requests share a single in-flight refresh.
+    See https://learn.microsoft.com/entra/identity-platform/signing-key-rollover
+    """
+
+    def __init__(
+        self,
+        key_url: str,
+        ttl: float = 24 * 60 * 60,
+        min_refresh_interval: float = 60,
+        http_session: Optional[aiohttp.ClientSession] = None,
+    ):
+        self.key_url = key_url
+        self.http_session = http_session
+        self.ttl = ttl
+        # Anyone can send a token with an unknown key id, so limit how often that can force a refresh
+        self.min_refresh_interval = min_refresh_interval
+        self.jwks_keys: dict[str, dict[str, Any]] = {}
+        self.pem_keys: dict[str, bytes] = {}
+        self.last_refreshed: Optional[float] = None
+        self.refresh_task: Optional[asyncio.Task] = None
+
+    async def get_key(self, kid: str) -> Optional[bytes]:
+        """
+        Returns the PEM encoded public key for the given key id, or None if Entra doesn't publish that key
+        """
+        if self.last_refreshed is None:
+            await self.refresh()
+        elif kid not in self.jwks_keys:
+            if time.monotonic() - self.last_refreshed >= self.min_refresh_interval:
+                await self.refresh()
+        elif time.monotonic() - self.last_refreshed >= self.ttl:
+            # Keep serving the cached keys while the new ones are downloaded
+            self.start_refresh()
+
+        if kid not in self.pem_keys:
+            jwk = self.jwks_keys.get(kid)
+            if jwk is None:
+                return None
+            self.pem_keys[kid] = create_pem_from_jwk(jwk)
+        return self.pem_keys[kid]
+
+    def start_refresh(self) -> asyncio.Task:
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.fetch_keys())
+            self.refresh_task.add_done_callback(SigningKeyCache.log_refresh_error)
+        return self.refresh_task
+
+    async def refresh(self):
+        # Shield the shared refresh so that one cancelled request doesn't cancel it for the others
+        await asyncio.shield(self.start_refresh())
+
+    @staticmethod
+    def log_refresh_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Failed to refresh token signing keys: %s", task.exception())
+
+    async def fetch_keys(self):
+        jwks = None
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type(AuthError),
+            wait=wait_random_exponential(min=15, max=60),
+            stop=stop_after_attempt(5),
+        ):
+            with attempt:
+                async with borrow_session(self.http_session) as session:
+                    async with session.get(url=self.key_url) as resp:
+                        resp_status = resp.status
+                        if resp_status in [500, 502, 503, 504]:
+                            raise AuthError(
+                                error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
+                            )
+                        jwks = await resp.json()
+
+        if not jwks or "keys" not in jwks:
+            raise AuthError("Unable to get keys to validate auth token.", 401)
+
+        self.jwks_keys = {key["kid"]: key for key in jwks["keys"] if "kid" in key}
+        self.pem_keys = {}
+        self.last_refreshed = time.monotonic()
+
+
 class AuthenticationHelper:
     scope: str = "https://graph.microsoft.com/.default"
+    GRAPH_PAGE_SIZE = 999
 
     def __init__(
         self,
@@ -45,6 +155,11 @@ class AuthenticationHelper:
         require_access_control: bool = False,
         enable_global_documents: bool = False,
         enable_unauthenticated_access: bool = False,
+        auth_claims_cache_size: int = 1000,
+        obo_max_workers: int = 8,
+        groups_cache_size: int = 1000,
+        groups_cache_ttl: float = 5 * 60,
+        http_session: Optional[aiohttp.ClientSession] = None,
     ):
         self.use_authentication = use_authentication
         self.server_app_id = server_app_id
@@ -61,6 +176,14 @@ class AuthenticationHelper:
         self.valid_audiences = [f"api://{server_app_id}", str(server_app_id)]
         # See https://learn.microsoft.com/entra/identity-platform/access-tokens#validate-the-issuer for more information on token validation
         self.key_url = f"{self.authority}/discovery/v2.0/keys"
+        # Shared pooled session for the calls to Entra and Microsoft Graph, owned by the app
+        self.http_session = http_session
+        self.signing_keys = SigningKeyCache(self.key_url, http_session=http_session)
+        # Maps a hash of each validated access token to the claims resolved for it, until the token expires
+        self.auth_claims_cache: LRUCache[str, dict[str, Any]] = LRUCache(max_size=auth_claims_cache_size)
+        # Group memberships read from Microsoft Graph for users with a groups overage claim, indexed by oid
+        self.groups_cache: LRUCache[str, list[str]] = LRUCache(max_size=groups_cache_size, ttl=groups_cache_ttl)
+        self.graph_pages_fetched = 0
 
         if self.use_authentication:
             field_names = [field.name for field in search_index.fields] if search_index else []
@@ -71,12 +194,19 @@ class AuthenticationHelper:
             self.confidential_client = ConfidentialClientApplication(
                 server_app_id, authority=self.authority, client_credential=server_app_secret, token_cache=TokenCache()
             )
+            self.obo_executor = ThreadPoolExecutor(max_workers=obo_max_workers, thread_name_prefix="obo")
+            self.pending_obo_exchanges: dict[str, asyncio.Future] = {}
         else:
             self.has_auth_fields = False
             self.require_access_control = False
             self.enable_global_documents = True
             self.enable_unauthenticated_access = True
 
+    def close(self):
+        # The exchanges still running finish on their threads, without delaying the shutdown of the app
+        if self.use_authentication:
+            self.obo_executor.shutdown(wait=False)
+
     def get_auth_setup_for_client(self) -> dict[str, Any]:
         # returns MSAL.js settings used by the client app
         return {
@@ -178,16 +308,21 @@ class AuthenticationHelper:
 
         return security_filter
 
-    @staticmethod
-    async def list_groups(graph_resource_access_token: dict) -> list[str]:
+    async def list_groups(self, graph_resource_access_token: dict) -> list[str]:
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
         groups = []
-        async with aiohttp.ClientSession(headers=headers) as session:
+        async with borrow_session(self.http_session) as session:
             resp_json = None
             resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
+            # Request the largest page size Graph allows, so users in many groups need as few round trips as possible
+            # https://learn.microsoft.com/graph/paging
+            async with session.get(
+                url=f"https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id&$top={self.GRAPH_PAGE_SIZE}",
+                headers=headers,
+            ) as resp:
                 resp_json = await resp.json()
                 resp_status = resp.status
+                self.graph_pages_fetched += 1
                 if resp_status != 200:
                     raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
 
@@ -197,16 +332,43 @@ class AuthenticationHelper:
                     groups.append(group["id"])
                 next_link = resp_json.get("@odata.nextLink")
                 if next_link:
-                    async with session.get(url=next_link) as resp:
+                    async with session.get(url=next_link, headers=headers) as resp:
                         resp_json = await resp.json()
                         resp_status = resp.status
+                        self.graph_pages_fetched += 1
                 else:
                     break
             if resp_status != 200:
                 raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
 
+        logging.info(
+            "Read %d groups from Microsoft Graph, %d pages fetched so far", len(groups), self.graph_pages_fetched
+        )
         return groups
 
+    def get_cache_stats(self) -> dict[str, Any]:
+        return {
+            "authClaims": self.auth_claims_cache.stats(),
+            "groups": self.groups_cache.stats() | {"graphPagesFetched": self.graph_pages_fetched},
+        }
+
+    async def acquire_token_on_behalf_of(self, auth_token: str, token_hash: str) -> dict[str, Any]:
+        # MSAL only has a synchronous API, so the exchange runs on a dedicated thread pool to keep the event loop free.
+        # Concurrent requests carrying the same user token share a single exchange.
+        exchange = self.pending_obo_exchanges.get(token_hash)
+        if exchange is None:
+            exchange = asyncio.get_running_loop().run_in_executor(
+                self.obo_executor,
+                functools.partial(
+                    self.confidential_client.acquire_token_on_behalf_of,
+                    user_assertion=auth_token,
+                    scopes=["https://graph.microsoft.com/.default"],
+                ),
+            )
+            self.pending_obo_exchanges[token_hash] = exchange
+            exchange.add_done_callback(lambda _: self.pending_obo_exchanges.pop(token_hash, None))
+        return await asyncio.shield(exchange)
+
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
         if not self.use_authentication:
             return {}
@@ -215,14 +377,18 @@ class AuthenticationHelper:
             # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
             # https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow
             auth_token = AuthenticationHelper.get_token_auth_header(headers)
+            # Tokens that were already validated and exchanged are cached until they expire
+            token_hash = hashlib.sha256(auth_token.encode("utf-8")).hexdigest()
+            cached_auth_claims = self.auth_claims_cache.get(token_hash)
+            if cached_auth_claims is not None:
+                return copy.deepcopy(cached_auth_claims)
+
             # Validate the token before use
-            await self.validate_access_token(auth_token)
+            token_claims = await self.validate_access_token(auth_token)
 
             # Use the on-behalf-of-flow to acquire another token for use with Microsoft Graph
             # See https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow for more information
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
-            )
+            graph_resource_access_token = await self.acquire_token_on_behalf_of(auth_token, token_hash)
             if "error" in graph_resource_access_token:
                 raise AuthError(error=str(graph_resource_access_token), status_code=401)
 
@@ -240,9 +406,22 @@ class AuthenticationHelper:
                 and "_claim_names" in id_token_claims
                 and "groups" in id_token_claims["_claim_names"]
             )
+            expires_at = token_claims.get("exp") if token_claims else None
             if missing_groups_claim or has_group_overage_claim:
-                # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
+                # Read the user's groups from Microsoft Graph, unless they were listed recently
+                cached_groups = self.groups_cache.get(auth_claims["oid"])
+                if cached_groups is not None:
+                    auth_claims["groups"] = list(cached_groups)
+                else:
+                    auth_claims["groups"] = await self.list_groups(graph_resource_access_token)
+                    self.groups_cache.set(auth_claims["oid"], list(auth_claims["groups"]))
+                # The claims are not reused for longer than the groups read from Graph, so that changes
+                # of the group memberships apply as soon as for the other tokens of the user
+                if expires_at is not None and self.groups_cache.ttl is not None:
+                    expires_at = min(expires_at, time.time() + self.groups_cache.ttl)
+
+            if expires_at is not None:
+                self.auth_claims_cache.set(token_hash, copy.deepcopy(auth_claims), expires_at=expires_at)
             return auth_claims
         except AuthError as e:
             logging.exception("Exception getting authorization information - " + json.dumps(e.error))
@@ -284,58 +463,25 @@ class AuthenticationHelper:
 
         return allowed
 
-    async def create_pem_format(self, jwks, token):
-        unverified_header = jwt.get_unverified_header(token)
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                # Construct the RSA public key
-                public_numbers = rsa.RSAPublicNumbers(
-                    e=int.from_bytes(base64.urlsafe_b64decode(key["e"] + "=="), byteorder="big"),
-                    n=int.from_bytes(base64.urlsafe_b64decode(key["n"] + "=="), byteorder="big"),
-                )
-                public_key = public_numbers.public_key()
-
-                # Convert to PEM format
-                pem_key = public_key.public_bytes(
-                    encoding=serialization.Encoding.PEM, format=serialization.PublicFormat.SubjectPublicKeyInfo
-                )
-                rsa_key = pem_key
-                return rsa_key
-
     # See https://github.com/Azure-Samples/ms-identity-python-on-behalf-of/blob/939be02b11f1604814532fdacc2c2eccd198b755/FlaskAPI/helpers/authorization.py#L44
-    async def validate_access_token(self, token: str):
+    async def validate_access_token(self, token: str) -> dict[str, Any]:
         """
-        Validate an access token is issued by Entra
+        Validate an access token is issued by Entra, returning its claims
         """
-        jwks = None
-        async for attempt in AsyncRetrying(
-            retry=retry_if_exception_type(AuthError),
-            wait=wait_random_exponential(min=15, max=60),
-            stop=stop_after_attempt(5),
-        ):
-            with attempt:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url=self.key_url) as resp:
-                        resp_status = resp.status
-                        if resp_status in [500, 502, 503, 504]:
-                            raise AuthError(
-                                error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
-                            )
-                        jwks = await resp.json()
-
-        if not jwks or "keys" not in jwks:
-            raise AuthError("Unable to get keys to validate auth token.", 401)
-
         rsa_key = None
         issuer = None
         audience = None
+        kid = None
         try:
+            unverified_header = jwt.get_unverified_header(token)
             unverified_claims = jwt.decode(token, options={"verify_signature": False})
             issuer = unverified_claims.get("iss")
             audience = unverified_claims.get("aud")
-            rsa_key = await self.create_pem_format(jwks, token)
+            kid = unverified_header.get("kid")
         except jwt.PyJWTError as exc:
             raise AuthError("Unable to parse authorization token.", 401) from exc
+        if kid:
+            rsa_key = await self.signing_keys.get_key(kid)
         if not rsa_key:
             raise AuthError("Unable to find appropriate key", 401)
 
@@ -349,7 +495,7 @@ class AuthenticationHelper:
             )
 
         try:
-            jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
+            return jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
         except jwt.ExpiredSignatureError as jwt_expired_exc:
             raise AuthError("Token is expired", 401) from jwt_expired_exc
         except (jwt.InvalidAudienceError, jwt.InvalidIssuerError) as jwt_claims_exc:
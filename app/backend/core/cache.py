@@ -0,0 +1,74 @@
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A bounded in-memory cache that evicts the least recently used entry once max_size is reached.
+    Entries can also expire, either after the cache-wide ttl (in seconds) or at an explicit expires_at timestamp.
+    Hits and misses are counted so the effectiveness of the cache can be reported.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        if max_size <= 0:
+            raise ValueError("max_size must be greater than 0")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[K, tuple[V, Optional[float]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: K, record: bool = True) -> Optional[V]:
+        """
+        Returns the value of key if it has not expired. Lookups that are part of a larger one, such as an exact match
+        tried before a similarity search, pass record=False and record the outcome of the whole lookup themselves.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at is None or expires_at > time.time():
+                self.entries.move_to_end(key)
+                if record:
+                    self.record(hit=True)
+                return value
+            del self.entries[key]
+        if record:
+            self.record(hit=False)
+        return None
+
+    def record(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def set(self, key: K, value: V, expires_at: Optional[float] = None):
+        if self.ttl is not None:
+            ttl_expires_at = time.time() + self.ttl
+            expires_at = ttl_expires_at if expires_at is None else min(expires_at, ttl_expires_at)
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def delete(self, key: K):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
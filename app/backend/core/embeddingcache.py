@@ -0,0 +1,74 @@
+import asyncio
+import hashlib
+import threading
+from array import array
+from typing import Optional
+
+from core.cache import LRUCache
+from prepdocslib.embeddingcache import VectorStore
+
+
+class EmbeddingCache:
+    """
+    Cache of query embeddings, indexed by the normalized query text, the embedding model and the dimensions.
+    Recently used vectors are kept in memory, and optionally in a SQLite file that can be shared by all the workers
+    of the app on the same machine. Vectors are stored as float32, which is the precision of the search index fields.
+    """
+
+    def __init__(self, max_size: int = 1000, path: Optional[str] = None):
+        self.memory: LRUCache[str, array] = LRUCache(max_size=max_size)
+        self.disk_hits = 0
+        # The same store as the embeddings of the sections in prepdocs, with other keys
+        self.store: Optional[VectorStore] = VectorStore(path) if path else None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def create_key(text: str, model: str, dimensions: Optional[int]) -> str:
+        normalized_text = " ".join(text.split()).casefold()
+        return hashlib.sha256(f"{model}:{dimensions}:{normalized_text}".encode()).hexdigest()
+
+    async def get(self, text: str, model: str, dimensions: Optional[int]) -> Optional[list[float]]:
+        key = self.create_key(text, model, dimensions)
+        vector = self.memory.get(key)
+        if vector is None and self.store is not None:
+            # Reads wait for the lock of the file while another worker writes, so they run off the event loop
+            vector = await asyncio.to_thread(self.read, key)
+            if vector is not None:
+                self.memory.set(key, vector)
+                self.disk_hits += 1
+        return vector.tolist() if vector is not None else None
+
+    async def set(self, text: str, model: str, dimensions: Optional[int], embedding: list[float]):
+        key = self.create_key(text, model, dimensions)
+        vector = array("f", embedding)
+        self.memory.set(key, vector)
+        if self.store is not None:
+            await asyncio.to_thread(self.write, key, vector)
+
+    def read(self, key: str) -> Optional[array]:
+        with self.lock:
+            return self.store.get_many([key]).get(key) if self.store is not None else None
+
+    def write(self, key: str, vector: array):
+        with self.lock:
+            if self.store is not None:
+                self.store.set_many({key: vector})
+
+    def stats(self) -> dict[str, float]:
+        # Lookups that missed the memory tier but were found on disk are hits too
+        hits = self.memory.hits
+        misses = self.memory.misses - self.disk_hits
+        lookups = hits + self.memory.misses
+        return {
+            "size": len(self.memory),
+            "hits": hits,
+            "disk_hits": self.disk_hits,
+            "misses": misses,
+            "hit_ratio": (hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self.lock:
+            if self.store is not None:
+                self.store.close()
+                self.store = None
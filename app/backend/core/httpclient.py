@@ -0,0 +1,60 @@
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Optional
+
+import aiohttp
+
+
+class HTTPClientRegistry:
+    """
+    Owns the pooled aiohttp sessions used for the backend's outbound HTTP calls (Microsoft Graph, the Entra signing keys,
+    Azure AI Vision, ...), so that warm keep-alive connections are reused across requests
+    instead of paying for a new TCP and TLS handshake on every call.
+    Sessions are created on first use, and must all be closed with close() when the app shuts down.
+    """
+
+    DEFAULT = "default"
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_connections_per_host: int = 0,
+        keepalive_timeout: float = 30,
+        dns_cache_ttl: Optional[int] = 300,
+    ):
+        # A value of 0 means no limit, like in aiohttp.TCPConnector
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.sessions: dict[str, aiohttp.ClientSession] = {}
+
+    def get_session(self, name: str = DEFAULT) -> aiohttp.ClientSession:
+        session = self.sessions.get(name)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=self.dns_cache_ttl is not None,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            self.sessions[name] = session
+        return session
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+
+@asynccontextmanager
+async def borrow_session(http_session: Optional[aiohttp.ClientSession]) -> AsyncGenerator[aiohttp.ClientSession, None]:
+    """
+    Yields the shared session when one was provided, otherwise a new session that is closed on exit
+    """
+    if http_session is not None:
+        yield http_session
+    else:
+        async with aiohttp.ClientSession() as session:
+            yield session
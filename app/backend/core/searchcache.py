@@ -0,0 +1,79 @@
+import hashlib
+import json
+from array import array
+from typing import Any, Generic, Optional, TypeVar
+
+from azure.search.documents.models import VectorizedQuery, VectorQuery
+
+from core.cache import LRUCache
+from prepdocslib.indexversion import IndexVersion
+
+T = TypeVar("T")
+
+
+class SearchCache(Generic[T]):
+    """
+    Cache of the documents returned by Azure AI Search for recent queries, so that identical searches made within
+    the ttl, such as the same question asked again or sent to both /ask and /chat, are not run again.
+    Entries are dropped when the search index changes, and hits are counted for each approach that searched.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: Optional[float] = 60, index_version: Optional[IndexVersion] = None):
+        self.entries: LRUCache[str, list[T]] = LRUCache(max_size=max_size, ttl=ttl)
+        self.index_version = index_version
+        self.cached_index_version = index_version.current if index_version else None
+        self.approach_stats: dict[str, dict[str, int]] = {}
+
+    @staticmethod
+    def hash_vectors(vectors: list[VectorQuery]) -> str:
+        vectors_hash = hashlib.sha256()
+        for vector in vectors:
+            if isinstance(vector, VectorizedQuery):
+                # Hashing the float32 bytes is much cheaper than serializing thousands of floats as JSON
+                vectors_hash.update(f"{vector.fields}:{vector.k_nearest_neighbors}:".encode())
+                vectors_hash.update(array("f", vector.vector).tobytes())
+            else:
+                vectors_hash.update(json.dumps(vector.as_dict(), sort_keys=True).encode())
+        return vectors_hash.hexdigest()
+
+    @staticmethod
+    def create_key(
+        search_text: Optional[str],
+        vectors: list[VectorQuery],
+        filter: Optional[str],
+        top: int,
+        **flags: Any,
+    ) -> str:
+        parts = {
+            "search_text": search_text,
+            "vectors": SearchCache.hash_vectors(vectors),
+            "filter": filter,
+            "top": top,
+            "flags": flags,
+        }
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def check_index_version(self):
+        if self.index_version is not None and self.index_version.current != self.cached_index_version:
+            self.entries.clear()
+            self.cached_index_version = self.index_version.current
+
+    def get(self, key: str, approach: str) -> Optional[list[T]]:
+        self.check_index_version()
+        documents = self.entries.get(key)
+        approach_stats = self.approach_stats.setdefault(approach, {"hits": 0, "misses": 0})
+        approach_stats["hits" if documents is not None else "misses"] += 1
+        return list(documents) if documents is not None else None
+
+    def set(self, key: str, documents: list[T]):
+        self.check_index_version()
+        self.entries.set(key, list(documents))
+
+    def stats(self) -> dict[str, Any]:
+        return self.entries.stats() | {
+            "approaches": {
+                approach: approach_stats
+                | {"hit_ratio": approach_stats["hits"] / (approach_stats["hits"] + approach_stats["misses"])}
+                for approach, approach_stats in self.approach_stats.items()
+            }
+        }
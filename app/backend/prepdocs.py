@@ -14,6 +14,7 @@ from load_azd_env import load_azd_env
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.cosmosstatusmanager import CosmosStatusManager
 from prepdocslib.csvparser import CsvParser
+from prepdocslib.embeddingcache import ChunkEmbeddingCache
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
     ImageEmbeddings,
@@ -22,6 +23,7 @@ from prepdocslib.embeddings import (
 from prepdocslib.fileprocessor import FileProcessor
 from prepdocslib.filestrategy import FileStrategy
 from prepdocslib.htmlparser import LocalHTMLParser
+from prepdocslib.indexversion import IndexVersion
 from prepdocslib.integratedvectorizerstrategy import (
     IntegratedVectorizerStrategy,
 )
@@ -34,6 +36,7 @@ from prepdocslib.listfilestrategy import (
 )
 from prepdocslib.parser import Parser
 from prepdocslib.pdfparser import DocumentAnalysisParser, LocalPdfParser
+from prepdocslib.ratelimiter import EmbeddingRateLimiter
 from prepdocslib.strategy import DocumentAction, SearchInfo, Strategy
 from prepdocslib.textparser import TextParser
 from prepdocslib.textsplitter import SentenceTextSplitter, SimpleTextSplitter
@@ -159,6 +162,8 @@ def setup_embeddings_service(
     openai_org: Union[str, None],
     disable_vectors: bool = False,
     disable_batch_vectors: bool = False,
+    rate_limiter: Optional[EmbeddingRateLimiter] = None,
+    cache: Optional[ChunkEmbeddingCache] = None,
 ):
     if disable_vectors:
         logger.info("Not setting up embeddings service")
@@ -177,6 +182,8 @@ def setup_embeddings_service(
             open_ai_api_version=openai_api_version,
             credential=azure_open_ai_credential,
             disable_batch=disable_batch_vectors,
+            rate_limiter=rate_limiter,
+            cache=cache,
         )
     else:
         if openai_key is None:
@@ -187,6 +194,8 @@ def setup_embeddings_service(
             credential=openai_key,
             organization=openai_org,
             disable_batch=disable_batch_vectors,
+            rate_limiter=rate_limiter,
+            cache=cache,
         )
 
 
@@ -298,6 +307,8 @@ async def process_documents(args):
     use_acls = os.getenv("AZURE_ADLS_GEN2_STORAGE_ACCOUNT") is not None
     dont_use_vectors = os.getenv("USE_VECTORS", "").lower() == "false"
     use_content_understanding = os.getenv("USE_MEDIA_DESCRIBER_AZURE_CU", "").lower() == "true"
+    # Lets the app workers on this machine know that the answers and search results they cached are stale
+    index_version_file = os.getenv("SEARCH_INDEX_VERSION_FILE")
 
 
     azd_credential = DefaultAzureCredential(process_timeout=60)
@@ -356,6 +367,16 @@ async def process_documents(args):
         openai_dimensions = 1536
         if os.getenv("AZURE_OPENAI_EMB_DIMENSIONS"):
             openai_dimensions = int(os.environ["AZURE_OPENAI_EMB_DIMENSIONS"])
+        # Batches of sections are embedded concurrently, within the quota of the deployment that is configured here
+        # or else read from the x-ratelimit-remaining headers of the responses
+        embeddings_rate_limiter = EmbeddingRateLimiter(
+            max_concurrency=int(os.getenv("AZURE_OPENAI_EMB_CONCURRENCY") or 4),
+            tokens_per_minute=int(os.getenv("AZURE_OPENAI_EMB_TOKENS_PER_MINUTE") or 0),
+            requests_per_minute=int(os.getenv("AZURE_OPENAI_EMB_REQUESTS_PER_MINUTE") or 0),
+        )
+        # Optional file that keeps the embeddings of the sections between runs, to only embed the changed sections
+        embeddings_cache_file = os.getenv("INGESTION_EMBEDDING_CACHE_FILE")
+        embeddings_cache = ChunkEmbeddingCache(embeddings_cache_file) if embeddings_cache_file else None
         openai_embeddings_service = setup_embeddings_service(
             azure_credential=azd_credential,
             openai_host=openai_host,
@@ -369,6 +390,8 @@ async def process_documents(args):
             openai_org=os.getenv("OPENAI_ORGANIZATION"),
             disable_vectors=dont_use_vectors,
             disable_batch_vectors=args.disablebatchvectors,
+            rate_limiter=embeddings_rate_limiter,
+            cache=embeddings_cache,
         )
 
         ingestion_strategy: Strategy
@@ -419,9 +442,17 @@ async def process_documents(args):
                 use_content_understanding=use_content_understanding,
                 content_understanding_endpoint=os.getenv("AZURE_CONTENTUNDERSTANDING_ENDPOINT"),
                 cosmos_manager=cosmos_manager,
+                index_version=IndexVersion(index_version_file) if index_version_file else None,
+                incremental=args.incremental,
             )
 
-        await main(ingestion_strategy, setup_index=not args.remove and not args.removeall)
+        try:
+            await main(ingestion_strategy, setup_index=not args.remove and not args.removeall)
+        finally:
+            if openai_embeddings_service is not None:
+                await openai_embeddings_service.close()
+            if embeddings_cache is not None:
+                embeddings_cache.close()
 
 
 if __name__ == "__main__":
@@ -443,6 +474,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "--disablebatchvectors", action="store_true", help="Don't compute embeddings in batch for the sections"
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only index the sections of each file that changed since it was last indexed, and remove the stale ones",
+    )
     parser.add_argument(
         "--remove",
         action="store_true",
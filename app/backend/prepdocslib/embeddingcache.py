@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import sqlite3
+from array import array
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("scripts")
+
+
+class VectorStore:
+    """
+    Vectors stored by key in a SQLite file, as float32, which is the precision of the search index fields.
+    WAL mode lets the other processes that share the file read while one of them writes.
+    The connection can be used from any thread, but only by one thread at a time.
+    """
+
+    # Keys looked up per query, below the SQLite limit of variables in a statement
+    MAX_KEYS_PER_QUERY = 500
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def get_many(self, keys: List[str]) -> Dict[str, array]:
+        vectors: Dict[str, array] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), self.MAX_KEYS_PER_QUERY):
+            query_keys = unique_keys[start : start + self.MAX_KEYS_PER_QUERY]
+            rows = self.connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(query_keys))})", query_keys
+            )
+            for key, blob in rows:
+                vector = array("f")
+                vector.frombytes(blob)
+                vectors[key] = vector
+        return vectors
+
+    def set_many(self, vectors: Dict[str, array]):
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, vector.tobytes()) for key, vector in vectors.items()],
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+class ChunkEmbeddingCache:
+    """
+    Persistent cache of the embeddings of the sections, indexed by the SHA-256 of their exact text,
+    the embedding model and the dimensions, so that ingesting a file again only embeds the sections that changed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.store = VectorStore(path)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def create_key(text: str, model: str, dimensions: Optional[int]) -> str:
+        return hashlib.sha256(f"{model}:{dimensions}:{text}".encode()).hexdigest()
+
+    def get_many(self, texts: List[str], model: str, dimensions: Optional[int]) -> List[Optional[List[float]]]:
+        keys = [self.create_key(text, model, dimensions) for text in texts]
+        vectors = self.store.get_many(keys)
+        embeddings = [vectors[key].tolist() if key in vectors else None for key in keys]
+        hits = sum(embedding is not None for embedding in embeddings)
+        self.hits += hits
+        self.misses += len(embeddings) - hits
+        return embeddings
+
+    def set_many(self, texts: List[str], model: str, dimensions: Optional[int], embeddings: List[List[float]]):
+        self.store.set_many(
+            {
+                self.create_key(text, model, dimensions): array("f", embedding)
+                for text, embedding in zip(texts, embeddings)
+            }
+        )
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        stats = self.stats()
+        logger.info(
+            "Embedding cache '%s': %d sections reused, %d embedded (%.0f%% hit ratio)",
+            self.path,
+            stats["hits"],
+            stats["misses"],
+            stats["hit_ratio"] * 100,
+        )
+        self.store.close()
@@ -1,6 +1,9 @@
+import asyncio
 import logging
 from abc import ABC
-from typing import Awaitable, Callable, List, Optional, Union
+from contextlib import AsyncExitStack
+from functools import cached_property
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Union, cast
 from urllib.parse import urljoin
 
 import aiohttp
@@ -8,7 +11,12 @@ import tiktoken
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import get_bearer_token_provider
-from openai import AsyncAzureOpenAI, AsyncOpenAI, RateLimitError
+from openai import (
+    AsyncAzureOpenAI,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    RateLimitError,
+)
 from tenacity import (
     AsyncRetrying,
     retry_if_exception_type,
@@ -17,6 +25,9 @@ from tenacity import (
 )
 from typing_extensions import TypedDict
 
+from .embeddingcache import ChunkEmbeddingCache
+from .ratelimiter import EmbeddingRateLimiter
+
 logger = logging.getLogger("scripts")
 
 
@@ -37,7 +48,8 @@ class ExtraArgs(TypedDict, total=False):
 class OpenAIEmbeddings(ABC):
     """
     Contains common logic across both OpenAI and Azure OpenAI embedding services
-    Can split source text into batches for more efficient embedding calls
+    Can split source text into batches for more efficient embedding calls, which are sent concurrently
+    within the rate limits of the deployment
     """
 
     SUPPORTED_BATCH_AOAI_MODEL = {
@@ -51,22 +63,66 @@ class OpenAIEmbeddings(ABC):
         "text-embedding-3-large": True,
     }
 
-    def __init__(self, open_ai_model_name: str, open_ai_dimensions: int, disable_batch: bool = False):
+    def __init__(
+        self,
+        open_ai_model_name: str,
+        open_ai_dimensions: int,
+        disable_batch: bool = False,
+        rate_limiter: Optional[EmbeddingRateLimiter] = None,
+        cache: Optional[ChunkEmbeddingCache] = None,
+    ):
         self.open_ai_model_name = open_ai_model_name
         self.open_ai_dimensions = open_ai_dimensions
         self.disable_batch = disable_batch
+        self.rate_limiter = rate_limiter or EmbeddingRateLimiter()
+        self.cache = cache
+        self.client: Optional[AsyncOpenAI] = None
 
     async def create_client(self) -> AsyncOpenAI:
         raise NotImplementedError
 
+    async def get_client(self) -> AsyncOpenAI:
+        """
+        Returns the client of the service, created on first use and then shared by all the files of the run,
+        so that they reuse its connections and its token provider
+        """
+        if self.client is None:
+            client = await self.create_client()
+            # Another file may have created the client while this one was being created
+            if self.client is None:
+                self.client = client
+            else:
+                await client.close()
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            client = self.client
+            self.client = None
+            await client.close()
+
+    def create_http_client(self) -> DefaultAsyncHttpxClient:
+        # The rate limiter reads the remaining quota from the headers of every response
+        return DefaultAsyncHttpxClient(event_hooks={"response": [self.rate_limiter.update_from_response]})
+
     def before_retry_sleep(self, retry_state):
         logger.info("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
 
+    @cached_property
+    def encoding(self) -> tiktoken.Encoding:
+        # Resolved on first use, as only the models that support batching need to count tokens
+        return tiktoken.encoding_for_model(self.open_ai_model_name)
+
     def calculate_token_length(self, text: str):
-        encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
-        return len(encoding.encode(text))
+        return len(self.encoding.encode(text))
 
-    def split_text_into_batches(self, texts: List[str]) -> List[EmbeddingBatch]:
+    def calculate_token_lengths(self, texts: List[str]) -> List[int]:
+        # Encodes the texts in tiktoken's threads, which release the GIL
+        return [len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts)]
+
+    def split_text_into_batches(
+        self, texts: List[str], token_counts: Optional[Sequence[Optional[int]]] = None
+    ) -> List[EmbeddingBatch]:
         batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(self.open_ai_model_name)
         if not batch_info:
             raise NotImplementedError(
@@ -78,8 +134,13 @@ class OpenAIEmbeddings(ABC):
         batches: List[EmbeddingBatch] = []
         batch: List[str] = []
         batch_token_length = 0
-        for text in texts:
-            text_token_length = self.calculate_token_length(text)
+        # Only the texts without a count from the text splitter are encoded
+        if token_counts is None:
+            token_counts = [None] * len(texts)
+        uncounted_texts = [text for text, token_count in zip(texts, token_counts) if token_count is None]
+        uncounted_token_lengths = iter(self.calculate_token_lengths(uncounted_texts))
+        for text, token_count in zip(texts, token_counts):
+            text_token_length = token_count if token_count is not None else next(uncounted_token_lengths)
             if batch_token_length + text_token_length >= batch_token_limit and len(batch) > 0:
                 batches.append(EmbeddingBatch(batch, batch_token_length))
                 batch = []
@@ -97,32 +158,50 @@ class OpenAIEmbeddings(ABC):
 
         return batches
 
-    async def create_embedding_batch(self, texts: List[str], dimensions_args: ExtraArgs) -> List[List[float]]:
-        batches = self.split_text_into_batches(texts)
-        embeddings = []
-        client = await self.create_client()
-        for batch in batches:
+    async def create_embedding_batch(
+        self, texts: List[str], dimensions_args: ExtraArgs, token_counts: Optional[Sequence[Optional[int]]] = None
+    ) -> List[List[float]]:
+        batches = self.split_text_into_batches(texts, token_counts)
+        client = await self.get_client()
+
+        async def embed_batch(batch: EmbeddingBatch) -> List[List[float]]:
+            # The rate limiter pauses the batches for as long as the service asks, so the backoff can start short
             async for attempt in AsyncRetrying(
                 retry=retry_if_exception_type(RateLimitError),
-                wait=wait_random_exponential(min=15, max=60),
+                wait=wait_random_exponential(min=1, max=60),
                 stop=stop_after_attempt(15),
                 before_sleep=self.before_retry_sleep,
             ):
                 with attempt:
-                    emb_response = await client.embeddings.create(
-                        model=self.open_ai_model_name, input=batch.texts, **dimensions_args
-                    )
-                    embeddings.extend([data.embedding for data in emb_response.data])
+                    admitted_at = await self.rate_limiter.acquire(batch.token_length)
+                    try:
+                        emb_response = await client.embeddings.create(
+                            model=self.open_ai_model_name, input=batch.texts, **dimensions_args
+                        )
+                    except RateLimitError as error:
+                        self.rate_limiter.record_rate_limit(admitted_at, error)
+                        raise
+                    finally:
+                        self.rate_limiter.release()
+                    self.rate_limiter.record_success()
                     logger.info(
                         "Computed embeddings in batch. Batch size: %d, Token count: %d",
                         len(batch.texts),
                         batch.token_length,
                     )
+            return [data.embedding for data in emb_response.data]
 
-        return embeddings
+        tasks = [asyncio.create_task(embed_batch(batch)) for batch in batches]
+        try:
+            batch_embeddings = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return [embedding for embeddings in batch_embeddings for embedding in embeddings]
 
     async def create_embedding_single(self, text: str, dimensions_args: ExtraArgs) -> List[float]:
-        client = await self.create_client()
+        client = await self.get_client()
         async for attempt in AsyncRetrying(
             retry=retry_if_exception_type(RateLimitError),
             wait=wait_random_exponential(min=15, max=60),
@@ -137,7 +216,9 @@ class OpenAIEmbeddings(ABC):
 
         return emb_response.data[0].embedding
 
-    async def create_embeddings(self, texts: List[str]) -> List[List[float]]:
+    async def create_embeddings(
+        self, texts: List[str], token_counts: Optional[Sequence[Optional[int]]] = None
+    ) -> List[List[float]]:
 
         dimensions_args: ExtraArgs = (
             {"dimensions": self.open_ai_dimensions}
@@ -145,8 +226,39 @@ class OpenAIEmbeddings(ABC):
             else {}
         )
 
+        if self.cache is None:
+            return await self.compute_embeddings(texts, dimensions_args, token_counts)
+
+        # Only the sections that are new or were edited since they were last ingested are sent to the service
+        dimensions = dimensions_args.get("dimensions")
+        embeddings = self.cache.get_many(texts, self.open_ai_model_name, dimensions)
+        # Sections repeated in the files, such as headers and footers, are only embedded once
+        missing_indexes: Dict[str, List[int]] = {}
+        for index, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing_indexes.setdefault(texts[index], []).append(index)
+        if missing_indexes:
+            missing_texts = list(missing_indexes)
+            missing_embeddings = await self.compute_embeddings(
+                missing_texts,
+                dimensions_args,
+                (
+                    [token_counts[indexes[0]] for indexes in missing_indexes.values()]
+                    if token_counts is not None
+                    else None
+                ),
+            )
+            self.cache.set_many(missing_texts, self.open_ai_model_name, dimensions, missing_embeddings)
+            for indexes, embedding in zip(missing_indexes.values(), missing_embeddings):
+                for index in indexes:
+                    embeddings[index] = embedding
+        return cast(List[List[float]], embeddings)
+
+    async def compute_embeddings(
+        self, texts: List[str], dimensions_args: ExtraArgs, token_counts: Optional[Sequence[Optional[int]]] = None
+    ) -> List[List[float]]:
         if not self.disable_batch and self.open_ai_model_name in OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL:
-            return await self.create_embedding_batch(texts, dimensions_args)
+            return await self.create_embedding_batch(texts, dimensions_args, token_counts)
 
         return [await self.create_embedding_single(text, dimensions_args) for text in texts]
 
@@ -167,8 +279,10 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
         credential: Union[AsyncTokenCredential, AzureKeyCredential],
         open_ai_custom_url: Union[str, None] = None,
         disable_batch: bool = False,
+        rate_limiter: Optional[EmbeddingRateLimiter] = None,
+        cache: Optional[ChunkEmbeddingCache] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch, rate_limiter, cache)
         self.open_ai_service = open_ai_service
         if open_ai_service:
             self.open_ai_endpoint = f"https://{open_ai_service}.openai.azure.com"
@@ -199,6 +313,7 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
             azure_endpoint=self.open_ai_endpoint,
             azure_deployment=self.open_ai_deployment,
             api_version=self.open_ai_api_version,
+            http_client=self.create_http_client(),
             **auth_args,
         )
 
@@ -216,13 +331,17 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         credential: str,
         organization: Optional[str] = None,
         disable_batch: bool = False,
+        rate_limiter: Optional[EmbeddingRateLimiter] = None,
+        cache: Optional[ChunkEmbeddingCache] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch, rate_limiter, cache)
         self.credential = credential
         self.organization = organization
 
     async def create_client(self) -> AsyncOpenAI:
-        return AsyncOpenAI(api_key=self.credential, organization=self.organization)
+        return AsyncOpenAI(
+            api_key=self.credential, organization=self.organization, http_client=self.create_http_client()
+        )
 
 
 class ImageEmbeddings:
@@ -231,9 +350,16 @@ class ImageEmbeddings:
     To learn more, please visit https://learn.microsoft.com/azure/ai-services/computer-vision/how-to/image-retrieval#call-the-vectorize-image-api
     """
 
-    def __init__(self, endpoint: str, token_provider: Callable[[], Awaitable[str]]):
+    def __init__(
+        self,
+        endpoint: str,
+        token_provider: Callable[[], Awaitable[str]],
+        http_session: Optional[aiohttp.ClientSession] = None,
+    ):
         self.token_provider = token_provider
         self.endpoint = endpoint
+        # Reuses the caller's pooled session when given, otherwise a session is opened per call
+        self.http_session = http_session
 
     async def create_embeddings(self, blob_urls: List[str]) -> List[List[float]]:
         endpoint = urljoin(self.endpoint, "computervision/retrieval:vectorizeImage")
@@ -242,7 +368,10 @@ class ImageEmbeddings:
         headers["Authorization"] = "Bearer " + await self.token_provider()
 
         embeddings: List[List[float]] = []
-        async with aiohttp.ClientSession(headers=headers) as session:
+        async with AsyncExitStack() as stack:
+            session = self.http_session
+            if session is None:
+                session = await stack.enter_async_context(aiohttp.ClientSession())
             for blob_url in blob_urls:
                 async for attempt in AsyncRetrying(
                     retry=retry_if_exception_type(Exception),
@@ -252,7 +381,7 @@ class ImageEmbeddings:
                 ):
                     with attempt:
                         body = {"url": blob_url}
-                        async with session.post(url=endpoint, params=params, json=body) as resp:
+                        async with session.post(url=endpoint, params=params, headers=headers, json=body) as resp:
                             resp_json = await resp.json()
                             embeddings.append(resp_json["vector"])
 
@@ -7,6 +7,7 @@ from .blobmanager import BlobManager
 from .cosmosstatusmanager import CosmosStatusManager
 from .embeddings import ImageEmbeddings, OpenAIEmbeddings
 from .fileprocessor import FileProcessor
+from .indexversion import IndexVersion
 from .listfilestrategy import File, ListFileStrategy
 from .mediadescriber import ContentUnderstandingDescriber
 from .searchmanager import SearchManager, Section
@@ -59,6 +60,8 @@ class FileStrategy(Strategy):
         use_content_understanding: bool = False,
         content_understanding_endpoint: Optional[str] = None,
         cosmos_manager: Optional[CosmosStatusManager] = None,
+        index_version: Optional[IndexVersion] = None,
+        incremental: bool = False,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -73,6 +76,8 @@ class FileStrategy(Strategy):
         self.category = category
         self.use_content_understanding = use_content_understanding
         self.content_understanding_endpoint = content_understanding_endpoint
+        self.index_version = index_version
+        self.incremental = incremental
 
     async def setup(self):
         search_manager = SearchManager(
@@ -82,6 +87,7 @@ class FileStrategy(Strategy):
             False,
             self.embeddings,
             search_images=self.image_embeddings is not None,
+            incremental=self.incremental,
         )
         await search_manager.create_index()
 
@@ -97,7 +103,13 @@ class FileStrategy(Strategy):
 
     async def run(self):
         search_manager = SearchManager(
-            self.search_info, self.search_analyzer_name, self.use_acls, False, self.embeddings
+            self.search_info,
+            self.search_analyzer_name,
+            self.use_acls,
+            False,
+            self.embeddings,
+            index_version=self.index_version,
+            incremental=self.incremental,
         )
         if self.document_action == DocumentAction.Add:
             files = self.list_file_strategy.list()
@@ -152,12 +164,15 @@ class UploadUserFileStrategy:
         file_processors: dict[str, FileProcessor],
         embeddings: Optional[OpenAIEmbeddings] = None,
         image_embeddings: Optional[ImageEmbeddings] = None,
+        index_version: Optional[IndexVersion] = None,
     ):
         self.file_processors = file_processors
         self.embeddings = embeddings
         self.image_embeddings = image_embeddings
         self.search_info = search_info
-        self.search_manager = SearchManager(self.search_info, None, True, False, self.embeddings)
+        self.search_manager = SearchManager(
+            self.search_info, None, True, False, self.embeddings, index_version=index_version
+        )
 
     async def add_file(self, file: File):
         if self.image_embeddings:
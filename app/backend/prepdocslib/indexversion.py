@@ -0,0 +1,32 @@
+import os
+import time
+from typing import Optional
+
+
+class IndexVersion:
+    """
+    Version of the content of a search index, which changes every time documents are added to or removed from it,
+    so that caches derived from the index can tell when their entries are stale.
+    The version is kept in memory for the current process, and can also be stored in a file to be shared with
+    the other processes that update or read the same index on this machine, such as the app workers and prepdocs.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.local_version = 0
+
+    @property
+    def current(self) -> tuple[int, int]:
+        file_version = 0
+        if self.path:
+            try:
+                file_version = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        return (self.local_version, file_version)
+
+    def bump(self):
+        self.local_version += 1
+        if self.path:
+            with open(self.path, "w") as f:
+                f.write(str(time.time_ns()))
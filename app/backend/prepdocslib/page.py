@@ -1,3 +1,6 @@
+from typing import Optional
+
+
 class Page:
     """
     A single page from a document
@@ -21,8 +24,10 @@ class SplitPage:
     Attributes:
         page_num (int): Page number (0-indexed)
         text (str): The text of the section
+        token_count (Optional[int]): The number of tokens of the text, when the splitter counted them
     """
 
-    def __init__(self, page_num: int, text: str):
+    def __init__(self, page_num: int, text: str, token_count: Optional[int] = None):
         self.page_num = page_num
         self.text = text
+        self.token_count = token_count
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import httpx
+from openai import RateLimitError
+
+logger = logging.getLogger("scripts")
+
+
+class TokenBucket:
+    """
+    Allows an amount per minute, such as the tokens or the requests of a deployment, refilled continuously
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_wait_time(self, amount: int) -> float:
+        self.refill()
+        # An amount larger than the bucket only waits for the bucket to be full
+        return max(min(amount, self.capacity) - self.available, 0) / self.rate
+
+    def take(self, amount: int):
+        self.refill()
+        self.available -= amount
+
+    def limit(self, remaining: int):
+        # The remaining quota reported by the service also accounts for the other clients of the deployment
+        self.refill()
+        if remaining > self.capacity:
+            # The remaining quota is at most the limit of the deployment, which is larger than assumed
+            self.capacity = remaining
+            self.rate = remaining / 60
+        self.available = min(self.available, remaining)
+
+
+class EmbeddingRateLimiter:
+    """
+    Paces the embedding requests sent to a deployment, so that batches are computed concurrently within its quota.
+    The tokens and requests per minute are either configured or read from the x-ratelimit headers of the responses.
+    Azure OpenAI only sends the remaining quota, so the limit is then the largest remaining amount seen so far.
+    The number of requests in flight grows by one after a round of successful requests,
+    and is halved when the service responds that it is rate limited (additive increase, multiplicative decrease).
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        # Admits the batches one at a time, in the order that they were split
+        self.admission = asyncio.Lock()
+        self.released = asyncio.Event()
+
+    def get_wait_time(self, token_count: int) -> float:
+        wait_time = self.paused_until - time.monotonic()
+        if self.tokens is not None:
+            wait_time = max(wait_time, self.tokens.get_wait_time(token_count))
+        if self.requests is not None:
+            wait_time = max(wait_time, self.requests.get_wait_time(1))
+        return wait_time
+
+    async def acquire(self, token_count: int) -> float:
+        """
+        Waits until a request of token_count tokens can be sent, and returns the time at which it was admitted
+        """
+        async with self.admission:
+            while True:
+                if self.in_flight >= max(int(self.concurrency), 1):
+                    self.released.clear()
+                    await self.released.wait()
+                    continue
+                wait_time = self.get_wait_time(token_count)
+                if wait_time <= 0:
+                    break
+                await asyncio.sleep(wait_time)
+            self.in_flight += 1
+            if self.tokens is not None:
+                self.tokens.take(token_count)
+            if self.requests is not None:
+                self.requests.take(1)
+            return time.monotonic()
+
+    def release(self):
+        self.in_flight -= 1
+        self.released.set()
+
+    def record_success(self):
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+    def record_rate_limit(self, admitted_at: float, error: RateLimitError):
+        now = time.monotonic()
+        # The requests that were already in flight when the limit was lowered do not lower it again
+        if admitted_at > self.decreased_at:
+            self.concurrency = max(self.concurrency / 2, 1.0)
+            self.decreased_at = now
+            logger.info("Lowering the embedding requests in flight to %d after a rate limit", int(self.concurrency))
+        retry_after = self.get_retry_after(error.response.headers)
+        if retry_after is not None:
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+    @staticmethod
+    def get_retry_after(headers: httpx.Headers) -> Optional[float]:
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            if "retry-after" in headers:
+                return float(headers["retry-after"])
+        except ValueError:
+            # Retry-After can also be an HTTP date, which is left to the exponential backoff
+            pass
+        return None
+
+    async def update_from_response(self, response: httpx.Response):
+        """
+        Reads the quota of the deployment from the headers of a response, as an httpx response hook
+        """
+        for bucket_name, limit_header, remaining_header in (
+            ("tokens", "x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens"),
+            ("requests", "x-ratelimit-limit-requests", "x-ratelimit-remaining-requests"),
+        ):
+            bucket: Optional[TokenBucket] = getattr(self, bucket_name)
+            try:
+                if bucket is None and limit_header in response.headers:
+                    bucket = TokenBucket(int(response.headers[limit_header]))
+                    setattr(self, bucket_name, bucket)
+                elif bucket is None and remaining_header in response.headers:
+                    bucket = TokenBucket(int(response.headers[remaining_header]))
+                    setattr(self, bucket_name, bucket)
+                if bucket is not None and remaining_header in response.headers:
+                    bucket.limit(int(response.headers[remaining_header]))
+            except ValueError:
+                continue
@@ -1,7 +1,9 @@
 import asyncio
+import hashlib
+import json
 import logging
 import os
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 from azure.search.documents.indexes.models import (
     AzureOpenAIVectorizer,
@@ -24,9 +26,10 @@ from azure.search.documents.indexes.models import (
 
 from .blobmanager import BlobManager
 from .embeddings import AzureOpenAIEmbeddingService, OpenAIEmbeddings
+from .indexversion import IndexVersion
 from .listfilestrategy import File
 from .strategy import SearchInfo
-from .textsplitter import SplitPage
+from .textsplitter import SplitPage, bpe
 
 logger = logging.getLogger("scripts")
 
@@ -56,6 +59,8 @@ class SearchManager:
         use_int_vectorization: bool = False,
         embeddings: Optional[OpenAIEmbeddings] = None,
         search_images: bool = False,
+        index_version: Optional[IndexVersion] = None,
+        incremental: bool = False,
     ):
         self.search_info = search_info
         self.search_analyzer_name = search_analyzer_name
@@ -65,6 +70,10 @@ class SearchManager:
         # Integrated vectorization uses the ada-002 model with 1536 dimensions
         self.embedding_dimensions = self.embeddings.open_ai_dimensions if self.embeddings else 1536
         self.search_images = search_images
+        # Bumped whenever the content of the index changes, to invalidate the caches built from search results
+        self.index_version = index_version
+        # Only sends the sections of a file that changed since it was last ingested, see update_content_incremental
+        self.incremental = incremental
 
     async def create_index(self, vectorizers: Optional[List[VectorSearchVectorizer]] = None):
         logger.info("Checking whether search index %s exists...", self.search_info.index_name)
@@ -123,7 +132,10 @@ class SearchManager:
                         filterable=True,
                         facetable=False,
                     ),
+                    SimpleField(name="token_count", type="Edm.Int32", filterable=False),
                 ]
+                if self.incremental:
+                    fields.append(SimpleField(name="content_hash", type="Edm.String", filterable=False))
                 if self.use_acls:
                     fields.append(
                         SimpleField(
@@ -218,9 +230,11 @@ class SearchManager:
             else:
                 logger.info("Search index %s already exists", self.search_info.index_name)
                 existing_index = await search_index_client.get_index(self.search_info.index_name)
-                if not any(field.name == "storageUrl" for field in existing_index.fields):
+                existing_field_names = [field.name for field in existing_index.fields]
+                missing_fields = []
+                if "storageUrl" not in existing_field_names:
                     logger.info("Adding storageUrl field to index %s", self.search_info.index_name)
-                    existing_index.fields.append(
+                    missing_fields.append(
                         SimpleField(
                             name="storageUrl",
                             type="Edm.String",
@@ -228,6 +242,16 @@ class SearchManager:
                             facetable=False,
                         ),
                     )
+                if "token_count" not in existing_field_names:
+                    # The sections that were uploaded before are counted by the app when they are retrieved
+                    logger.info("Adding token_count field to index %s", self.search_info.index_name)
+                    missing_fields.append(SimpleField(name="token_count", type="Edm.Int32", filterable=False))
+                if self.incremental and "content_hash" not in existing_field_names:
+                    # The sections that were uploaded before have no hash, so they are uploaded again once
+                    logger.info("Adding content_hash field to index %s", self.search_info.index_name)
+                    missing_fields.append(SimpleField(name="content_hash", type="Edm.String", filterable=False))
+                if missing_fields:
+                    existing_index.fields.extend(missing_fields)
                     await search_index_client.create_or_update_index(existing_index)
 
                 if existing_index.vector_search is not None and (
@@ -253,6 +277,60 @@ class SearchManager:
                             self.search_info,
                         )
 
+    def count_tokens(self, sections: List[Section]) -> List[int]:
+        # Counted once, by the splitter or here, so that neither the embeddings batching nor the app
+        # budgeting the prompt tokens encode the sections again
+        uncounted_texts = [section.split_page.text for section in sections if section.split_page.token_count is None]
+        uncounted_token_counts = iter(len(tokens) for tokens in bpe.encode_ordinary_batch(uncounted_texts))
+        return [
+            (
+                section.split_page.token_count
+                if section.split_page.token_count is not None
+                else next(uncounted_token_counts)
+            )
+            for section in sections
+        ]
+
+    def create_document(
+        self,
+        section: Section,
+        chunk_id: str,
+        token_count: int,
+        image_embeddings: Optional[List[List[float]]] = None,
+        url: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        document: Dict[str, Any] = {
+            "id": chunk_id,
+            "content": section.split_page.text,
+            "token_count": token_count,
+            "category": section.category,
+            "filename": os.path.basename(section.content.filename()),
+            "sourcepage": (
+                BlobManager.blob_image_name_from_file_page(
+                    filename=section.content.filename(),
+                    page=section.split_page.page_num,
+                )
+                if image_embeddings
+                else BlobManager.sourcepage_from_file_page(
+                    filename=section.content.filename(),
+                    page=section.split_page.page_num,
+                )
+            ),
+            "sourcefile": section.content.filename(),
+            **section.content.acls,
+        }
+        if url:
+            document["storageUrl"] = url
+        if image_embeddings:
+            document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
+        return document
+
+    @staticmethod
+    def create_content_hash(document: Dict[str, Any]) -> str:
+        # The vectors are left out, as they are derived from the text and the page, which are hashed
+        fields = {name: value for name, value in document.items() if name not in ("embedding", "imageEmbedding")}
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
     async def update_content(
         self,
         sections: List[Section],
@@ -262,58 +340,118 @@ class SearchManager:
         """
         Updates the search index with the given sections, returning the chunk IDs used as the documents' 'id'.
         """
+        if self.incremental:
+            return await self.update_content_incremental(sections, image_embeddings, url)
+
         MAX_BATCH_SIZE = 1000
         section_batches = [sections[i : i + MAX_BATCH_SIZE] for i in range(0, len(sections), MAX_BATCH_SIZE)]
         all_chunk_ids: List[str] = []
 
         async with self.search_info.create_search_client() as search_client:
             for batch_index, batch in enumerate(section_batches):
+                token_counts = self.count_tokens(batch)
                 documents = []
                 for section_index, section in enumerate(batch):
                     chunk_id = f"{section.content.filename_to_id()}-chunk-{section_index + batch_index * MAX_BATCH_SIZE}"
                     documents.append(
-                        {
-                            "id": chunk_id,
-                            "content": section.split_page.text,
-                            "category": section.category,
-                            "filename": os.path.basename(section.content.filename()),
-                            "sourcepage": (
-                                BlobManager.blob_image_name_from_file_page(
-                                    filename=section.content.filename(),
-                                    page=section.split_page.page_num,
-                                )
-                                if image_embeddings
-                                else BlobManager.sourcepage_from_file_page(
-                                    filename=section.content.filename(),
-                                    page=section.split_page.page_num,
-                                )
-                            ),
-                            "sourcefile": section.content.filename(),
-                            **section.content.acls,
-                        }
+                        self.create_document(section, chunk_id, token_counts[section_index], image_embeddings, url)
                     )
                     all_chunk_ids.append(chunk_id)
 
-                if url:
-                    for document in documents:
-                        document["storageUrl"] = url
                 if self.embeddings:
                     embeddings = await self.embeddings.create_embeddings(
-                        texts=[section.split_page.text for section in batch]
+                        texts=[section.split_page.text for section in batch], token_counts=token_counts
                     )
                     for i, document in enumerate(documents):
                         document["embedding"] = embeddings[i]
-                if image_embeddings:
-                    for i, (document, section) in enumerate(zip(documents, batch)):
-                        document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
 
                 await search_client.upload_documents(documents)
 
+        if self.index_version:
+            self.index_version.bump()
         logger.info(
             "Updated search index '%s' with %d sections from %d files", self.search_info.index_name, len(sections), len(section_batches)
         )
         return all_chunk_ids
 
+    async def update_content_incremental(
+        self,
+        sections: List[Section],
+        image_embeddings: Optional[List[List[float]]] = None,
+        url: Optional[str] = None,
+    ) -> List[str]:
+        """
+        Updates the search index with the sections of a file, sending only the ones that changed since the file
+        was last ingested, and removing the ones that are not in the file anymore.
+        The chunk IDs are derived from the text of the sections rather than from their position,
+        so that an edit in a page does not change the IDs of the sections that follow it.
+        Each document stores a hash of its fields, which tells whether an unchanged text has new metadata.
+        """
+        if not sections:
+            return []
+        MAX_BATCH_SIZE = 1000
+        file = sections[0].content
+        token_counts = self.count_tokens(sections)
+        documents = []
+        occurrences: Dict[str, int] = {}
+        for section, token_count in zip(sections, token_counts):
+            text_hash = hashlib.sha256(section.split_page.text.encode()).hexdigest()[:32]
+            # A text repeated in the file, such as a page footer, gets one document per occurrence
+            occurrences[text_hash] = occurrences.get(text_hash, 0) + 1
+            chunk_id = f"{file.filename_to_id()}-chunk-{text_hash}"
+            if occurrences[text_hash] > 1:
+                chunk_id += f"-{occurrences[text_hash]}"
+            document = self.create_document(section, chunk_id, token_count, image_embeddings, url)
+            document["content_hash"] = self.create_content_hash(document)
+            documents.append(document)
+
+        async with self.search_info.create_search_client() as search_client:
+            # Replace ' with '' to escape the single quote for the filter
+            path_for_filter = file.filename().replace("'", "''")
+            results = await search_client.search(
+                search_text="", filter=f"sourcefile eq '{path_for_filter}'", select=["id", "content_hash"]
+            )
+            existing_hashes = {result["id"]: result.get("content_hash") async for result in results}
+
+            new_documents = []
+            new_token_counts = []
+            changed_documents = []
+            for document, token_count in zip(documents, token_counts):
+                if document["id"] not in existing_hashes:
+                    new_documents.append(document)
+                    new_token_counts.append(token_count)
+                elif existing_hashes[document["id"]] != document["content_hash"]:
+                    # The text is the same, so the embedding stored in the index is kept
+                    changed_documents.append({"storageUrl": None, **document})
+            chunk_ids = {document["id"] for document in documents}
+            stale_documents = [{"id": chunk_id} for chunk_id in existing_hashes if chunk_id not in chunk_ids]
+
+            if self.embeddings and new_documents:
+                embeddings = await self.embeddings.create_embeddings(
+                    texts=[document["content"] for document in new_documents], token_counts=new_token_counts
+                )
+                for document, embedding in zip(new_documents, embeddings):
+                    document["embedding"] = embedding
+            for i in range(0, len(new_documents), MAX_BATCH_SIZE):
+                await search_client.upload_documents(new_documents[i : i + MAX_BATCH_SIZE])
+            for i in range(0, len(changed_documents), MAX_BATCH_SIZE):
+                await search_client.merge_documents(changed_documents[i : i + MAX_BATCH_SIZE])
+            for i in range(0, len(stale_documents), MAX_BATCH_SIZE):
+                await search_client.delete_documents(stale_documents[i : i + MAX_BATCH_SIZE])
+
+        if self.index_version and (new_documents or changed_documents or stale_documents):
+            self.index_version.bump()
+        logger.info(
+            "Updated search index '%s' with file %s: %d sections uploaded, %d merged, %d removed, %d unchanged",
+            self.search_info.index_name,
+            file.filename(),
+            len(new_documents),
+            len(changed_documents),
+            len(stale_documents),
+            len(documents) - len(new_documents) - len(changed_documents),
+        )
+        return [document["id"] for document in documents]
+
     async def remove_content(self, path: Optional[str] = None, only_oid: Optional[str] = None):
         logger.info(
             "Removing sections from '{%s or '<all>'}' from search index '%s'", path, self.search_info.index_name
@@ -345,5 +483,7 @@ class SearchManager:
                         continue
                 removed_docs = await search_client.delete_documents(documents_to_remove)
                 logger.info("Removed %d sections from index", len(removed_docs))
+                if self.index_version:
+                    self.index_version.bump()
                 # It can take a few seconds for search results to reflect changes, so wait a bit
                 await asyncio.sleep(2)
@@ -102,7 +102,7 @@ class SentenceTextSplitter(TextSplitter):
         tokens = bpe.encode(text)
         if len(tokens) <= self.max_tokens_per_section:
             # Section is already within max tokens, return
-            yield SplitPage(page_num=page_num, text=text)
+            yield SplitPage(page_num=page_num, text=text, token_count=len(tokens))
         else:
             # Start from the center and try and find the closest sentence ending by spiralling outward.
             # IF we get to the outer thirds, then just split in half with a 5% overlap
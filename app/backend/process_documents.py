@@ -71,6 +71,7 @@ async def fetch_and_process_messages(queue_client: QueueClient, deadletter_queue
                 category=None,
                 skipblobs=False,
                 disablebatchvectors=False,
+                incremental=False,
                 searchkey=None,
                 storagekey=None,
                 datalakekey=None,
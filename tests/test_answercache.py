@@ -0,0 +1,189 @@
+import pytest
+from openai.types.chat import ChatCompletion
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.keywordclassifier import KeywordClassifier
+from approaches.promptmanager import PromptyManager
+from core.answercache import AnswerCache, CachedAnswer
+from prepdocslib.indexversion import IndexVersion
+
+from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_exact_match():
+    cache = AnswerCache(max_size=10)
+    assert await cache.get("scope", "What is the dress code?") is None
+    cache.set("scope", "What is the dress code?", None, CachedAnswer("Business casual", {"text": []}))
+
+    # Whitespace and case differences share the cached answer, but other scopes do not
+    hit = await cache.get("scope", "  what is the DRESS code? ")
+    assert hit is not None
+    assert hit.answer.content == "Business casual"
+    assert hit.match == "exact"
+    assert await cache.get("other scope", "What is the dress code?") is None
+
+    # The cached answer cannot be modified through the answer that was served
+    hit.answer.data_points["text"].append("changed")
+    assert (await cache.get("scope", "What is the dress code?")).answer.data_points == {"text": []}
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_semantic_match():
+    cache = AnswerCache(max_size=10, similarity_threshold=0.95)
+    cache.set("scope", "What is the dress code?", [1.0, 0.0, 0.0], CachedAnswer("Business casual", {}))
+    cache.set("other scope", "What should I wear?", [0.0, 1.0, 0.0], CachedAnswer("Shorts", {}))
+
+    hit = await cache.get("scope", "What should I wear?", [0.99, 0.1, 0.0])
+    assert hit is not None
+    assert hit.answer.content == "Business casual"
+    assert hit.match == "semantic"
+    assert hit.similarity == pytest.approx(0.995, abs=1e-3)
+
+    assert await cache.get("scope", "What are the benefits?", [0.5, 0.5, 0.7]) is None
+    # Vectors of other scopes are never matched
+    assert await cache.get("scope", "What should I wear?", [0.0, 1.0, 0.0]) is None
+
+    assert cache.stats() == {"size": 2, "hits": 1, "misses": 2, "hit_ratio": 1 / 3}
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_semantic_candidates(monkeypatch):
+    monkeypatch.setattr(AnswerCache, "MAX_SEMANTIC_CANDIDATES", 2)
+    cache = AnswerCache(max_size=3, similarity_threshold=0.95)
+    cache.set("scope", "What is the dress code?", [1.0, 0.0, 0.0], CachedAnswer("Business casual", {}))
+    cache.set("scope", "What are the benefits?", [0.0, 1.0, 0.0], CachedAnswer("Health and dental", {}))
+    cache.set("scope", "When is payday?", [0.0, 0.0, 1.0], CachedAnswer("Fridays", {}))
+
+    # Only the latest queries of the scope are compared
+    assert await cache.get("scope", "What should I wear?", [1.0, 0.0, 0.0]) is None
+    assert (await cache.get("scope", "Which benefits?", [0.0, 1.0, 0.0])).answer.content == "Health and dental"
+
+    # The vectors of evicted answers are dropped with them
+    for index in range(10):
+        cache.set("other scope", f"Question {index}", [1.0, 1.0, float(index)], CachedAnswer("Answer", {}))
+    assert cache.vector_count <= 6
+    assert "scope" not in cache.vectors
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_without_similarity_threshold():
+    cache = AnswerCache(max_size=10)
+    cache.set("scope", "What is the dress code?", [1.0, 0.0], CachedAnswer("Business casual", {}))
+    assert await cache.get("scope", "What should I wear?", [1.0, 0.0]) is None
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_index_version(tmp_path):
+    version_file = tmp_path / "index_version"
+    index_version = IndexVersion(str(version_file))
+    cache = AnswerCache(max_size=10, index_version=index_version)
+    cache.set("scope", "What is the dress code?", None, CachedAnswer("Business casual", {}))
+    assert await cache.get("scope", "What is the dress code?") is not None
+
+    index_version.bump()
+    assert version_file.exists()
+    assert await cache.get("scope", "What is the dress code?") is None
+
+    # Another process that ingests documents into the same index updates the shared file
+    cache.set("scope", "What is the dress code?", None, CachedAnswer("Business casual", {}))
+    IndexVersion(str(version_file)).bump()
+    assert await cache.get("scope", "What is the dress code?") is None
+
+
+def test_answer_cache_scope():
+    scope = AnswerCache.create_scope(filter=None, overrides={"top": 3, "temperature": 0.3})
+    assert scope == AnswerCache.create_scope(overrides={"temperature": 0.3, "top": 3}, filter=None)
+    assert scope != AnswerCache.create_scope(filter="oids/any(g:search.in(g, 'OID_X'))", overrides={"top": 3})
+
+
+class MockCountingCompletions:
+    def __init__(self, answer: str):
+        self.answer = answer
+        self.answer_calls = 0
+
+    async def create(self, *args, **kwargs):
+        if "tools" in kwargs:
+            content = "0"
+        else:
+            self.answer_calls += 1
+            content = self.answer
+        return ChatCompletion.model_validate(
+            {
+                "id": "chatcmpl-answer",
+                "object": "chat.completion",
+                "created": 1695324963,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {"index": 0, "finish_reason": "stop", "message": {"content": content, "role": "assistant"}}
+                ],
+            }
+        )
+
+
+@pytest.mark.asyncio
+async def test_chat_approach_answer_cache(monkeypatch):
+    completions = MockCountingCompletions("Business casual <<Are jeans allowed?>>")
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=None,
+        auth_helper=None,
+        openai_client=type("MockOpenAI", (), {"chat": type("MockChat", (), {"completions": completions})})(),
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        prompt_manager=PromptyManager(),
+        answer_cache=AnswerCache(max_size=10),
+        keyword_classifier=KeywordClassifier({"golf": []}),
+    )
+    searches = []
+
+    async def mock_search(top, query_text, *args, **kwargs):
+        searches.append(query_text)
+        return []
+
+    monkeypatch.setattr(chat_approach, "search", mock_search)
+    monkeypatch.setattr(chat_approach, "build_filter", lambda overrides, auth_claims: None)
+    messages = [{"role": "user", "content": "What is the dress code?"}]
+    overrides = {"retrieval_mode": "text", "suggest_followup_questions": True}
+
+    response = await chat_approach.run_without_streaming(messages, overrides, {})
+    assert response["message"]["content"] == "Business casual "
+    assert response["context"]["followup_questions"] == ["Are jeans allowed?"]
+    assert completions.answer_calls == 1
+    assert len(searches) == 1
+
+    # The streamed answer to the same question is replayed from the cache, without searching again
+    chunks = [chunk async for chunk in chat_approach.run_with_streaming(messages, overrides, {})]
+    assert completions.answer_calls == 1
+    assert len(searches) == 1
+    thoughts = chunks[0]["context"]["thoughts"]
+    assert thoughts[-1].title == "Answer served from cache"
+    assert thoughts[-1].props == {"match": "exact", "similarity": 1.0}
+    assert "".join(chunk["delta"].get("content") or "" for chunk in chunks) == "Business casual "
+    assert chunks[-1]["context"]["followup_questions"] == ["Are jeans allowed?"]
+
+    # Other overrides change the answer, so they are not served from the cache
+    await chat_approach.run_without_streaming(messages, overrides | {"temperature": 0.9}, {})
+    assert completions.answer_calls == 2
+
+    # Another conversation that ends with the same question is answered again,
+    # and its thoughts never contain the conversation of the first user
+    other_messages = [
+        {"role": "user", "content": "My employee ID is 1234, what is my manager's name?"},
+        {"role": "assistant", "content": "Your manager is Jane."},
+        *messages,
+    ]
+    chat_approach.answer_cache = AnswerCache(max_size=10)
+    await chat_approach.run_without_streaming(other_messages, overrides, {})
+    assert completions.answer_calls == 3
+    response = await chat_approach.run_without_streaming(messages, overrides, {})
+    assert completions.answer_calls == 4
+    response = await chat_approach.run_without_streaming(messages, overrides, {})
+    assert completions.answer_calls == 4
+    assert "1234" not in str(response["context"]["thoughts"])
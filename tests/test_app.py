@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -5,6 +6,8 @@ from unittest import mock
 
 import pytest
 import quart.testing.app
+from azure.core.exceptions import ResourceNotFoundError
+from azure.search.documents.aio import SearchClient
 from httpx import Request, Response
 from openai import BadRequestError
 
@@ -1006,3 +1009,110 @@ async def test_format_as_ndjson():
 
     result = [line async for line in app.format_as_ndjson(gen())]
     assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        {"delta": {"content": "I ❤️ 🐍", "role": "assistant"}},
+        {"delta": {"content": 'Quotes " and \\ and \n\t\u0000 are escaped', "role": "assistant"}},
+        {"delta": {"content": None, "role": "assistant"}},
+        {"delta": {"content": " token", "role": None}},
+        {"delta": {"content": None, "role": None}},
+        {"delta": {"role": "assistant", "content": "Reordered"}},
+        {"delta": {"content": "With context", "role": "assistant"}, "context": {"followup_questions": []}},
+    ],
+)
+def test_format_ndjson_line(event):
+    assert app.format_ndjson_line(event) == json.dumps(event, ensure_ascii=False) + "\n"
+
+
+@pytest.mark.asyncio
+async def test_cache_stats(client):
+    # The statistics of every user are only served when enabled
+    response = await client.get("/api/cache_stats")
+    assert response.status_code == 400
+
+    client.app.config[app.CONFIG_CACHE_STATS_ENABLED] = True
+    response = await client.get("/api/cache_stats")
+    assert response.status_code == 200
+    result = await response.get_json()
+    # The search cache is opt-in, like the answer cache
+    assert result["searchResults"] is None
+    assert result["answers"] is None
+    assert result["groups"]["graphPagesFetched"] == 0
+
+
+def test_format_ndjson_line_tokens_skip_encoder(monkeypatch):
+    def fail_dumps(*args, **kwargs):
+        raise AssertionError("Answer tokens should not go through json.dumps")
+
+    monkeypatch.setattr(app.json, "dumps", fail_dumps)
+    # The deltas of the tokens after the first one have no role
+    assert app.format_ndjson_line({"delta": {"content": "It", "role": None}}) == (
+        '{"delta": {"content": "It", "role": null}}\n'
+    )
+    assert app.format_ndjson_line({"delta": {"content": " is", "role": "assistant"}}) == (
+        '{"delta": {"content": " is", "role": "assistant"}}\n'
+    )
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_flush_interval():
+    async def gen():
+        yield {"delta": {"content": "Hello", "role": "assistant"}}
+        yield {"delta": {"content": " world", "role": "assistant"}}
+        await asyncio.sleep(0.2)
+        yield {"delta": {"content": "!", "role": "assistant"}}
+        raise ValueError("Stream interrupted")
+
+    result = [lines async for lines in app.format_as_ndjson(gen(), flush_interval=0.05)]
+    # The tokens that arrive within the window are written together, and the last ones before the error
+    assert result == [
+        '{"delta": {"content": "Hello", "role": "assistant"}}\n{"delta": {"content": " world", "role": "assistant"}}\n',
+        '{"delta": {"content": "!", "role": "assistant"}}\n' + json.dumps(app.error_dict(ValueError())),
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("flush_interval", [0, 0.05])
+async def test_format_as_ndjson_closes_stream(flush_interval):
+    tasks = set()
+    closed = []
+
+    async def gen():
+        try:
+            for token in ["Hello", " world", "!"]:
+                tasks.add(asyncio.current_task())
+                yield {"delta": {"content": token, "role": "assistant"}}
+                await asyncio.sleep(0.01)
+        finally:
+            closed.append(True)
+
+    # The client disconnects after the first write
+    stream = app.format_as_ndjson(gen(), flush_interval=flush_interval)
+    assert "Hello" in await stream.__anext__()
+    await stream.aclose()
+    assert closed == [True]
+    assert len(tasks) == 1
+
+
+@pytest.mark.asyncio
+async def test_document_vectors(client, monkeypatch):
+    async def mock_get_document(self, key, *args, **kwargs):
+        if key != "file-Benefit_Options_pdf-page-2":
+            raise ResourceNotFoundError("Document not found")
+        return {"id": key, "sourcepage": "Benefit_Options-2.pdf", "embedding": [0.1, 0.2, 0.3]}
+
+    monkeypatch.setattr(SearchClient, "get_document", mock_get_document)
+
+    response = await client.get("/api/document/file-Benefit_Options_pdf-page-2/vectors")
+    assert response.status_code == 200
+    assert await response.get_json() == {
+        "id": "file-Benefit_Options_pdf-page-2",
+        "embedding": [0.1, 0.2, 0.3],
+        "imageEmbedding": None,
+    }
+
+    response = await client.get("/api/document/missing/vectors")
+    assert response.status_code == 404
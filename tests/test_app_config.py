@@ -30,6 +30,38 @@ async def test_app_local_openai(monkeypatch, minimal_env):
         assert quart_app.config[app.CONFIG_OPENAI_CLIENT].base_url == "http://localhost:5000"
 
 
+@pytest.mark.asyncio
+async def test_app_search_cache(monkeypatch, minimal_env):
+    monkeypatch.setenv("OPENAI_HOST", "local")
+    monkeypatch.setenv("OPENAI_BASE_URL", "http://localhost:5000")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_SEARCH_CACHE] is None
+
+    monkeypatch.setenv("USE_SEARCH_CACHE", "true")
+    monkeypatch.setenv("SEARCH_CACHE_TTL", "30")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_SEARCH_CACHE].entries.ttl == 30
+
+
+@pytest.mark.asyncio
+async def test_app_query_embedding_cache(monkeypatch, minimal_env):
+    monkeypatch.setenv("OPENAI_HOST", "local")
+    monkeypatch.setenv("OPENAI_BASE_URL", "http://localhost:5000")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_EMBEDDING_CACHE] is None
+
+    monkeypatch.setenv("USE_QUERY_EMBEDDING_CACHE", "true")
+    monkeypatch.setenv("QUERY_EMBEDDING_CACHE_SIZE", "50")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_EMBEDDING_CACHE].memory.max_size == 50
+
+
 @pytest.mark.asyncio
 async def test_app_azure_custom_key(monkeypatch, minimal_env):
     monkeypatch.setenv("OPENAI_HOST", "azure_custom")
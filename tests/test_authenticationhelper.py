@@ -1,10 +1,13 @@
+import asyncio
 import base64
 import json
 import re
+import time
 from datetime import datetime, timedelta
 
 import aiohttp
 import jwt
+import msal
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
@@ -12,7 +15,7 @@ from azure.search.documents.indexes.models import SearchField, SearchIndex
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
-from core.authentication import AuthenticationHelper, AuthError
+from core.authentication import AuthenticationHelper, AuthError, SigningKeyCache
 
 from .mocks import MockAsyncPageIterator, MockResponse
 
@@ -102,6 +105,44 @@ async def test_get_auth_claims_overage_success(
     assert auth_claims.get("groups") == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]
 
 
+@pytest.mark.asyncio
+async def test_get_auth_claims_overage_groups_cached(
+    mock_confidential_client_overage, mock_list_groups_success, mock_validate_token_success
+):
+    helper = create_authentication_helper()
+    # Different tokens for the same user share the cached group membership
+    for token in ["Token1", "Token2", "Token3"]:
+        auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"})
+        assert auth_claims.get("groups") == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]
+    assert helper.graph_pages_fetched == 2
+    assert helper.groups_cache.stats()["hits"] == 2
+    assert helper.get_cache_stats()["groups"] == {
+        "size": 1,
+        "hits": 2,
+        "misses": 1,
+        "hit_ratio": 2 / 3,
+        "graphPagesFetched": 2,
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_overage_cached_until_groups_expire(
+    monkeypatch, mock_confidential_client_overage, mock_list_groups_success
+):
+    token_exp = int((datetime.utcnow() + timedelta(hours=1)).timestamp())
+
+    async def mock_validate_access_token(self, token):
+        return {"oid": "OID_X", "exp": token_exp}
+
+    monkeypatch.setattr(AuthenticationHelper, "validate_access_token", mock_validate_access_token)
+
+    helper = create_authentication_helper()
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    # The claims with groups read from Graph expire with the groups, rather than with the token
+    [(_, expires_at)] = helper.auth_claims_cache.entries.values()
+    assert expires_at <= time.time() + helper.groups_cache.ttl
+
+
 @pytest.mark.asyncio
 async def test_get_auth_claims_overage_unauthorized(
     mock_confidential_client_overage, mock_list_groups_unauthorized, mock_validate_token_success
@@ -112,15 +153,126 @@ async def test_get_auth_claims_overage_unauthorized(
 
 
 @pytest.mark.asyncio
-async def test_list_groups_success(mock_list_groups_success, mock_validate_token_success):
-    groups = await AuthenticationHelper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
+async def test_get_auth_claims_cached(monkeypatch, mock_confidential_client_success):
+    token_exp = int((datetime.utcnow() + timedelta(hours=1)).timestamp())
+
+    async def mock_validate_access_token(self, token):
+        return {"oid": "OID_X", "exp": token_exp}
+
+    monkeypatch.setattr(AuthenticationHelper, "validate_access_token", mock_validate_access_token)
+
+    obo_calls = 0
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        nonlocal obo_calls
+        obo_calls += 1
+        return {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}}
+
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+
+    helper = create_authentication_helper()
+    for _ in range(3):
+        auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+        assert auth_claims == {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+        # Callers can't modify the cached claims
+        auth_claims["groups"].append("GROUP_INJECTED")
+    assert obo_calls == 1
+    assert helper.auth_claims_cache.hits == 2
+    assert helper.auth_claims_cache.misses == 1
+
+    # A different token is validated and exchanged separately
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer OtherToken"})
+    assert obo_calls == 2
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_not_cached_after_expiry(monkeypatch, mock_confidential_client_success):
+    async def mock_validate_access_token(self, token):
+        return {"oid": "OID_X", "exp": int(datetime.utcnow().timestamp()) - 1}
+
+    monkeypatch.setattr(AuthenticationHelper, "validate_access_token", mock_validate_access_token)
+
+    helper = create_authentication_helper()
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    assert helper.auth_claims_cache.hits == 0
+    assert helper.auth_claims_cache.misses == 2
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_obo_off_event_loop(
+    monkeypatch, mock_confidential_client_success, mock_validate_token_success
+):
+    obo_calls = 0
+    ticks = 0
+    ticks_during_obo = 0
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        nonlocal obo_calls, ticks_during_obo
+        obo_calls += 1
+        # Simulate a slow, blocking round trip to Entra
+        time.sleep(0.2)
+        ticks_during_obo = ticks
+        return {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}}
+
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+
+    async def ticker():
+        nonlocal ticks
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    helper = create_authentication_helper()
+    results = await asyncio.gather(
+        *[helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"}) for _ in range(3)], ticker()
+    )
+    # The event loop kept running while the exchange was in flight
+    assert ticks_during_obo == 10
+    # Concurrent requests with the same token share a single exchange
+    assert obo_calls == 1
+    assert results[:3] == [{"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}] * 3
+    assert helper.pending_obo_exchanges == {}
+
+
+def test_close_shuts_down_obo_executor(mock_confidential_client_success):
+    helper = create_authentication_helper()
+    helper.close()
+    with pytest.raises(RuntimeError):
+        helper.obo_executor.submit(print)
+
+    # Without authentication there is no executor to shut down
+    AuthenticationHelper(
+        search_index=None,
+        use_authentication=False,
+        server_app_id=None,
+        server_app_secret=None,
+        client_app_id=None,
+        tenant_id=None,
+    ).close()
+
+
+@pytest.mark.asyncio
+async def test_list_groups_success(
+    mock_confidential_client_success, mock_list_groups_success, mock_validate_token_success
+):
+    helper = create_authentication_helper()
+    groups = await helper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
     assert groups == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]
+    assert helper.graph_pages_fetched == 2
 
 
 @pytest.mark.asyncio
-async def test_list_groups_unauthorized(mock_list_groups_unauthorized, mock_validate_token_success):
+async def test_list_groups_unauthorized(
+    mock_confidential_client_success, mock_list_groups_unauthorized, mock_validate_token_success
+):
+    helper = create_authentication_helper()
     with pytest.raises(AuthError) as exc_info:
-        await AuthenticationHelper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
+        await helper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
     assert exc_info.value.error == '{"error": "unauthorized"}'
 
 
@@ -519,58 +671,22 @@ async def test_check_path_auth_allowed_public_without_access_control(
 
 
 @pytest.mark.asyncio
-async def test_create_pem_format(mock_confidential_client_success, mock_validate_token_success):
-    helper = create_authentication_helper()
+async def test_create_pem_from_jwk(monkeypatch):
     mock_token, public_key, payload = create_mock_jwt(oid="OID_X")
     _, other_public_key, _ = create_mock_jwt(oid="OID_Y")
-    mock_jwks = {
-        "keys": [
-            # Include a key with a different KID to ensure the correct key is selected
-            {
-                "kty": "RSA",
-                "kid": "other_mock_kid",
-                "use": "sig",
-                "n": base64.urlsafe_b64encode(
-                    other_public_key.public_numbers().n.to_bytes(
-                        (other_public_key.public_numbers().n.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-                "e": base64.urlsafe_b64encode(
-                    other_public_key.public_numbers().e.to_bytes(
-                        (other_public_key.public_numbers().e.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-            },
-            {
-                "kty": "RSA",
-                "kid": "mock_kid",
-                "use": "sig",
-                "n": base64.urlsafe_b64encode(
-                    public_key.public_numbers().n.to_bytes(
-                        (public_key.public_numbers().n.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-                "e": base64.urlsafe_b64encode(
-                    public_key.public_numbers().e.to_bytes(
-                        (public_key.public_numbers().e.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-            },
-        ]
-    }
 
-    pem_key = await helper.create_pem_format(mock_jwks, mock_token)
+    def mock_get(*args, **kwargs):
+        # Include a key with a different KID to ensure the correct key is selected
+        published_keys = [create_mock_jwk(other_public_key, kid="other_mock_kid"), create_mock_jwk(public_key)]
+        return MockResponse(status=200, text=json.dumps({"keys": published_keys}))
+
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+
+    cache = SigningKeyCache("https://login.microsoftonline.com/TENANT_ID/discovery/v2.0/keys")
+    pem_key = await cache.get_key(jwt.get_unverified_header(mock_token)["kid"])
 
     # Assert that the result is bytes
-    assert isinstance(pem_key, bytes), "create_pem_format should return bytes"
+    assert isinstance(pem_key, bytes), "create_pem_from_jwk should return bytes"
 
     # Convert bytes to string for regex matching
     pem_str = pem_key.decode("utf-8")
@@ -600,9 +716,26 @@ async def test_create_pem_format(mock_confidential_client_success, mock_validate
         pytest.fail(f"Failed to load PEM key: {str(e)}")
 
 
+def create_mock_jwk(public_key, kid="mock_kid"):
+    def encode(number: int) -> str:
+        return (
+            base64.urlsafe_b64encode(number.to_bytes((number.bit_length() + 7) // 8, byteorder="big"))
+            .decode("utf-8")
+            .rstrip("=")
+        )
+
+    return {
+        "kty": "RSA",
+        "kid": kid,
+        "use": "sig",
+        "n": encode(public_key.public_numbers().n),
+        "e": encode(public_key.public_numbers().e),
+    }
+
+
 @pytest.mark.asyncio
 async def test_validate_access_token(monkeypatch, mock_confidential_client_success):
-    mock_token, public_key, payload = create_mock_jwt(oid="OID_X")
+    mock_token, public_key, _ = create_mock_jwt(oid="OID_X")
 
     def mock_get(*args, **kwargs):
         return MockResponse(
@@ -620,16 +753,7 @@ async def test_validate_access_token(monkeypatch, mock_confidential_client_succe
                             "x5c": ["MIIC/jCC"],
                             "issuer": "https://login.microsoftonline.com/TENANT_ID/v2.0",
                         },
-                        {
-                            "kty": "RSA",
-                            "use": "sig",
-                            "kid": "MGLq",
-                            "x5t": "MGLq",
-                            "n": "yfNcG8",
-                            "e": "AQAB",
-                            "x5c": ["MIIC/jCC"],
-                            "issuer": "https://login.microsoftonline.com/TENANT_ID/v2.0",
-                        },
+                        create_mock_jwk(public_key, kid="mock_kid"),
                     ]
                 }
             ),
@@ -637,15 +761,76 @@ async def test_validate_access_token(monkeypatch, mock_confidential_client_succe
 
     monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
 
-    def mock_decode(*args, **kwargs):
-        return payload
+    helper = create_authentication_helper()
+    await helper.validate_access_token(mock_token)
+
 
-    monkeypatch.setattr(jwt, "decode", mock_decode)
+@pytest.mark.asyncio
+async def test_validate_access_token_caches_keys(monkeypatch, mock_confidential_client_success):
+    mock_token, public_key, _ = create_mock_jwt(oid="OID_X")
+    key_requests = 0
 
-    async def mock_create_pem_format(*args, **kwargs):
-        return public_key
+    def mock_get(*args, **kwargs):
+        nonlocal key_requests
+        key_requests += 1
+        return MockResponse(status=200, text=json.dumps({"keys": [create_mock_jwk(public_key, kid="mock_kid")]}))
 
-    monkeypatch.setattr(AuthenticationHelper, "create_pem_format", mock_create_pem_format)
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
 
     helper = create_authentication_helper()
+    await asyncio.gather(*[helper.validate_access_token(mock_token) for _ in range(5)])
     await helper.validate_access_token(mock_token)
+    assert key_requests == 1
+
+
+@pytest.mark.asyncio
+async def test_signing_key_cache_unknown_kid(monkeypatch):
+    _, public_key, _ = create_mock_jwt(kid="mock_kid")
+    _, rotated_public_key, _ = create_mock_jwt(kid="rotated_kid")
+    published_keys = [create_mock_jwk(public_key, kid="mock_kid")]
+    key_requests = 0
+
+    def mock_get(*args, **kwargs):
+        nonlocal key_requests
+        key_requests += 1
+        return MockResponse(status=200, text=json.dumps({"keys": published_keys}))
+
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+
+    cache = SigningKeyCache("https://login.microsoftonline.com/TENANT_ID/discovery/v2.0/keys")
+    assert await cache.get_key("mock_kid") is not None
+    assert key_requests == 1
+
+    # Unknown key ids only force a refresh once the minimum refresh interval has passed
+    published_keys.append(create_mock_jwk(rotated_public_key, kid="rotated_kid"))
+    assert await cache.get_key("rotated_kid") is None
+    assert key_requests == 1
+
+    cache.last_refreshed -= cache.min_refresh_interval
+    assert await cache.get_key("rotated_kid") is not None
+    assert key_requests == 2
+
+
+@pytest.mark.asyncio
+async def test_signing_key_cache_expired(monkeypatch):
+    _, public_key, _ = create_mock_jwt(kid="mock_kid")
+    key_requests = 0
+
+    def mock_get(*args, **kwargs):
+        nonlocal key_requests
+        key_requests += 1
+        return MockResponse(status=200, text=json.dumps({"keys": [create_mock_jwk(public_key, kid="mock_kid")]}))
+
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+
+    cache = SigningKeyCache("https://login.microsoftonline.com/TENANT_ID/discovery/v2.0/keys")
+    pem_key = await cache.get_key("mock_kid")
+    cache.last_refreshed -= cache.ttl
+
+    # Expired keys are still served while the refresh runs in the background
+    assert await cache.get_key("mock_kid") == pem_key
+    assert cache.refresh_task is not None
+    await cache.refresh_task
+    assert key_requests == 2
+    assert await cache.get_key("mock_kid") == pem_key
+    assert key_requests == 2
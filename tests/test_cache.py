@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+from core.cache import LRUCache
+
+
+def test_lrucache_evicts_least_recently_used():
+    cache: LRUCache[str, int] = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_lrucache_expiry():
+    cache: LRUCache[str, int] = LRUCache(max_size=10, ttl=60)
+    cache.set("expired", 1, expires_at=time.time() - 1)
+    cache.set("fresh", 2, expires_at=time.time() + 3600)
+    assert cache.get("expired") is None
+    assert cache.get("fresh") == 2
+    # The cache-wide TTL caps explicit expiry times
+    assert cache.entries["fresh"][1] <= time.time() + 60
+    assert len(cache) == 1
+
+
+def test_lrucache_stats():
+    cache: LRUCache[str, int] = LRUCache(max_size=10)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+    cache.delete("a")
+    assert cache.get("a") is None
+    assert cache.stats() == {"size": 0, "hits": 2, "misses": 2, "hit_ratio": 0.5}
+
+
+def test_lrucache_invalid_size():
+    with pytest.raises(ValueError):
+        LRUCache(max_size=0)
+
+
+def test_lrucache_record():
+    cache: LRUCache[str, int] = LRUCache(max_size=10)
+    cache.set("a", 1)
+    assert cache.get("a", record=False) == 1
+    assert cache.get("b", record=False) is None
+    assert cache.stats()["hits"] == 0 and cache.stats()["misses"] == 0
+    cache.record(hit=True)
+    assert cache.stats()["hits"] == 1
@@ -1,16 +1,22 @@
+import asyncio
 import json
 
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
 from openai.types.chat import ChatCompletion
+from openai_messages_token_helper import message_builder
 
+from approaches.approach import Document
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.contextpacker import ContextPacker
+from approaches.keywordclassifier import KeywordClassifier
 from approaches.promptmanager import PromptyManager
 
 from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
     MOCK_EMBEDDING_MODEL_NAME,
+    MockAsyncPageIterator,
     MockAsyncSearchResultsIterator,
 )
 
@@ -201,3 +207,437 @@ async def test_search_results_filtering_by_scores(
     assert (
         len(filtered_results) == expected_result_count
     ), f"Expected {expected_result_count} results with minimum_search_score={minimum_search_score} and minimum_reranker_score={minimum_reranker_score}"
+
+
+class MockPagedSearchResults:
+    def __init__(self, pages):
+        self.pages = pages
+        self.pages_read = 0
+
+    async def by_page(self):
+        for page in self.pages:
+            self.pages_read += 1
+            yield MockAsyncPageIterator(list(page))
+
+
+def mock_search_hit(id, score, reranker_score=None):
+    return {"id": id, "content": id, "@search.score": score, "@search.reranker_score": reranker_score}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "use_semantic_ranker,pages,expected_ids,expected_pages_read",
+    [
+        # Stops reading pages once top documents passed the thresholds
+        (False, [[mock_search_hit("a", 0.9), mock_search_hit("b", 0.8)], [mock_search_hit("c", 0.7)]], ["a", "b"], 1),
+        # Results are sorted by search score, so the first one below the threshold ends the search
+        (False, [[mock_search_hit("a", 0.9), mock_search_hit("b", 0.1)], [mock_search_hit("c", 0.05)]], ["a"], 1),
+        # With the semantic ranker, the results are sorted by reranker score and the search score is only a filter
+        (
+            True,
+            [[mock_search_hit("a", 0.1, 3), mock_search_hit("b", 0.9, 2.5)], [mock_search_hit("c", 0.9, 1)]],
+            ["b"],
+            2,
+        ),
+    ],
+)
+async def test_search_stream_early_termination(
+    chat_approach, use_semantic_ranker, pages, expected_ids, expected_pages_read
+):
+    results = MockPagedSearchResults(pages)
+
+    async def mock_search(*args, **kwargs):
+        return results
+
+    chat_approach.search_client = type("MockSearchClient", (), {"search": staticmethod(mock_search)})()
+
+    documents = [
+        document
+        async for document in chat_approach.search_stream(
+            top=2,
+            query_text="test query",
+            filter=None,
+            vectors=[],
+            use_text_search=True,
+            use_vector_search=False,
+            use_semantic_ranker=use_semantic_ranker,
+            use_semantic_captions=False,
+            minimum_search_score=0.5,
+            minimum_reranker_score=2 if use_semantic_ranker else 0,
+        )
+    ]
+
+    assert [document.id for document in documents] == expected_ids
+    assert results.pages_read == expected_pages_read
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "include_vectors,has_token_count_field,expected_select",
+    [
+        (False, False, ["id", "content", "category", "sourcepage", "sourcefile"]),
+        (False, True, ["id", "content", "category", "sourcepage", "sourcefile", "token_count"]),
+        (True, False, None),
+    ],
+)
+async def test_search_excludes_vectors(chat_approach, include_vectors, has_token_count_field, expected_select):
+    chat_approach.has_token_count_field = has_token_count_field
+    search_kwargs = {}
+
+    async def mock_search(*args, **kwargs):
+        search_kwargs.update(kwargs)
+        return MockPagedSearchResults([])
+
+    chat_approach.search_client = type("MockSearchClient", (), {"search": staticmethod(mock_search)})()
+
+    await chat_approach.search(
+        top=3,
+        query_text="test query",
+        filter=None,
+        vectors=[],
+        use_text_search=True,
+        use_vector_search=False,
+        use_semantic_ranker=False,
+        use_semantic_captions=False,
+        minimum_search_score=0,
+        minimum_reranker_score=0,
+        include_vectors=include_vectors,
+    )
+
+    assert search_kwargs["select"] == expected_select
+
+
+class MockQueryRewriteCompletions:
+    def __init__(self, query_rewrite: str):
+        self.query_rewrite = query_rewrite
+
+    async def create(self, *args, **kwargs):
+        return ChatCompletion.model_validate(
+            {
+                "id": "chatcmpl-rewrite",
+                "object": "chat.completion",
+                "created": 1695324963,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"content": self.query_rewrite, "role": "assistant"},
+                    }
+                ],
+            }
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query_rewrite,expected_search_vector,expected_path",
+    [
+        ("0", "What is the dress code?", "speculative"),
+        ("What is the dress code?", "What is the dress code?", "speculative"),
+        ("dress code policy", "dress code policy", "recomputed"),
+    ],
+)
+async def test_speculative_query_embedding(
+    monkeypatch, chat_approach, query_rewrite, expected_search_vector, expected_path
+):
+    chat_approach.speculative_query_embedding = True
+    chat_approach.openai_client = type(
+        "MockOpenAI", (), {"chat": type("MockChat", (), {"completions": MockQueryRewriteCompletions(query_rewrite)})}
+    )()
+    embedded_queries = []
+    searched_vectors = []
+
+    async def mock_compute_text_embedding(q):
+        embedded_queries.append(q)
+        return q
+
+    async def mock_search(top, query_text, filter, vectors, *args, **kwargs):
+        searched_vectors.extend(vectors)
+        return []
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "search", mock_search)
+    monkeypatch.setattr(chat_approach, "build_filter", lambda overrides, auth_claims: None)
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the dress code?"}], overrides={}, auth_claims={}, should_stream=False
+    )
+    await chat_coroutine
+
+    assert searched_vectors == [expected_search_vector]
+    assert embedded_queries.count(expected_search_vector) == 1
+    assert extra_info["thoughts"][1].props["query_embedding"] == expected_path
+
+
+class MockMultiQueryRewriteCompletions:
+    def __init__(self, search_query: str, sub_queries: list[str]):
+        self.arguments = json.dumps({"search_query": search_query, "sub_queries": sub_queries})
+        self.calls: list[dict] = []
+
+    async def create(self, *args, **kwargs):
+        self.calls.append(kwargs)
+        return ChatCompletion.model_validate(
+            {
+                "id": "chatcmpl-rewrite",
+                "object": "chat.completion",
+                "created": 1695324963,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "tool_calls",
+                        "message": {
+                            "role": "assistant",
+                            "tool_calls": [
+                                {
+                                    "id": "search_sources1235",
+                                    "type": "function",
+                                    "function": {"name": "search_sources", "arguments": self.arguments},
+                                }
+                            ],
+                        },
+                    }
+                ],
+            }
+        )
+
+
+def test_get_sub_queries(chat_approach):
+    completions = MockMultiQueryRewriteCompletions("dental plan", ["dental plan", "vision plan", "0", "vision plan"])
+    chat_completion = asyncio.run(completions.create())
+    assert chat_approach.get_sub_queries(chat_completion, "dental plan", 3) == ["vision plan"]
+
+
+@pytest.mark.asyncio
+async def test_multi_query_search(monkeypatch, chat_approach):
+    completions = MockMultiQueryRewriteCompletions(
+        "plan deductibles", ["dental plan deductible", "vision plan deductible", "health plan deductible"]
+    )
+    chat_approach.openai_client = type("MockOpenAI", (), {"chat": type("MockChat", (), {"completions": completions})})()
+    chat_approach.sub_query_concurrency = 2
+    searches_in_flight = []
+    embedded_queries = []
+
+    async def mock_compute_text_embedding(q):
+        embedded_queries.append(q)
+        return q
+
+    async def mock_search(top, query_text, filter, vectors, *args, **kwargs):
+        searches_in_flight.append(query_text)
+        await asyncio.sleep(0.01)
+        assert len(searches_in_flight) <= 2
+        searches_in_flight.remove(query_text)
+        # Every query finds its own document, and the shared overview of the plans
+        return [
+            Document(
+                id=document_id,
+                content=document_id,
+                embedding=None,
+                image_embedding=None,
+                category=None,
+                sourcepage=f"{document_id}.pdf",
+                sourcefile=f"{document_id}.pdf",
+                oids=None,
+                groups=None,
+                captions=[],
+            )
+            for document_id in (query_text, "overview")
+        ]
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "search", mock_search)
+    monkeypatch.setattr(chat_approach, "build_filter", lambda overrides, auth_claims: None)
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What are the deductibles of my plans?"}],
+        overrides={"multi_query": True, "top": 3},
+        auth_claims={},
+        should_stream=False,
+    )
+    await chat_coroutine
+
+    # Only the rewrite asked for sub-queries
+    assert "sub_queries" in json.dumps(completions.calls[0]["tools"])
+    assert embedded_queries == [
+        "plan deductibles",
+        "dental plan deductible",
+        "vision plan deductible",
+        "health plan deductible",
+    ]
+    # The results of the four searches are fused, and the document found by all of them comes first only once
+    results = extra_info["thoughts"][2].description
+    assert [result["id"] for result in results] == ["overview", "plan deductibles", "dental plan deductible"]
+    sub_queries = extra_info["thoughts"][1].props["sub_queries"]
+    assert [sub_query["query"] for sub_query in sub_queries] == [
+        "plan deductibles",
+        "dental plan deductible",
+        "vision plan deductible",
+        "health plan deductible",
+    ]
+    assert all(sub_query["results"] == 2 and sub_query["duration_ms"] >= 0 for sub_query in sub_queries)
+
+
+@pytest.mark.asyncio
+async def test_packed_sources_not_counted_again(monkeypatch, chat_approach):
+    chat_approach.openai_client = type(
+        "MockOpenAI", (), {"chat": type("MockChat", (), {"completions": MockQueryRewriteCompletions("dress code")})}
+    )()
+    chat_approach.context_packer = ContextPacker(1000)
+    counted_messages = []
+    count_tokens_for_message = message_builder.count_tokens_for_message
+
+    def mock_count_tokens_for_message(model, message, **kwargs):
+        counted_messages.append(message)
+        return count_tokens_for_message(model, message, **kwargs)
+
+    async def mock_compute_text_embedding(q):
+        return q
+
+    async def mock_search(*args, **kwargs):
+        return [
+            Document(
+                id="dress-code",
+                content="Employees wear business casual clothing from Monday to Thursday.",
+                embedding=None,
+                image_embedding=None,
+                category=None,
+                sourcepage="handbook.pdf#page=4",
+                sourcefile="handbook.pdf",
+                oids=None,
+                groups=None,
+                captions=[],
+                token_count=12,
+            )
+        ]
+
+    monkeypatch.setattr(message_builder, "count_tokens_for_message", mock_count_tokens_for_message)
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "search", mock_search)
+    monkeypatch.setattr(chat_approach, "build_filter", lambda overrides, auth_claims: None)
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [
+            {"role": "user", "content": "Is there a dress code?"},
+            {"role": "assistant", "content": "Yes, the handbook has one."},
+            {"role": "user", "content": "What is the dress code?"},
+        ],
+        overrides={},
+        auth_claims={},
+        should_stream=False,
+    )
+    await chat_coroutine
+
+    # The question and the history are counted for the answer prompt, but the sources were counted when packed
+    assert [message["content"] for message in counted_messages[-3:]] == [
+        "What is the dress code?",
+        "Yes, the handbook has one.",
+        "Is there a dress code?",
+    ]
+    messages = extra_info["thoughts"][3].description
+    assert messages[-1]["role"] == "user"
+    assert "handbook.pdf#page=4: Employees wear business casual clothing" in messages[-1]["content"]
+
+
+@pytest.mark.asyncio
+async def test_speculative_query_embedding_disabled(monkeypatch, chat_approach):
+    chat_approach.openai_client = type(
+        "MockOpenAI", (), {"chat": type("MockChat", (), {"completions": MockQueryRewriteCompletions("0")})}
+    )()
+
+    async def mock_compute_text_embedding(q):
+        return q
+
+    async def mock_search(*args, **kwargs):
+        return []
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "search", mock_search)
+    monkeypatch.setattr(chat_approach, "build_filter", lambda overrides, auth_claims: None)
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the dress code?"}], overrides={}, auth_claims={}, should_stream=False
+    )
+    await chat_coroutine
+
+    assert "query_embedding" not in extra_info["thoughts"][1].props
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("is_non_answerable", [True, False])
+async def test_run_with_streaming_classifies_concurrently(monkeypatch, chat_approach, is_non_answerable):
+    events = []
+
+    async def mock_classify_user_input_from_keywords(user_question, keywords):
+        events.append("classify started")
+        await asyncio.sleep(0.01)
+        events.append("classify finished")
+        return is_non_answerable
+
+    async def mock_answer():
+        return None
+
+    async def mock_run_until_final_call(messages, overrides, auth_claims, should_stream):
+        events.append("retrieval started")
+        await asyncio.sleep(0.1)
+        events.append("retrieval finished")
+        return {}, mock_answer()
+
+    monkeypatch.setattr(chat_approach, "classify_user_input_from_keywords", mock_classify_user_input_from_keywords)
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+
+    stream = chat_approach.run_with_streaming([{"role": "user", "content": "Who won the game?"}], {}, {})
+    first_event = await stream.__anext__()
+    if is_non_answerable:
+        assert first_event["context"]["data_points"] == {"text": ["Classified as a non-answerable question"]}
+        second_event = await stream.__anext__()
+        assert second_event["delta"]["content"] == chat_approach.PRE_GENERATED_RESPONSE
+        # The retrieval was cancelled as soon as the question was classified
+        assert events == ["classify started", "retrieval started", "classify finished"]
+    else:
+        assert first_event["context"] == {}
+        assert events == ["classify started", "retrieval started", "classify finished", "retrieval finished"]
+    await stream.aclose()
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_local_keyword_classifier(monkeypatch, chat_approach):
+    chat_approach.keyword_classifier = KeywordClassifier.from_file(KeywordClassifier.DEFAULT_RULES_FILE)
+
+    async def mock_classify_user_input_from_keywords(user_question, keywords):
+        raise AssertionError("The chat model should not be used to classify the question")
+
+    monkeypatch.setattr(chat_approach, "classify_user_input_from_keywords", mock_classify_user_input_from_keywords)
+
+    stream = chat_approach.run_with_streaming([{"role": "user", "content": "Best NBA team?"}], {}, {})
+    events = [event async for event in stream]
+    assert events[-1]["delta"]["content"] == chat_approach.PRE_GENERATED_RESPONSE
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "question,llm_fallback,expected_result,expected_llm_calls",
+    [
+        ("When is the next tee time?", True, True, 0),
+        ("What does my plan cover?", True, False, 0),
+        ("Who won the tournament?", False, False, 0),
+        ("Who won the tournament?", True, True, 1),
+    ],
+)
+async def test_classify_user_input_llm_fallback(
+    monkeypatch, chat_approach, question, llm_fallback, expected_result, expected_llm_calls
+):
+    chat_approach.keyword_classifier = KeywordClassifier.from_file(KeywordClassifier.DEFAULT_RULES_FILE)
+    chat_approach.keyword_classifier_llm_fallback = llm_fallback
+    llm_calls = []
+
+    async def mock_classify_user_input_from_keywords(user_question, keywords):
+        llm_calls.append(keywords)
+        return True
+
+    monkeypatch.setattr(chat_approach, "classify_user_input_from_keywords", mock_classify_user_input_from_keywords)
+
+    assert await chat_approach.classify_user_input(question) == expected_result
+    assert len(llm_calls) == expected_llm_calls
+    if llm_calls:
+        assert llm_calls[0] == ["golf", "basketball", "football"]
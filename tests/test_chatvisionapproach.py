@@ -150,3 +150,25 @@ async def test_compute_text_embedding(chat_approach, openai_client, mock_openai_
     assert result.vector == [0.0023064255, -0.009327292, -0.0028842222]
     assert result.k_nearest_neighbors == 50
     assert result.fields == "embedding"
+
+
+@pytest.mark.asyncio
+async def test_classify_user_input_from_keywords(chat_approach, monkeypatch):
+    models = []
+
+    async def mock_create(*args, **kwargs):
+        models.append(kwargs["model"])
+        return ChatCompletion.model_validate(
+            {
+                "id": "chatcmpl-classify",
+                "object": "chat.completion",
+                "created": 1695324963,
+                "model": "gpt-35-turbo",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"content": "True", "role": "assistant"}}],
+            }
+        )
+
+    chat_approach.openai_client.chat = type("MockChat", (), {"completions": type("MockCompletions", (), {})()})()
+    monkeypatch.setattr(chat_approach.openai_client.chat.completions, "create", mock_create, raising=False)
+    assert await chat_approach.classify_user_input("Who won the golf tournament?") is True
+    assert models == ["chat"]
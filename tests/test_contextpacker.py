@@ -0,0 +1,116 @@
+from approaches.approach import Document
+from approaches.contextpacker import ContextPacker
+
+from .mocks import MockCaption
+
+
+def create_document(id, content, sourcepage=None, captions=None):
+    return Document(
+        id=id,
+        content=content,
+        embedding=None,
+        image_embedding=None,
+        category=None,
+        sourcepage=sourcepage or f"{id}.pdf",
+        sourcefile=f"{id}.pdf",
+        oids=None,
+        groups=None,
+        captions=captions or [],
+    )
+
+
+SENTENCES = [
+    "Employees can work remotely up to three days per week with the approval of their manager.",
+    "Remote work days must be recorded in the time tracking system before the end of each month.",
+    "Equipment for the home office is reimbursed up to five hundred dollars every two years.",
+    "Managers review the remote work arrangements of their team members once per quarter.",
+]
+
+
+def test_pack_within_budget():
+    packer = ContextPacker(10000)
+    documents = [create_document("a", SENTENCES[0]), create_document("b", SENTENCES[1])]
+    assert packer.pack(documents, use_semantic_captions=False) == documents
+    assert documents[0].token_count == packer.count_tokens(SENTENCES[0])
+
+    # The token counts are reused by the next requests that find the same documents
+    packer.count_tokens = None
+    assert packer.pack(documents, use_semantic_captions=False) == documents
+
+
+def test_pack_uses_token_count_from_index():
+    packer = ContextPacker(0)
+    documents = [create_document("a", SENTENCES[0]), create_document("b", SENTENCES[1])]
+    documents[0].token_count = 40
+    documents[1].token_count = 200
+    packer.token_budget = 100
+
+    # The sections are not encoded again when they fit whole
+    counted = []
+    count_tokens = packer.count_tokens
+    packer.count_tokens = lambda text: counted.append(text) or count_tokens(text)
+    packed = packer.pack(documents, use_semantic_captions=False)
+    assert packed[0] is documents[0]
+    assert counted == [SENTENCES[1]]
+
+
+def test_pack_trims_at_sentence_boundary():
+    packer = ContextPacker(0)
+    first = create_document("first", " ".join(SENTENCES[:2]))
+    second = create_document("second", " ".join(SENTENCES))
+    third = create_document("third", SENTENCES[3])
+    packer.token_budget = packer.count_tokens(first.content) + packer.count_tokens(" ".join(SENTENCES[:2])) + 5
+
+    packed = packer.pack([first, second, third], use_semantic_captions=False)
+    assert [document.id for document in packed] == ["first", "second"]
+    assert packed[0] is first
+    assert packed[1].content == " ".join(SENTENCES[:2])
+    # The document from the search results is left as is, for the caches that hold it
+    assert second.content == " ".join(SENTENCES)
+
+
+def test_pack_removes_overlap_from_same_page():
+    packer = ContextPacker(10000)
+    documents = [
+        create_document("chunk-1", " ".join(SENTENCES[:3]), sourcepage="policy.pdf#page=1"),
+        # The next chunk of the page starts with the end of the previous one
+        create_document("chunk-2", " ".join(SENTENCES[2:]), sourcepage="policy.pdf#page=1"),
+        create_document("chunk-1-copy", SENTENCES[1], sourcepage="policy.pdf#page=1"),
+        create_document("other-page", SENTENCES[2], sourcepage="policy.pdf#page=2"),
+    ]
+
+    packed = packer.pack(documents, use_semantic_captions=False)
+    assert [document.id for document in packed] == ["chunk-1", "chunk-2", "other-page"]
+    assert packed[1].content == " " + SENTENCES[3]
+    assert packed[1].token_count == packer.count_tokens(" " + SENTENCES[3])
+    assert packed[2].content == SENTENCES[2]
+
+
+def test_pack_captions():
+    packer = ContextPacker(0)
+    documents = [
+        create_document("a", SENTENCES[0], captions=[MockCaption(SENTENCES[0])]),
+        create_document("b", SENTENCES[1], captions=[MockCaption(SENTENCES[1] + " " + SENTENCES[2])]),
+        create_document("c", SENTENCES[3], captions=[MockCaption(SENTENCES[3])]),
+    ]
+    packer.token_budget = packer.count_tokens(SENTENCES[0]) + packer.count_tokens(SENTENCES[3])
+
+    # Captions that do not fit are skipped rather than trimmed
+    packed = packer.pack(documents, use_semantic_captions=True)
+    assert [document.id for document in packed] == ["a", "c"]
+
+
+def test_get_sources_token_count():
+    packer = ContextPacker(10000)
+    documents = [create_document("a", SENTENCES[0]), create_document("b", SENTENCES[1])]
+    packed = packer.pack(documents, use_semantic_captions=False)
+
+    # The sources are counted from the counts kept by pack, without encoding their text again
+    counted = []
+    count_tokens = packer.count_tokens
+    packer.count_tokens = lambda text: counted.append(text) or count_tokens(text)
+    assert packer.get_sources_token_count(packed, use_semantic_captions=False) == sum(
+        count_tokens(text) + count_tokens(document.sourcepage) + ContextPacker.SOURCE_SEPARATOR_TOKENS
+        for document, text in zip(packed, SENTENCES)
+    )
+    assert counted == ["a.pdf", "b.pdf"]
@@ -0,0 +1,113 @@
+import threading
+
+import openai.types
+import pytest
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.promptmanager import PromptyManager
+from core.embeddingcache import EmbeddingCache
+
+from .mocks import (
+    MOCK_EMBEDDING_DIMENSIONS,
+    MOCK_EMBEDDING_MODEL_NAME,
+    MockClient,
+    MockEmbeddingsClient,
+)
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_memory():
+    cache = EmbeddingCache(max_size=10)
+    assert await cache.get("What is the dress code?", "text-embedding-3-large", 256) is None
+    await cache.set("What is the dress code?", "text-embedding-3-large", 256, [0.1, 0.2, 0.3])
+
+    # Whitespace and case differences share the cached vector, but other models and dimensions do not
+    vector = await cache.get("  what is the DRESS code? ", "text-embedding-3-large", 256)
+    assert vector == pytest.approx([0.1, 0.2, 0.3])
+    assert await cache.get("What is the dress code?", "text-embedding-3-small", 256) is None
+    assert await cache.get("What is the dress code?", "text-embedding-3-large", 1024) is None
+
+    assert cache.stats() == {"size": 1, "hits": 1, "disk_hits": 0, "misses": 3, "hit_ratio": 0.25}
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_stores_float32():
+    cache = EmbeddingCache(max_size=10)
+    await cache.set("query", "text-embedding-ada-002", None, [0.1] * 1536)
+    stored_vector = next(iter(cache.memory.entries.values()))[0]
+    assert stored_vector.itemsize == 4
+    assert len(stored_vector.tobytes()) == 1536 * 4
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_disk_shared(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    worker1 = EmbeddingCache(max_size=10, path=path)
+    worker2 = EmbeddingCache(max_size=10, path=path)
+    await worker1.set("query", "text-embedding-ada-002", None, [0.5, -0.25])
+
+    assert await worker2.get("query", "text-embedding-ada-002", None) == [0.5, -0.25]
+    # The second lookup is served from memory
+    assert await worker2.get("query", "text-embedding-ada-002", None) == [0.5, -0.25]
+    assert worker2.stats() == {"size": 1, "hits": 1, "disk_hits": 1, "misses": 0, "hit_ratio": 1.0}
+    worker1.close()
+    worker2.close()
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_disk_off_event_loop(tmp_path):
+    cache = EmbeddingCache(max_size=10, path=str(tmp_path / "embeddings.sqlite"))
+    threads = []
+    read, write = cache.read, cache.write
+    cache.read = lambda key: threads.append(threading.current_thread()) or read(key)
+    cache.write = lambda key, vector: threads.append(threading.current_thread()) or write(key, vector)
+
+    await cache.set("query", "text-embedding-ada-002", None, [0.5])
+    cache.memory.clear()
+    assert await cache.get("query", "text-embedding-ada-002", None) == [0.5]
+    # The SQLite file is only used from other threads, as it waits for the writes of the other workers
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_uses_cache():
+    calls = []
+
+    class CountingEmbeddingsClient(MockEmbeddingsClient):
+        async def create(self, *args, **kwargs):
+            calls.append(kwargs)
+            return await super().create(*args, **kwargs)
+
+    embeddings_client = CountingEmbeddingsClient(
+        openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[openai.types.Embedding(embedding=[0.25, 0.5, 1.0], index=0, object="embedding")],
+            model=MOCK_EMBEDDING_MODEL_NAME,
+            usage=openai.types.create_embedding_response.Usage(prompt_tokens=8, total_tokens=8),
+        )
+    )
+    approach = ChatReadRetrieveReadApproach(
+        search_client=None,
+        auth_helper=None,
+        openai_client=MockClient(embeddings_client),
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        prompt_manager=PromptyManager(),
+        embedding_cache=EmbeddingCache(max_size=10),
+    )
+
+    first = await approach.compute_text_embedding("What is the dress code?")
+    second = await approach.compute_text_embedding("what is the dress code?")
+    assert len(calls) == 1
+    assert calls[0]["model"] == "embeddings"
+    assert first.vector == second.vector == [0.25, 0.5, 1.0]
+    assert approach.embedding_cache.stats()["hits"] == 1
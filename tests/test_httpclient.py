@@ -0,0 +1,35 @@
+import pytest
+
+from core.httpclient import HTTPClientRegistry, borrow_session
+
+
+@pytest.mark.asyncio
+async def test_registry_reuses_sessions():
+    registry = HTTPClientRegistry(max_connections=10, max_connections_per_host=5, keepalive_timeout=15)
+    session = registry.get_session()
+    assert registry.get_session() is session
+    assert registry.get_session("graph") is not session
+    assert session.connector.limit == 10
+    assert session.connector.limit_per_host == 5
+
+    await registry.close()
+    assert session.closed
+    assert registry.sessions == {}
+    # A new session is created if the registry is used again after being closed
+    assert not registry.get_session().closed
+    await registry.close()
+
+
+@pytest.mark.asyncio
+async def test_borrow_session():
+    registry = HTTPClientRegistry()
+    shared_session = registry.get_session()
+    async with borrow_session(shared_session) as session:
+        assert session is shared_session
+    assert not shared_session.closed
+
+    async with borrow_session(None) as session:
+        temporary_session = session
+        assert temporary_session is not shared_session
+    assert temporary_session.closed
+    await registry.close()
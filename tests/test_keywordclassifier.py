@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from approaches.chatapproach import ChatApproach
+from approaches.keywordclassifier import (
+    KeywordClassifier,
+    Verdict,
+    normalize_tokens,
+)
+
+
+@pytest.fixture
+def classifier():
+    return KeywordClassifier(
+        keywords={
+            "golf": ["golfer", "tee time", "hole in one"],
+            "football": ["soccer", "fútbol", "world cup"],
+        },
+        ambiguous_terms=["tournament", "hole"],
+    )
+
+
+def test_normalize_tokens():
+    assert normalize_tokens("Fútbol, GOLF & Tee-Time!") == ["futbol", "golf", "tee", "time"]
+
+
+@pytest.mark.parametrize(
+    "text,expected_verdict,expected_matches",
+    [
+        ("Who won the GOLF tournament?", Verdict.MATCH, ["golf"]),
+        ("Can I book a tee time?", Verdict.MATCH, ["golf"]),
+        ("Futbol or soccer, and golf", Verdict.MATCH, ["football", "golf"]),
+        ("I got a hole in one", Verdict.MATCH, ["golf"]),
+        # Multi-word patterns are matched on whole words only
+        ("Is there a time for tea?", Verdict.NO_MATCH, []),
+        ("Does my plan cover golfing lessons?", Verdict.NO_MATCH, []),
+        ("Who is in the world series?", Verdict.NO_MATCH, []),
+        ("Who won the tournament?", Verdict.AMBIGUOUS, ["tournament"]),
+        ("There is a hole in my roof", Verdict.AMBIGUOUS, ["hole"]),
+        ("", Verdict.NO_MATCH, []),
+    ],
+)
+def test_classify(classifier, text, expected_verdict, expected_matches):
+    classification = classifier.classify(text)
+    assert classification.verdict == expected_verdict
+    assert classification.matches == expected_matches
+    assert classification.is_match == (expected_verdict == Verdict.MATCH)
+
+
+def test_overlapping_patterns():
+    # The failure links find "b c d" even though the text first follows the "a b c x" branch of the trie
+    classifier = KeywordClassifier(keywords={"first": ["a b c x"], "second": ["b c d"], "third": ["c"]})
+    assert classifier.classify("a b c d").matches == ["third", "second"]
+
+
+def test_from_file(tmp_path):
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps({"keywords": {"golf": ["pga"]}, "ambiguous": ["league"]}))
+    classifier = KeywordClassifier.from_file(rules_file)
+    assert classifier.keywords == ["golf"]
+    assert classifier.classify("PGA tour").is_match
+    assert classifier.classify("Which league?").verdict == Verdict.AMBIGUOUS
+
+
+def test_default_rules_cover_keywords():
+    classifier = KeywordClassifier.from_file(KeywordClassifier.DEFAULT_RULES_FILE)
+    assert classifier.keywords == ChatApproach.KEYWORDS
+    for keyword in ChatApproach.KEYWORDS:
+        assert classifier.classify(f"Tell me about {keyword}").matches == [keyword]
+
+
+def test_invalid_term():
+    with pytest.raises(ValueError):
+        KeywordClassifier(keywords={"golf": ["?!"]})
@@ -216,3 +216,68 @@ async def test_compute_embedding_autherror(monkeypatch, capsys):
         )
         monkeypatch.setattr(embeddings, "create_client", create_auth_error_limit_client)
         await embeddings.create_embeddings(texts=["foo"])
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_reuses_client(monkeypatch):
+    clients = []
+
+    class ClosingMockClient(MockClient):
+        closed = False
+
+        async def close(self):
+            self.closed = True
+
+    async def mock_create_client(*args, **kwargs):
+        clients.append(
+            ClosingMockClient(
+                embeddings_client=MockEmbeddingsClient(
+                    create_embedding_response=openai.types.CreateEmbeddingResponse(
+                        object="list",
+                        data=[openai.types.Embedding(embedding=[0.5, -0.5, 0.25], index=0, object="embedding")],
+                        model="text-embedding-ada-002",
+                        usage=Usage(prompt_tokens=8, total_tokens=8),
+                    )
+                )
+            )
+        )
+        return clients[-1]
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential=MockAzureCredential(),
+        organization="org",
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    # Each file of an ingestion run embeds its sections with the same client
+    for texts in (["foo"], ["bar"]):
+        assert await embeddings.create_embeddings(texts=texts) == [[0.5, -0.5, 0.25]]
+    embeddings.disable_batch = True
+    assert await embeddings.create_embeddings(texts=["baz"]) == [[0.5, -0.5, 0.25]]
+    assert len(clients) == 1
+
+    await embeddings.close()
+    assert clients[0].closed
+    assert embeddings.client is None
+
+
+def test_split_text_into_batches_uses_token_counts(monkeypatch):
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential=MockAzureCredential(),
+    )
+    encoded = []
+    calculate_token_lengths = embeddings.calculate_token_lengths
+
+    def mock_calculate_token_lengths(texts):
+        encoded.extend(texts)
+        return calculate_token_lengths(texts)
+
+    monkeypatch.setattr(embeddings, "calculate_token_lengths", mock_calculate_token_lengths)
+    # Only the text that the splitter did not count is encoded, and the counts decide the batches
+    batches = embeddings.split_text_into_batches(["foo", "bar", "baz"], token_counts=[5000, None, 5000])
+    assert encoded == ["bar"]
+    assert [batch.texts for batch in batches] == [["foo", "bar"], ["baz"]]
+    assert batches[0].token_length == 5000 + embeddings.calculate_token_length("bar")
@@ -0,0 +1,93 @@
+import openai
+import openai.types
+import pytest
+from openai.types.create_embedding_response import Usage
+
+from prepdocslib.embeddingcache import ChunkEmbeddingCache
+from prepdocslib.embeddings import OpenAIEmbeddingService
+
+from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME, MockClient
+
+
+def test_get_many_set_many(tmp_path):
+    cache = ChunkEmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    cache.set_many(["first section", "second section"], "text-embedding-3-small", 3, [[0.5, -0.25, 1.0], [1, 2, 3]])
+
+    assert cache.get_many(["second section", "First section", "first section"], "text-embedding-3-small", 3) == [
+        [1.0, 2.0, 3.0],
+        None,
+        [0.5, -0.25, 1.0],
+    ]
+    # The model and the dimensions are part of the key
+    assert cache.get_many(["first section"], "text-embedding-3-small", 256) == [None]
+    assert cache.get_many(["first section"], "text-embedding-3-large", 3) == [None]
+    assert cache.stats() == {"hits": 2, "misses": 3, "hit_ratio": 0.4}
+    cache.close()
+
+
+class RecordingEmbeddingsClient:
+    def __init__(self):
+        self.inputs = []
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        self.inputs.extend(kwargs["input"])
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[
+                openai.types.Embedding(embedding=[float(len(text)), 0.5], index=index, object="embedding")
+                for index, text in enumerate(kwargs["input"])
+            ],
+            model=MOCK_EMBEDDING_MODEL_NAME,
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+async def test_create_embeddings_uses_cache(tmp_path, monkeypatch):
+    embeddings_client = RecordingEmbeddingsClient()
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    async def ingest(texts):
+        # Each run of prepdocs opens the cache file again
+        cache = ChunkEmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+        embeddings = OpenAIEmbeddingService(
+            open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+            open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+            credential="key",
+            cache=cache,
+        )
+        monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+        result = await embeddings.create_embeddings(texts, token_counts=[2] * len(texts))
+        cache.close()
+        return result
+
+    assert await ingest(["a", "bb", "ccc"]) == [[1.0, 0.5], [2.0, 0.5], [3.0, 0.5]]
+    embeddings_client.inputs.clear()
+
+    # After an edit, only the new section is embedded
+    assert await ingest(["a", "bbbb", "ccc"]) == [[1.0, 0.5], [4.0, 0.5], [3.0, 0.5]]
+    assert embeddings_client.inputs == ["bbbb"]
+
+
+@pytest.mark.asyncio
+async def test_create_embeddings_embeds_repeated_sections_once(tmp_path, monkeypatch):
+    embeddings_client = RecordingEmbeddingsClient()
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    cache = ChunkEmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential="key",
+        cache=cache,
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    result = await embeddings.create_embeddings(["footer", "a", "footer", "bb", "a"], token_counts=[1, 1, 1, 1, 1])
+    cache.close()
+
+    assert result == [[6.0, 0.5], [1.0, 0.5], [6.0, 0.5], [2.0, 0.5], [1.0, 0.5]]
+    assert embeddings_client.inputs == ["footer", "a", "bb"]
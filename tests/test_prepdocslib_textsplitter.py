@@ -29,6 +29,8 @@ def test_sentencetextsplitter_split_small_pages():
     assert len(split_pages) == 1
     assert split_pages[0].page_num == 0
     assert split_pages[0].text == "Not a large page"
+    # The tokens counted to check the size of the section are kept for the index and the embeddings
+    assert split_pages[0].token_count == len(tiktoken.encoding_for_model(ENCODING_MODEL).encode("Not a large page"))
 
 
 @pytest.mark.asyncio
@@ -0,0 +1,161 @@
+import asyncio
+import shutil
+
+import jinja2
+import prompty
+import pytest
+
+from approaches.promptmanager import PromptyManager
+
+PAST_MESSAGES = [
+    {"role": "user", "content": "What is the deductible?"},
+    {"role": "assistant", "content": "The deductible is $500 [info1.txt]."},
+]
+
+
+def prepare_messages(prompt, data):
+    # The messages that prompty renders and parses without any caching, with the examples marker removed
+    messages = prompty.prepare(prompt, data)
+    for message in messages:
+        if isinstance(message["content"], str) and message["content"].startswith("(EXAMPLE)"):
+            message["content"] = message["content"][9:].lstrip()
+    return messages
+
+
+@pytest.mark.parametrize(
+    "prompt_path",
+    [
+        "ask_answer_question.prompty",
+        "chat_answer_question.prompty",
+        "chat_query_rewrite.prompty",
+        "chat_answer_question_vision.prompty",
+    ],
+)
+def test_render_prompt_reuses_static_messages(prompt_path):
+    prompt_manager = PromptyManager()
+    prompt = prompt_manager.load_prompt(prompt_path)
+    requests = [
+        {"user_query": "What is the deductible?", "past_messages": [], "text_sources": ["info1.txt: $500"]},
+        {"user_query": "And for families?", "past_messages": PAST_MESSAGES, "text_sources": ["info2.txt: $1000"]},
+        {"user_query": "What about dental?", "past_messages": PAST_MESSAGES * 2, "text_sources": []},
+    ]
+    for data in requests:
+        data = data | {"override_prompt": None, "injected_prompt": "", "include_follow_up_questions": True}
+        rendered = prompt_manager.render_prompt(prompt, data)
+        assert rendered.all_messages == prepare_messages(prompt, data)
+        assert rendered.system_content == rendered.all_messages[0]["content"]
+        assert rendered.past_messages == (data["past_messages"] if "past_messages" in prompt.content else [])
+        assert rendered.new_user_content == rendered.all_messages[-1]["content"]
+        assert rendered.all_messages[1 : 1 + len(rendered.few_shot_messages)] == rendered.few_shot_messages
+
+    assert prompt_manager.static_prompts.stats()["hits"] == len(requests) - 1
+
+
+def test_render_prompt_variants():
+    prompt_manager = PromptyManager()
+    prompt = prompt_manager.load_prompt("chat_answer_question.prompty")
+    data = {"user_query": "What is the deductible?", "past_messages": [], "text_sources": []}
+
+    default = prompt_manager.render_prompt(prompt, data | {"include_follow_up_questions": False})
+    with_follow_up = prompt_manager.render_prompt(prompt, data | {"include_follow_up_questions": True})
+    overridden = prompt_manager.render_prompt(prompt, data | {"override_prompt": "Answer in French."})
+    assert "follow-up questions" not in default.system_content
+    assert "follow-up questions" in with_follow_up.system_content
+    assert overridden.system_content.startswith("Answer in French.")
+
+    # Each variant of the system prompt is rendered once and then reused
+    assert prompt_manager.render_prompt(prompt, data | {"include_follow_up_questions": True}) == with_follow_up
+    assert len(prompt_manager.static_prompts) == 3
+
+
+def test_render_prompt_compiles_and_parses_static_messages_once(monkeypatch):
+    # Renders the chat answer prompt as requests with history and sources would, spying on Jinja and the parser
+    environments = []
+    parsed_texts = []
+
+    class SpyEnvironment(jinja2.Environment):
+        def __init__(self, *args, **kwargs):
+            environments.append(self)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(jinja2, "Environment", SpyEnvironment)
+    prompt_manager = PromptyManager()
+    parse_messages = prompt_manager.parse_messages
+
+    def spy_parse_messages(prompt, text):
+        parsed_texts.append(text)
+        return parse_messages(prompt, text)
+
+    monkeypatch.setattr(prompt_manager, "parse_messages", spy_parse_messages)
+    prompt = prompt_manager.load_prompt("chat_answer_question.prompty")
+    data = {
+        "override_prompt": None,
+        "injected_prompt": "",
+        "include_follow_up_questions": True,
+        "past_messages": PAST_MESSAGES * 3,
+        "text_sources": ["info1.txt: " + "In-network deductibles are $500 for employees. " * 20] * 3,
+    }
+    for index in range(10):
+        rendered = prompt_manager.render_prompt(prompt, data | {"user_query": f"Question {index}?"})
+
+    assert len(environments) == 1
+    # After the first request, only the messages of each request are parsed, without the system message
+    assert rendered.system_content.split("\n")[0] in parsed_texts[0]
+    assert len(parsed_texts) > 9
+    assert all(rendered.system_content.split("\n")[0] not in text for text in parsed_texts[-9:])
+    assert all(f"Question {index}?" in text for index, text in zip(range(1, 10), parsed_texts[-9:]))
+
+
+@pytest.fixture
+def prompts_directory(tmp_path, monkeypatch):
+    directory = tmp_path / "prompts"
+    shutil.copytree(PromptyManager.PROMPTS_DIRECTORY, directory)
+    monkeypatch.setattr(PromptyManager, "PROMPTS_DIRECTORY", directory)
+    return directory
+
+
+def test_reload(prompts_directory):
+    prompt_manager = PromptyManager()
+    version = prompt_manager.version
+    prompt = prompt_manager.load_prompt("chat_answer_question.prompty")
+    assert PromptyManager().version == version
+    assert prompt_manager.reload() is False
+
+    prompt_path = prompts_directory / "chat_answer_question.prompty"
+    prompt_path.write_text(prompt_path.read_text().replace("Assistant helps", "Assistant kindly helps"))
+    assert prompt_manager.reload() is True
+    assert prompt_manager.version != version
+    assert prompt_manager.reloads == 1
+    assert "Assistant kindly helps" in prompt_manager.load_prompt("chat_answer_question.prompty").content
+    # Requests that already looked up the prompt keep rendering the previous version
+    assert "Assistant kindly helps" not in prompt.content
+
+
+def test_reload_keeps_version_on_error(prompts_directory):
+    prompt_manager = PromptyManager()
+    version = prompt_manager.version
+    (prompts_directory / "chat_query_rewrite_tools.json").write_text('[{"type": "function",')
+    assert prompt_manager.reload() is False
+    assert prompt_manager.version == version
+    assert prompt_manager.load_tools("chat_query_rewrite_tools.json")[0]["type"] == "function"
+    with pytest.raises(ValueError, match="missing.json not found"):
+        prompt_manager.load_tools("missing.json")
+
+
+@pytest.mark.asyncio
+async def test_watch(prompts_directory):
+    prompt_manager = PromptyManager()
+    version = prompt_manager.version
+    watch = asyncio.create_task(prompt_manager.watch(0.01))
+    try:
+        await asyncio.sleep(0.05)
+        assert prompt_manager.reloads == 0
+        (prompts_directory / "chat_extra_tools.json").write_text("[]")
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if prompt_manager.reloads:
+                break
+        assert prompt_manager.version != version
+        assert prompt_manager.load_tools("chat_extra_tools.json") == []
+    finally:
+        watch.cancel()
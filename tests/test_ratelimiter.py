@@ -0,0 +1,143 @@
+import asyncio
+
+import openai
+import openai.types
+import pytest
+from httpx import Request, Response
+from openai.types.create_embedding_response import Usage
+
+from prepdocslib.embeddings import OpenAIEmbeddingService
+from prepdocslib.ratelimiter import EmbeddingRateLimiter, TokenBucket
+
+from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME, MockClient
+
+
+def rate_limit_error(headers=None):
+    response = Response(429, headers=headers, request=Request(method="post", url="https://foo.bar/"))
+    return openai.RateLimitError(message="Rate limited", response=response, body=None)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(per_minute=600)
+    assert bucket.get_wait_time(600) == 0
+    bucket.take(600)
+    # Refilled at 10 per second
+    assert bucket.get_wait_time(100) == pytest.approx(10, abs=0.1)
+    # Larger amounts than the bucket only wait for it to be full
+    assert bucket.get_wait_time(1000) == pytest.approx(60, abs=0.1)
+    bucket.limit(0)
+    assert bucket.available <= 0
+
+
+def test_aimd():
+    rate_limiter = EmbeddingRateLimiter(max_concurrency=8)
+    rate_limiter.record_rate_limit(admitted_at=1, error=rate_limit_error())
+    assert rate_limiter.concurrency == 4
+    # Requests that were already in flight when the limit was lowered do not lower it again
+    rate_limiter.record_rate_limit(admitted_at=1, error=rate_limit_error())
+    assert rate_limiter.concurrency == 4
+
+    for _ in range(4):
+        rate_limiter.record_success()
+    assert 4.9 < rate_limiter.concurrency < 5
+    for _ in range(100):
+        rate_limiter.record_success()
+    assert rate_limiter.concurrency == 8
+
+
+def test_retry_after():
+    rate_limiter = EmbeddingRateLimiter()
+    rate_limiter.record_rate_limit(admitted_at=0, error=rate_limit_error({"retry-after-ms": "2500"}))
+    assert rate_limiter.get_wait_time(100) == pytest.approx(2.5, abs=0.1)
+    assert EmbeddingRateLimiter.get_retry_after(rate_limit_error({"retry-after": "3"}).response.headers) == 3
+    assert EmbeddingRateLimiter.get_retry_after(rate_limit_error().response.headers) is None
+
+
+@pytest.mark.asyncio
+async def test_update_from_response():
+    rate_limiter = EmbeddingRateLimiter()
+    assert rate_limiter.tokens is None
+    await rate_limiter.update_from_response(
+        Response(
+            200,
+            headers={
+                "x-ratelimit-limit-tokens": "120000",
+                "x-ratelimit-remaining-tokens": "1000",
+                "x-ratelimit-remaining-requests": "10",
+            },
+        )
+    )
+    assert rate_limiter.tokens.capacity == 120000
+    assert rate_limiter.tokens.available == pytest.approx(1000, abs=10)
+    # Azure OpenAI only sends the remaining requests, which are paced from then on
+    assert rate_limiter.requests.capacity == 10
+    assert rate_limiter.requests.available == pytest.approx(10, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_update_from_remaining_headers():
+    rate_limiter = EmbeddingRateLimiter(requests_per_minute=60)
+    await rate_limiter.update_from_response(
+        Response(200, headers={"x-ratelimit-remaining-tokens": "5000", "x-ratelimit-remaining-requests": "100"})
+    )
+    assert rate_limiter.tokens.capacity == 5000
+    # The limit is the larger of the configured limit and the remaining amount
+    assert rate_limiter.requests.capacity == 100
+    assert rate_limiter.requests.available == pytest.approx(60, abs=1)
+
+    await rate_limiter.update_from_response(
+        Response(200, headers={"x-ratelimit-remaining-tokens": "90000", "x-ratelimit-remaining-requests": "20"})
+    )
+    assert rate_limiter.tokens.capacity == 90000
+    assert rate_limiter.requests.capacity == 100
+    assert rate_limiter.requests.available == pytest.approx(20, abs=1)
+
+
+class ConcurrentEmbeddingsClient:
+    def __init__(self, rate_limited_calls=0):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.rate_limited_calls = rate_limited_calls
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            if self.rate_limited_calls:
+                self.rate_limited_calls -= 1
+                raise rate_limit_error()
+        finally:
+            self.in_flight -= 1
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[
+                openai.types.Embedding(embedding=[float(text)], index=index, object="embedding")
+                for index, text in enumerate(kwargs["input"])
+            ],
+            model=MOCK_EMBEDDING_MODEL_NAME,
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+async def test_create_embeddings_concurrently(monkeypatch):
+    embeddings_client = ConcurrentEmbeddingsClient(rate_limited_calls=1)
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    monkeypatch.setattr("tenacity.wait_random_exponential.__call__", lambda x, y: 0)
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential="key",
+        rate_limiter=EmbeddingRateLimiter(max_concurrency=3),
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+
+    # 100 texts are split into batches of 16, which are embedded a few at a time
+    texts = [str(index) for index in range(100)]
+    assert await embeddings.create_embeddings(texts) == [[float(text)] for text in texts]
+    assert 1 < embeddings_client.max_in_flight <= 3
+    assert embeddings.rate_limiter.in_flight == 0
@@ -0,0 +1,126 @@
+import logging
+from random import Random
+
+from approaches.approach import Document
+from approaches.reranker import (
+    BM25Reranker,
+    MMRReranker,
+    RRFReranker,
+    get_reranker,
+    reciprocal_rank_fusion,
+)
+
+from .mocks import MockCaption
+
+
+def create_document(id, content, embedding=None, captions=None):
+    return Document(
+        id=id,
+        content=content,
+        embedding=embedding,
+        image_embedding=None,
+        category=None,
+        sourcepage=f"{id}.pdf",
+        sourcefile=f"{id}.pdf",
+        oids=None,
+        groups=None,
+        captions=captions or [],
+    )
+
+
+def test_reciprocal_rank_fusion():
+    a, b, c = create_document("a", ""), create_document("b", ""), create_document("c", "")
+    fused = reciprocal_rank_fusion([[a, b, c], [c, b], [b, c, a]])
+    assert [document.id for document in fused] == ["b", "c", "a"]
+
+
+def test_bm25_reranker():
+    documents = [
+        create_document("hours", "The office is open from 9 to 5."),
+        create_document("dress", "The dress code is business casual. Jeans are allowed on Fridays."),
+        create_document("parking", "Parking is free for employees."),
+    ]
+    reranked = BM25Reranker().rerank(["Are jeans part of the dress code?"], documents, top=2)
+    assert [document.id for document in reranked] == ["dress", "hours"]
+
+
+def test_bm25_reranker_uses_captions():
+    documents = [
+        create_document("a", "Parking is free.", captions=[MockCaption("Parking")]),
+        create_document("b", "Parking is free.", captions=[MockCaption("Dress code")]),
+    ]
+    reranked = BM25Reranker().rerank(["dress code"], documents, top=1)
+    assert [document.id for document in reranked] == ["b"]
+
+
+def test_mmr_reranker():
+    documents = [
+        create_document("a", "", embedding=[1.0, 0.0, 0.0]),
+        create_document("a-copy", "", embedding=[0.99, 0.01, 0.0]),
+        create_document("b", "", embedding=[0.6, 0.8, 0.0]),
+    ]
+    # The near duplicate of the first pick is skipped for a less relevant but different document
+    reranked = MMRReranker(diversity=0.7).rerank(["query"], documents, top=2, query_vector=[1.0, 0.0, 0.0])
+    assert [document.id for document in reranked] == ["a", "b"]
+
+    # Without diversity, it is only the order of relevance
+    reranked = MMRReranker(diversity=0).rerank(["query"], documents, top=2, query_vector=[1.0, 0.0, 0.0])
+    assert [document.id for document in reranked] == ["a", "a-copy"]
+
+
+def test_mmr_reranker_compares_each_pair_once(monkeypatch):
+    random = Random(0)
+    documents = [
+        create_document(str(index), "", embedding=[random.uniform(-1, 1) for _ in range(8)]) for index in range(30)
+    ]
+    query_vector = [random.uniform(-1, 1) for _ in range(8)]
+    reranker = MMRReranker(diversity=0.5)
+
+    # The picks of the definition of MMR, which compares each candidate to every selected document
+    vectors = [reranker.normalize(document.embedding) for document in documents]
+    relevance = [reranker.similarity(reranker.normalize(query_vector), vector) for vector in vectors]
+    expected: list[int] = []
+    while len(expected) < 10:
+        expected.append(
+            max(
+                (index for index in range(len(documents)) if index not in expected),
+                key=lambda index: 0.5 * relevance[index]
+                - 0.5 * max((reranker.similarity(vectors[index], vectors[other]) for other in expected), default=0),
+            )
+        )
+
+    comparisons = 0
+    similarity = MMRReranker.similarity
+
+    def count_similarity(first, second):
+        nonlocal comparisons
+        comparisons += 1
+        return similarity(first, second)
+
+    monkeypatch.setattr(MMRReranker, "similarity", staticmethod(count_similarity))
+    reranked = reranker.rerank(["query"], documents, top=10, query_vector=query_vector)
+    assert [document.id for document in reranked] == [str(index) for index in expected]
+    # The relevance of the 30 candidates, and the remaining ones against each of the first 9 picks
+    assert comparisons == 30 + sum(range(21, 30))
+
+
+def test_rrf_reranker():
+    documents = [
+        create_document("benefits", "Health insurance benefits."),
+        create_document("dress", "The dress code is business casual."),
+        create_document("parking", "Parking is free."),
+    ]
+    reranked = RRFReranker().rerank(["dress code", "What should I wear at the office? dress"], documents, top=2)
+    assert [document.id for document in reranked] == ["dress", "benefits"]
+
+
+def test_get_reranker(caplog):
+    assert get_reranker({}) is None
+    assert isinstance(get_reranker({"reranker": "bm25"}), BM25Reranker)
+    assert get_reranker({"reranker": "mmr"}).uses_vectors
+    assert get_reranker({"reranker": "rrf"}).get_candidate_count(3) == 9
+    assert get_reranker({"reranker": "rrf"}).get_candidate_count(20) == 50
+    # An unknown reranker from the client is not a server error
+    with caplog.at_level(logging.WARNING):
+        assert get_reranker({"reranker": "cross-encoder"}) is None
+    assert "Unknown reranker 'cross-encoder'" in caplog.text
@@ -0,0 +1,129 @@
+import pytest
+from azure.search.documents.models import VectorizedQuery
+
+from approaches.promptmanager import PromptyManager
+from approaches.retrievethenread import RetrieveThenReadApproach
+from core.searchcache import SearchCache
+from prepdocslib.indexversion import IndexVersion
+
+from .mocks import (
+    MOCK_EMBEDDING_DIMENSIONS,
+    MOCK_EMBEDDING_MODEL_NAME,
+    MockAsyncSearchResultsIterator,
+)
+
+
+class MockSearchClient:
+    """
+    Local stand-in for the Azure AI Search client, which counts the searches
+    """
+
+    def __init__(self):
+        self.searches = 0
+
+    async def search(self, *args, **kwargs):
+        self.searches += 1
+        return MockAsyncSearchResultsIterator(kwargs.get("search_text"), kwargs.get("vector_queries"))
+
+
+def create_approach(search_client, search_cache):
+    return RetrieveThenReadApproach(
+        search_client=search_client,
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        prompt_manager=PromptyManager(),
+        search_cache=search_cache,
+    )
+
+
+async def search(approach, query_text="whistleblower policy", filter=None, vectors=None, use_semantic_ranker=True):
+    return await approach.search(
+        top=3,
+        query_text=query_text,
+        filter=filter,
+        vectors=vectors or [],
+        use_text_search=True,
+        use_vector_search=True,
+        use_semantic_ranker=use_semantic_ranker,
+        use_semantic_captions=False,
+        minimum_search_score=0,
+        minimum_reranker_score=0,
+    )
+
+
+def test_search_cache_key():
+    vector = VectorizedQuery(vector=[0.1, 0.2, 0.3], k_nearest_neighbors=50, fields="embedding")
+    key = SearchCache.create_key("dress code", [vector], None, 3, use_semantic_ranker=True)
+    same_vector = VectorizedQuery(vector=[0.1, 0.2, 0.3], k_nearest_neighbors=50, fields="embedding")
+    assert key == SearchCache.create_key("dress code", [same_vector], None, 3, use_semantic_ranker=True)
+
+    other_vector = VectorizedQuery(vector=[0.1, 0.2, 0.4], k_nearest_neighbors=50, fields="embedding")
+    assert key != SearchCache.create_key("dress code", [other_vector], None, 3, use_semantic_ranker=True)
+    assert key != SearchCache.create_key("dress code", [vector], "category eq 'hr'", 3, use_semantic_ranker=True)
+    assert key != SearchCache.create_key("dress code", [vector], None, 5, use_semantic_ranker=True)
+    assert key != SearchCache.create_key("dress code", [vector], None, 3, use_semantic_ranker=False)
+
+
+@pytest.mark.asyncio
+async def test_search_cache_hits():
+    search_client = MockSearchClient()
+    search_cache = SearchCache(max_size=10, ttl=60)
+    approach = create_approach(search_client, search_cache)
+
+    documents = await search(approach)
+    assert await search(approach) == documents
+    assert search_client.searches == 1
+
+    # Any difference in the search, such as the security filter, is sent to the search service
+    await search(approach, filter="oids/any(g:search.in(g, 'OID_X'))")
+    await search(approach, use_semantic_ranker=False)
+    assert search_client.searches == 3
+
+    assert search_cache.stats() == {
+        "size": 3,
+        "hits": 1,
+        "misses": 3,
+        "hit_ratio": 0.25,
+        "approaches": {"RetrieveThenReadApproach": {"hits": 1, "misses": 3, "hit_ratio": 0.25}},
+    }
+
+
+@pytest.mark.asyncio
+async def test_search_cache_index_version():
+    search_client = MockSearchClient()
+    index_version = IndexVersion()
+    approach = create_approach(search_client, SearchCache(max_size=10, ttl=60, index_version=index_version))
+
+    await search(approach)
+    index_version.bump()
+    await search(approach)
+    assert search_client.searches == 2
+
+
+@pytest.mark.asyncio
+async def test_search_cache_repeated_queries():
+    # Repeats a small set of queries, with and without the cache, counting the calls to the search service
+    queries = ["whistleblower policy", "interest rates", "dress code", "vacation days"] * 5
+
+    async def run_queries(approach):
+        for query in queries:
+            await search(approach, query_text=query)
+
+    uncached_client = MockSearchClient()
+    await run_queries(create_approach(uncached_client, None))
+    cached_client = MockSearchClient()
+    search_cache = SearchCache(max_size=10, ttl=60)
+    await run_queries(create_approach(cached_client, search_cache))
+
+    assert uncached_client.searches == len(queries)
+    assert cached_client.searches == 4
+    assert search_cache.stats()["hit_ratio"] == 0.8
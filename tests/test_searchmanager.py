@@ -17,7 +17,7 @@ from prepdocslib.embeddings import AzureOpenAIEmbeddingService
 from prepdocslib.listfilestrategy import File
 from prepdocslib.searchmanager import SearchManager, Section
 from prepdocslib.strategy import SearchInfo
-from prepdocslib.textsplitter import SplitPage
+from prepdocslib.textsplitter import SplitPage, bpe
 
 from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
@@ -97,7 +97,8 @@ async def test_create_index_does_exist(monkeypatch, search_info):
                     name="storageUrl",
                     type=SearchFieldDataType.String,
                     filterable=True,
-                )
+                ),
+                SimpleField(name="token_count", type=SearchFieldDataType.Int32),
             ],
         )
 
@@ -144,8 +145,7 @@ async def test_create_index_add_field(monkeypatch, search_info):
     await manager.create_index()
     assert len(created_indexes) == 0, "It should not have created a new index"
     assert len(updated_indexes) == 1, "It should have updated the existing index"
-    assert len(updated_indexes[0].fields) == 1
-    assert updated_indexes[0].fields[0].name == "storageUrl"
+    assert [field.name for field in updated_indexes[0].fields] == ["storageUrl", "token_count"]
 
 
 @pytest.mark.asyncio
@@ -181,6 +181,7 @@ async def test_update_content(monkeypatch, search_info):
         assert documents[0]["category"] == "test"
         assert documents[0]["sourcepage"] == "foo.pdf#page=1"
         assert documents[0]["sourcefile"] == "foo.pdf"
+        assert documents[0]["token_count"] == len(bpe.encode("test content"))
 
     monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
 
@@ -490,3 +491,69 @@ async def test_remove_content_no_inf_loop(monkeypatch, search_info):
     assert len(searched_filters) == 1, "It should have searched once"
     assert searched_filters[0] == "sourcefile eq 'foo.pdf'"
     assert len(deleted_documents) == 0, "It should have deleted no documents"
+
+
+@pytest.mark.asyncio
+async def test_update_content_incremental(monkeypatch, search_info):
+    index = {}
+    actions = []
+
+    async def mock_search(self, *args, **kwargs):
+        assert kwargs.get("filter") == "sourcefile eq 'foo''s.pdf'"
+        return AsyncSearchResultsIterator(
+            [{"id": document["id"], "content_hash": document.get("content_hash")} for document in index.values()]
+        )
+
+    async def mock_upload_documents(self, documents):
+        actions.extend(("upload", document["id"]) for document in documents)
+        index.update({document["id"]: document for document in documents})
+
+    async def mock_merge_documents(self, documents):
+        actions.extend(("merge", document["id"]) for document in documents)
+        for document in documents:
+            index[document["id"]] = {**index[document["id"]], **document}
+
+    async def mock_delete_documents(self, documents):
+        actions.extend(("delete", document["id"]) for document in documents)
+        for document in documents:
+            del index[document["id"]]
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "merge_documents", mock_merge_documents)
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/foo's.pdf"
+    file = File(test_io)
+
+    def create_sections(texts):
+        return [
+            Section(split_page=SplitPage(page_num=page_num, text=text), content=file, category="test")
+            for page_num, text in enumerate(texts)
+        ]
+
+    manager = SearchManager(search_info, incremental=True)
+    # A positional chunk from before the incremental mode is replaced
+    index["file-foo_s_pdf-666F6F27732E706466-chunk-0"] = {"id": "file-foo_s_pdf-666F6F27732E706466-chunk-0"}
+    texts = [f"page {page_num}" for page_num in range(300)] + ["footer", "footer"]
+    chunk_ids = await manager.update_content(create_sections(texts))
+    assert len(set(chunk_ids)) == 302
+    assert sorted(index) == sorted(chunk_ids)
+    assert [action for action, _ in actions].count("upload") == 302
+    assert actions[-1] == ("delete", "file-foo_s_pdf-666F6F27732E706466-chunk-0")
+
+    # Only the edited page is sent again, and its previous chunk is removed
+    actions.clear()
+    texts[150] = "page 150, edited"
+    new_chunk_ids = await manager.update_content(create_sections(texts))
+    assert actions == [("upload", new_chunk_ids[150]), ("delete", chunk_ids[150])]
+    assert new_chunk_ids[:150] == chunk_ids[:150]
+
+    # Unchanged texts with new metadata are merged
+    actions.clear()
+    await manager.update_content(create_sections(texts[:1]), url="https://test/foo's.pdf")
+    assert actions[0] == ("merge", chunk_ids[0])
+    assert index[chunk_ids[0]]["storageUrl"] == "https://test/foo's.pdf"
+    assert [action for action, _ in actions].count("delete") == 301
+    assert list(index) == [chunk_ids[0]]